@@ -4,16 +4,17 @@ import copy
 import logging
 import os
 import pickle
-import socket
 import ssl
 import time
 from collections import deque
+from dataclasses import replace
 from typing import BinaryIO, Callable, Deque, Dict, List, Optional, Union, cast
 from urllib.parse import urlparse
 
 import aioquic
 from aioquic.asyncio.tunnel_transport import MasqueTransport
 from aioquic.masque.events import ConnectFailed, Connected, MasqueEvent, ProxiedDatagramReceived
+from aioquic.masque.resolver import Resolver
 from aioquic.masque.tunnel import MasqueTunnel, UdpTunnel
 from aioquic.quic.connection import QuicConnection, QuicTokenHandler
 import wsproto
@@ -24,12 +25,13 @@ from aioquic.h0.connection import H0_ALPN, H0Connection
 from aioquic.h3.connection import H3_ALPN, ErrorCode, H3Connection
 from aioquic.h3.events import (
     DataReceived,
+    DatagramDropped,
     DatagramReceived,
     H3Event,
     HeadersReceived,
     PushPromiseReceived,
 )
-from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.configuration import SMALLEST_MAX_DATAGRAM_SIZE, QuicConfiguration
 from aioquic.quic.events import QuicEvent
 from aioquic.quic.logger import QuicFileLogger
 from aioquic.quic.packet import QuicProtocolVersion
@@ -133,6 +135,7 @@ class MasqueClient(QuicConnectionProtocol):
         super().__init__(*args, **kwargs)
 
         self._connect_waiter: Dict[int, asyncio.Future[MasqueEvent]] = {}
+        self._flush_task: Optional[asyncio.TimerHandle] = None
         self._http = H3Connection(self._quic, enable_masque=True)
         self._tunnels: Dict[int, MasqueTunnel] = {}
         self._transports: Dict[int, MasqueTransport] = {}
@@ -144,9 +147,40 @@ class MasqueClient(QuicConnectionProtocol):
                           create_protocol: Callable = QuicConnectionProtocol,
                           session_ticket_handler: Optional[SessionTicketHandler] = None,
                           token_handler: Optional[QuicTokenHandler] = None,
+                          flush_delay: Optional[float] = 0.0,
+                          optimistic: bool = False,
+                          resolver: Optional[Resolver] = None,
                           ) -> Optional[QuicConnectionProtocol]:
+        """
+        Open a CONNECT-UDP tunnel and run a QUIC connection to `addr` over it.
+
+        Datagrams sent by the inner connection are coalesced: they are queued
+        on the outer connection and transmitted on the next event loop
+        iteration, or after `flush_delay` seconds if it is set. Pass
+        `flush_delay=None` to transmit every datagram immediately.
+
+        The inner connection's `max_datagram_size` is set to the largest
+        payload the tunnel can carry.
+
+        If `optimistic` is set, the inner connection starts without waiting
+        for the response to the CONNECT-UDP request, so that its Initial
+        packet is sent in the same flight as the request. If the proxy then
+        rejects the request, the inner connection is closed.
+
+        The host name in `addr` is resolved with `resolver`, which can be a
+        :class:`~aioquic.masque.resolver.CachingResolver` shared by several
+        tunnels.
+        """
         if self._http is None:
             raise Exception("No HTTP connection")
+
+        [host, port] = addr.split(':')
+        if resolver is None:
+            resolver = Resolver()
+        infos = await resolver.resolve(host, int(port))
+        target = infos[0][4]
+        if len(target) == 2:
+            target = ("::ffff:" + target[0], target[1], 0, 0)
         
         stream_id = self._quic.get_next_available_stream_id()
         tunnel = UdpTunnel(self._http, stream_id)
@@ -154,11 +188,22 @@ class MasqueClient(QuicConnectionProtocol):
         tunnel.connect(uri)
         waiter = self._loop.create_future()
         self._connect_waiter[stream_id] = waiter
-        try:
-            await asyncio.shield(waiter)
-        except Exception as e:
-            logger.error(f"{e}")
-            return None
+        if not optimistic:
+            try:
+                await asyncio.shield(waiter)
+            except Exception as e:
+                logger.error(f"{e}")
+                return None
+
+        max_payload_size = tunnel.max_datagram_payload_size
+        if max_payload_size is not None:
+            if max_payload_size < SMALLEST_MAX_DATAGRAM_SIZE:
+                logger.error(
+                    f"Tunnel only carries {max_payload_size} bytes datagrams, "
+                    f"QUIC requires {SMALLEST_MAX_DATAGRAM_SIZE}"
+                )
+                return None
+            configuration = replace(configuration, max_datagram_size=max_payload_size)
 
         connection = QuicConnection(
             configuration=configuration, 
@@ -168,25 +213,56 @@ class MasqueClient(QuicConnectionProtocol):
 
         def send_datagram(data: bytes) -> None:
             tunnel.send_datagram(data)
-            self.transmit()
+            if flush_delay is None:
+                self.transmit()
+            elif flush_delay:
+                self._flush_later(flush_delay)
+            else:
+                self._transmit_soon()
 
         proto: QuicConnectionProtocol = create_protocol(connection)
         transport = MasqueTransport(addr=addr, send=send_datagram)
         self._transports[stream_id] = transport
         proto.connection_made(transport)
         transport.set_protocol(proto)
-        [host, port] = addr.split(':')
-        infos = await self._loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
-        target = infos[0][4]
-        if len(target) == 2:
-            target = ("::ffff:" + target[0], target[1], 0, 0)
         proto.connect(target)
-        await proto.wait_connected()
+        if optimistic:
+            connected = asyncio.ensure_future(proto.wait_connected())
+            try:
+                await asyncio.shield(waiter)
+            except Exception as e:
+                logger.error(f"{e}")
+                connected.cancel()
+                self.close_udp(proto)
+                return None
+            await connected
+        else:
+            await proto.wait_connected()
         
         return proto
 
+    def close_udp(self, protocol: QuicConnectionProtocol) -> None:
+        """
+        Close a connection returned by :meth:`connect_udp` and its tunnel.
+        """
+        for stream_id, transport in list(self._transports.items()):
+            if transport.get_protocol() is protocol:
+                protocol.close()
+                del self._transports[stream_id]
+                del self._tunnels[stream_id]
+                self._http.send_data(stream_id, b"", end_stream=True)
+                self.transmit()
+
+    def _flush(self) -> None:
+        self._flush_task = None
+        self.transmit()
+
+    def _flush_later(self, delay: float) -> None:
+        if self._flush_task is None:
+            self._flush_task = self._loop.call_later(delay, self._flush)
+
     def http_event_received(self, event: H3Event) -> None:
-        if isinstance(event, (HeadersReceived, DataReceived, DatagramReceived)) and event.stream_id in self._tunnels:
+        if isinstance(event, (HeadersReceived, DataReceived, DatagramReceived, DatagramDropped)) and event.stream_id in self._tunnels:
             masque_events = self._tunnels[event.stream_id].handle_http_event(event)
             for masque_event in masque_events:
                 self.masque_event_received(masque_event)
@@ -505,6 +581,12 @@ async def main(
                 configuration=configuration, 
                 create_protocol=HttpClient,
                 session_ticket_handler=save_session_ticket,
+                flush_delay=(
+                    args.masque_flush_delay / 1e6
+                    if args.masque_flush_delay >= 0
+                    else None
+                ),
+                optimistic=args.masque_optimistic,
             )
             if not client:
                 logger.info("Connect UDP failed")
@@ -622,6 +704,18 @@ if __name__ == "__main__":
         default="",
         help="connect via an HTTP3 proxy at the specified URI (must be HTTPS)",
     )
+    parser.add_argument(
+        "--masque-flush-delay",
+        type=float,
+        default=0.0,
+        help="microseconds to wait for more tunneled datagrams before transmitting, "
+        "or a negative value to transmit every datagram immediately",
+    )
+    parser.add_argument(
+        "--masque-optimistic",
+        action="store_true",
+        help="start the tunneled connection before the proxy accepts the tunnel",
+    )
     parser.add_argument(
         "-d", "--data", type=str, help="send the specified data in a POST request"
     )
@@ -1,18 +1,21 @@
 import argparse
 import asyncio
 import importlib
+import ipaddress
 import logging
+import multiprocessing
 import socket
+import tempfile
 import time
 from collections import deque
 from email.utils import formatdate
-from typing import Callable, Deque, Dict, List, Optional, Union, cast
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union, cast
 
 import aioquic
 import wsproto
 import wsproto.events
 from aioquic.asyncio import QuicConnectionProtocol, serve
-from aioquic.buffer import encode_uint_var
+from aioquic.asyncio.router import QuicWorkerRouter
 from aioquic.h0.connection import H0_ALPN, H0Connection
 from aioquic.h3.connection import H3_ALPN, H3Connection
 from aioquic.h3.events import (
@@ -23,9 +26,20 @@ from aioquic.h3.events import (
     WebTransportStreamDataReceived,
 )
 from aioquic.h3.exceptions import NoAvailablePushIDError
-from aioquic.masque.capsule import CapsuleBuffer, DatagramCapsule, encode_datagram_capsule
+from aioquic.masque.capsule import AssignedAddress, IpAddress, IpAddressRange
+from aioquic.masque.events import AddressRequested, ProxiedDatagramReceived
+from aioquic.masque.exceptions import MasqueError
+from aioquic.masque.proxy import MasqueProxy
+from aioquic.masque.resolver import CachingResolver, Resolver
+from aioquic.masque.tunnel import IpTunnel
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import DatagramFrameReceived, ProtocolNegotiated, QuicEvent
+from aioquic.quic.events import (
+    ConnectionTerminated,
+    DatagramFrameReceived,
+    ProtocolNegotiated,
+    QuicEvent,
+    StreamReset,
+)
 from aioquic.quic.logger import QuicFileLogger
 from aioquic.tls import SessionTicket
 
@@ -322,49 +336,114 @@ class WebTransportHandler:
         self.transmit()
 
 
-class MasqueHandler:
+class TunDevice:
+    """
+    Stand-in for a TUN device, backed by a datagram socketpair.
+
+    IP packets written by the proxy come out of :attr:`peer`, and packets
+    written to :attr:`peer` are routed to the handler owning the
+    destination address. A real deployment would open `/dev/net/tun`.
+
+    Addresses are handed out from `networks`, which may mix IPv4 and IPv6
+    networks, and returned to the pool when their tunnel closes.
+    """
+
+    def __init__(self, networks: Sequence[str] = ("10.89.0.0/24", "fd89::/120")) -> None:
+        self.peer, self._sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._free: Dict[int, Deque[IpAddress]] = {4: deque(), 6: deque()}
+        for network in networks:
+            parsed = ipaddress.ip_network(network)
+            self._free[parsed.version].extend(parsed.hosts())
+        self._handlers: Dict[bytes, "MasqueIpHandler"] = {}
+        self._reader_added = False
+
+    @property
+    def available(self) -> int:
+        """
+        The number of addresses which can be allocated, of either version.
+        """
+        return len(self._free[4]) + len(self._free[6])
+
+    def allocate(self, handler: "MasqueIpHandler", version: int) -> Optional[IpAddress]:
+        """
+        Allocate an address of the given IP version, or return `None` if
+        there is none left.
+        """
+        free = self._free[version]
+        if not free:
+            return None
+        address = free.popleft()
+        self._handlers[address.packed] = handler
+        if not self._reader_added:
+            asyncio.get_event_loop().add_reader(self._sock.fileno(), self._read)
+            self._reader_added = True
+        return address
+
+    def release(self, address: IpAddress) -> None:
+        if self._handlers.pop(address.packed, None) is not None:
+            self._free[address.version].append(address)
+
+    def write(self, packet: bytes) -> None:
+        try:
+            self._sock.send(packet)
+        except (BlockingIOError, OSError):
+            pass
+
+    def _read(self) -> None:
+        while True:
+            try:
+                packet = self._sock.recv(65535)
+            except BlockingIOError:
+                return
+            # route packets on their destination address
+            addresses = packet_addresses(packet)
+            if addresses is not None:
+                handler = self._handlers.get(addresses[1])
+                if handler is not None:
+                    handler.send_to_client(packet)
+
+
+def packet_addresses(packet: bytes) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Return the packed source and destination addresses of an IP packet, or
+    `None` if it is not a complete IPv4 or IPv6 header.
+    """
+    version = packet[0] >> 4 if packet else 0
+    if version == 4 and len(packet) >= 20:
+        return packet[12:16], packet[16:20]
+    elif version == 6 and len(packet) >= 40:
+        return packet[8:24], packet[24:40]
+    return None
+
+
+class MasqueIpHandler:
+    """
+    The proxy end of a CONNECT-IP tunnel, forwarding packets to a
+    :class:`TunDevice`.
+
+    An address of each IP version is assigned when the tunnel opens, if the
+    device has one left, and ADDRESS_REQUEST capsules are answered with the
+    address of the requested version.
+    """
+
     def __init__(
         self,
         *,
         connection: H3Connection,
         stream_id: int,
-        target_host: str,
-        target_port: int,
         transmit: Callable[[], None],
+        tun: TunDevice,
     ) -> None:
         self.connection = connection
         self.stream_id = stream_id
-        self.target_host = target_host
-        self.target_port = target_port
         self.transmit = transmit
-        self.transport: Optional[asyncio.DatagramTransport] = None
-        self.protocol: Optional[asyncio.DatagramProtocol] = None
-        self._capsule_buffer = CapsuleBuffer()
-        
-    async def start(self) -> None:
-        # Resolve target host
-        self.connection._quic._logger.debug(f"Masque handler resolving for: {self.target_host}")
-        loop = asyncio.get_event_loop()
-        try:
-            infos = await loop.getaddrinfo(
-                self.target_host, self.target_port, 
-                family=socket.AF_UNSPEC, type=socket.SOCK_DGRAM
-            )
-        except socket.gaierror:
-            # Send 404 for resolution failure
-            self.connection.send_headers(
-                stream_id=self.stream_id,
-                headers=[(b":status", b"404")],
-            )
-            self.transmit()
-            return
-        
-        # Choose first available address (prefer IPv4)
-        ipv4_addresses = [info[4][0] for info in infos if info[0] == socket.AF_INET]
-        ipv6_addresses = [info[4][0] for info in infos if info[0] == socket.AF_INET6]
-        target_addr = ipv4_addresses[0] if ipv4_addresses else ipv6_addresses[0]
-        
-        # Send 200 response with capsule-protocol header
+        self.tun = tun
+        self.addresses: Dict[int, IpAddress] = {}
+        self.tunnel = IpTunnel(connection, stream_id)
+        self._closed = False
+
+    def start(self) -> None:
         self.connection.send_headers(
             stream_id=self.stream_id,
             headers=[
@@ -372,77 +451,130 @@ class MasqueHandler:
                 (b"capsule-protocol", b"?1"),
             ],
         )
-        self.transmit()
-        
-        # Create UDP socket and protocol
-        self.transport, self.protocol = await loop.create_datagram_endpoint(
-            lambda: MasqueDatagramProtocol(self),
-            remote_addr=(target_addr, self.target_port)
+        self.tunnel.mark_connected()
+        for version in (4, 6):
+            address = self.tun.allocate(self, version)
+            if address is not None:
+                self.addresses[version] = address
+        self._assign_addresses([])
+        self.tunnel.advertise_routes(
+            [
+                IpAddressRange(
+                    start=ipaddress.IPv4Address("0.0.0.0"),
+                    end=ipaddress.IPv4Address("255.255.255.255"),
+                ),
+                IpAddressRange(
+                    start=ipaddress.IPv6Address("::"),
+                    end=ipaddress.IPv6Address("ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"),
+                ),
+            ]
         )
-    
+        self.transmit()
+
     async def run_asgi(self, app) -> None:
-        # MASQUE handlers don't use ASGI, just keep the connection alive
         pass
 
-    def send_to_target(self, data: bytes) -> None:
-        if self.transport:
-            self.transport.sendto(data)
-    
-    def send_to_client(self, data: bytes, via_stream: bool = False) -> None:
-        context_id = encode_uint_var(0)  # UDP_PAYLOAD
-        datagram = context_id + data
-        if via_stream:
-            self.connection.send_data(
-                self.stream_id, encode_datagram_capsule(datagram), end_stream=False
-            )
-        else:
-            self.connection.send_datagram(self.stream_id, datagram)
+    def send_to_client(self, packet: bytes) -> None:
+        self.tunnel.send_datagram(packet)
         self.transmit()
-    
+
     def http_event_received(self, event: H3Event) -> None:
-        if isinstance(event, DataReceived):
-            # Parse capsules from stream data
-            for capsule in self._capsule_buffer.read_capsule_data(event.data):
-                if isinstance(capsule, DatagramCapsule):
-                    self._process_datagram(capsule.data)
-        elif isinstance(event, DatagramReceived):
-            # Process datagram directly
-            self._process_datagram(event.data)
-    
-    def _process_datagram(self, data: bytes) -> None:
-        # Extract payload from MASQUE datagram
-        if len(data) > 0:
-            ctx_size = 1 << ((data[0] & 0xc0) >> 6)
-            if len(data) > ctx_size:
-                context_id = int.from_bytes(data[:ctx_size]) & 0x3f
-                if context_id == 0:  # UDP_PAYLOAD
-                    payload = data[ctx_size:]
-                    self.send_to_target(payload)
-    
-    def close(self) -> None:
-        if self.transport:
-            self.transport.close()
+        if self._closed or not isinstance(event, (DataReceived, DatagramReceived)):
+            return
+        try:
+            masque_events = self.tunnel.handle_http_event(event)
+        except MasqueError:
+            self.connection.send_data(self.stream_id, b"", end_stream=True)
+            self.transmit()
+            self.close()
+            return
+        for masque_event in masque_events:
+            if isinstance(masque_event, ProxiedDatagramReceived):
+                self._process_packet(masque_event.datagram)
+            elif isinstance(masque_event, AddressRequested):
+                self._assign_addresses(masque_event.addresses)
+                self.transmit()
+
+    def _assign_addresses(self, requested: List[AssignedAddress]) -> None:
+        # ADDRESS_ASSIGN replaces the previous assignment, so it lists all
+        # the addresses, tagged with the request they answer if any
+        request_ids = {}
+        unavailable = []
+        for request in requested:
+            version = request.prefix.version
+            if version not in self.addresses:
+                address = self.tun.allocate(self, version)
+                if address is None:
+                    # RFC 9484 section 4.7.1: an unspecified address
+                    # rejects the request
+                    unavailable.append(
+                        AssignedAddress(
+                            request_id=request.request_id,
+                            prefix=ipaddress.ip_network(
+                                "0.0.0.0/32" if version == 4 else "::/128"
+                            ),
+                        )
+                    )
+                    continue
+                self.addresses[version] = address
+            request_ids[version] = request.request_id
+        self.tunnel.assign_addresses(
+            [
+                AssignedAddress(
+                    request_id=request_ids.get(version, 0),
+                    prefix=ipaddress.ip_network(address),
+                )
+                for version, address in sorted(self.addresses.items())
+            ]
+            + unavailable
+        )
 
+    def _process_packet(self, packet: bytes) -> None:
+        # only forward packets sent from an assigned address
+        addresses = packet_addresses(packet)
+        if addresses is None:
+            return
+        address = self.addresses.get(packet[0] >> 4)
+        if address is not None and addresses[0] == address.packed:
+            self.tun.write(packet)
 
-class MasqueDatagramProtocol(asyncio.DatagramProtocol):
-    def __init__(self, handler: MasqueHandler) -> None:
-        self.handler = handler
-    
-    def datagram_received(self, data: bytes, addr) -> None:
-        self.handler.send_to_client(data)
+    def close(self) -> None:
+        self._closed = True
+        for address in self.addresses.values():
+            self.tun.release(address)
+        self.addresses.clear()
 
 
-Handler = Union[HttpRequestHandler, WebSocketHandler, WebTransportHandler, MasqueHandler]
+Handler = Union[
+    HttpRequestHandler,
+    WebSocketHandler,
+    WebTransportHandler,
+    MasqueIpHandler,
+]
 
 
 class HttpServerProtocol(QuicConnectionProtocol):
-    def __init__(self, *args, enable_masque: bool = False, **kwargs) -> None:
+    def __init__(
+        self,
+        *args,
+        enable_masque: bool = False,
+        masque_flush_delay: Optional[float] = 0.0,
+        masque_resolver: Optional[Resolver] = None,
+        masque_tun: Optional[TunDevice] = None,
+        **kwargs,
+    ) -> None:
         super().__init__(*args, **kwargs)
         self._handlers: Dict[int, Handler] = {}
         self._http: Optional[HttpConnection] = None
         self._enable_masque = enable_masque
+        self._masque_flush_delay = masque_flush_delay
+        self._masque_resolver = masque_resolver
+        self._masque_tun = masque_tun
+        self._masque: Optional[MasqueProxy] = None
 
     def http_event_received(self, event: H3Event) -> None:
+        if self._masque is not None and self._masque.handle_http_event(event):
+            return
         if isinstance(event, HeadersReceived) and event.stream_id not in self._handlers:
             authority = None
             headers = []
@@ -500,36 +632,38 @@ class HttpServerProtocol(QuicConnectionProtocol):
                     stream_id=event.stream_id,
                     transmit=self.transmit,
                 )
-            elif method == "CONNECT" and protocol == "connect-udp" and self._enable_masque:
+            elif method == "CONNECT" and protocol == "connect-ip" and self._enable_masque:
                 assert isinstance(self._http, H3Connection), (
                     "MASQUE is only supported over HTTP/3"
                 )
-                # Accept path: /.well-known/masque/udp/{host}/{port}/
-                path_parts = path.strip('/').split('/')
-                if len(path_parts) == 5 and path_parts[:3] == ['.well-known', 'masque', 'udp'] and path_parts[4].isdigit():
-                    target_host = path_parts[3]
-                    target_port = int(path_parts[4])
-                    handler = MasqueHandler(
+                # Accept path: /.well-known/masque/ip/{target}/{ipproto}/
+                path_parts = path.strip("/").split("/")
+                if len(path_parts) != 5 or path_parts[:3] != [
+                    ".well-known",
+                    "masque",
+                    "ip",
+                ]:
+                    status = b"400"
+                elif self._masque_tun is None or not self._masque_tun.available:
+                    status = b"503"
+                else:
+                    handler = MasqueIpHandler(
                         connection=self._http,
                         stream_id=event.stream_id,
-                        target_host=target_host,
-                        target_port=target_port,
                         transmit=self.transmit,
+                        tun=self._masque_tun,
                     )
                     self._handlers[event.stream_id] = handler
-                    asyncio.ensure_future(handler.start())
-                    return
-                else:
-                    self._quic._logger.debug(f"Invalid path: {path}")
-                    # Invalid MASQUE path, send 400
-                    self._http.send_headers(
-                        stream_id=event.stream_id,
-                        headers=[(b":status", b"400")],
-                        end_stream=True,
-                    )
-                    self.transmit()
+                    handler.start()
                     return
-            
+                self._http.send_headers(
+                    stream_id=event.stream_id,
+                    headers=[(b":status", status)],
+                    end_stream=True,
+                )
+                self.transmit()
+                return
+
             elif method == "CONNECT" and protocol == "webtransport":
                 assert isinstance(self._http, H3Connection), (
                     "WebTransport is only supported over HTTP/3"
@@ -578,7 +712,7 @@ class HttpServerProtocol(QuicConnectionProtocol):
                     stream_id=event.stream_id,
                     transmit=self.transmit,
                 )
-            if not isinstance(handler, MasqueHandler):
+            if not isinstance(handler, MasqueIpHandler):
                 self._handlers[event.stream_id] = handler
                 asyncio.ensure_future(handler.run_asgi(application))
         elif (
@@ -587,6 +721,12 @@ class HttpServerProtocol(QuicConnectionProtocol):
         ):
             handler = self._handlers[event.stream_id]
             handler.http_event_received(event)
+            if (
+                isinstance(handler, MasqueIpHandler)
+                and isinstance(event, DataReceived)
+                and event.stream_ended
+            ):
+                self._close_ip_handler(event.stream_id)
         elif isinstance(event, DatagramReceived):
             if event.stream_id in self._handlers:
                 handler = self._handlers[event.stream_id]
@@ -603,17 +743,37 @@ class HttpServerProtocol(QuicConnectionProtocol):
                     enable_webtransport=True, 
                     enable_masque=self._enable_masque
                 )
+                if self._enable_masque:
+                    self._masque = MasqueProxy(
+                        self._http,
+                        self.transmit,
+                        flush_delay=self._masque_flush_delay,
+                        resolver=self._masque_resolver,
+                    )
             elif event.alpn_protocol in H0_ALPN:
                 self._http = H0Connection(self._quic)
         elif isinstance(event, DatagramFrameReceived):
             if event.data == b"quack":
                 self._quic.send_datagram_frame(b"quack-ack")
+        elif isinstance(event, ConnectionTerminated):
+            if self._masque is not None:
+                self._masque.close()
+            for stream_id in list(self._handlers):
+                self._close_ip_handler(stream_id)
+        elif isinstance(event, StreamReset):
+            self._close_ip_handler(event.stream_id)
 
         #  pass event to the HTTP layer
         if self._http is not None:
             for http_event in self._http.handle_event(event):
                 self.http_event_received(http_event)
 
+    def _close_ip_handler(self, stream_id: int) -> None:
+        handler = self._handlers.get(stream_id)
+        if isinstance(handler, MasqueIpHandler):
+            del self._handlers[stream_id]
+            handler.close()
+
 
 class SessionTicketStore:
     """
@@ -637,9 +797,30 @@ async def main(
     session_ticket_store: SessionTicketStore,
     retry: bool,
     enable_masque: bool = False,
+    masque_flush_delay: Optional[float] = 0.0,
+    router: Optional[QuicWorkerRouter] = None,
 ) -> None:
+    # all connections share the cache of target addresses
+    masque_resolver = CachingResolver()
+
+    # each worker owns a TUN device stand-in for CONNECT-IP, with its own
+    # ranges of addresses
+    masque_tun: Optional[TunDevice] = None
+    if enable_masque:
+        worker_index = router.index if router is not None else 0
+        masque_tun = TunDevice(
+            networks=("10.89.%d.0/24" % worker_index, "fd89:0:0:%x::/120" % worker_index)
+        )
+
     def create_protocol(*args, **kwargs):
-        return HttpServerProtocol(*args, enable_masque=enable_masque, **kwargs)
+        return HttpServerProtocol(
+            *args,
+            enable_masque=enable_masque,
+            masque_flush_delay=masque_flush_delay,
+            masque_resolver=masque_resolver,
+            masque_tun=masque_tun,
+            **kwargs,
+        )
     
     await serve(
         host,
@@ -649,10 +830,19 @@ async def main(
         session_ticket_fetcher=session_ticket_store.pop,
         session_ticket_handler=session_ticket_store.add,
         retry=retry,
+        router=router,
     )
     await asyncio.Future()
 
 
+def run_worker(index: int, workers: int, socket_dir: str, **kwargs) -> None:
+    router = QuicWorkerRouter(index=index, workers=workers, socket_dir=socket_dir)
+    try:
+        asyncio.run(main(router=router, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == "__main__":
     defaults = QuicConfiguration(is_client=False)
 
@@ -724,6 +914,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "--enable-masque", action="store_true", help="enable MASQUE proxy support"
     )
+    parser.add_argument(
+        "--masque-flush-delay",
+        type=float,
+        default=0.0,
+        help="microseconds to wait for more proxied datagrams before transmitting, "
+        "or a negative value to transmit every datagram immediately",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes sharing the listening address",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -764,16 +967,40 @@ if __name__ == "__main__":
     if uvloop is not None:
         uvloop.install()
 
-    try:
-        asyncio.run(
-            main(
-                host=args.host,
-                port=args.port,
-                configuration=configuration,
-                session_ticket_store=SessionTicketStore(),
-                retry=args.retry,
-                enable_masque=args.enable_masque,
+    main_kwargs = dict(
+        host=args.host,
+        port=args.port,
+        configuration=configuration,
+        session_ticket_store=SessionTicketStore(),
+        retry=args.retry,
+        enable_masque=args.enable_masque,
+        masque_flush_delay=(
+            args.masque_flush_delay / 1e6 if args.masque_flush_delay >= 0 else None
+        ),
+    )
+
+    if args.workers > 1:
+        # each worker binds the address with SO_REUSEPORT and forwards
+        # datagrams for connections owned by another worker
+        socket_dir = tempfile.mkdtemp()
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(index, args.workers, socket_dir),
+                kwargs=main_kwargs,
             )
-        )
-    except KeyboardInterrupt:
-        pass
+            for index in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            asyncio.run(main(**main_kwargs))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,117 @@
+"""
+Micro-benchmark for the MASQUE capsule decoder.
+
+Compares :class:`aioquic.masque.capsule.CapsuleBuffer` against the previous
+fixed-buffer implementation, feeding the same stream of DATAGRAM capsules
+split into chunks of various sizes.
+"""
+
+import argparse
+import time
+from typing import Callable, List
+
+from aioquic._buffer import BufferWriteError
+from aioquic.buffer import Buffer, BufferReadError
+from aioquic.masque.capsule import (
+    MAX_CAPSULE_SIZE,
+    Capsule,
+    CapsuleBuffer,
+    CapsuleType,
+    DatagramCapsule,
+    encode_datagram_capsule,
+)
+
+SPLIT_SIZES = [1, 16, 256, 1200, 4096, 16384, 65536]
+
+
+class LegacyCapsuleBuffer:
+    """
+    The fixed 64 KiB buffer implementation, kept for comparison.
+    """
+
+    def __init__(self) -> None:
+        self._buf = Buffer(capacity=MAX_CAPSULE_SIZE)
+        self._start = 0
+
+    def read_capsule_data(self, data: bytes) -> List[Capsule]:
+        try:
+            self._buf.push_bytes(data)
+        except BufferWriteError:
+            self._buf.seek(self._start)
+            return []
+
+        end = self._buf.tell()
+        self._buf.seek(self._start)
+        capsules: List[Capsule] = []
+        while self._buf.tell() < end:
+            try:
+                type = self._buf.pull_uint_var()
+                length = self._buf.pull_uint_var()
+                if self._buf.tell() + length > end:
+                    self._buf.seek(end)
+                    return capsules
+                capsule_data = self._buf.pull_bytes(length)
+                if type == CapsuleType.DATAGRAM:
+                    capsules.append(DatagramCapsule(data=capsule_data))
+                else:
+                    capsules.append(Capsule())
+                self._start = self._buf.tell()
+            except BufferReadError:
+                return capsules
+        self._start = 0
+        self._buf.seek(self._start)
+        return capsules
+
+
+def run(factory: Callable, chunks: List[bytes]) -> int:
+    parser = factory()
+    count = 0
+    for chunk in chunks:
+        count += len(parser.read_capsule_data(chunk))
+    return count
+
+
+def main(payload_size: int, total_size: int) -> None:
+    capsule = encode_datagram_capsule(b"\x00" + b"x" * payload_size)
+    stream = capsule * (total_size // len(capsule))
+    expected = len(stream) // len(capsule)
+
+    print(
+        "%8s %14s %14s %14s %14s"
+        % ("split", "legacy MB/s", "legacy ok", "new MB/s", "speedup")
+    )
+    for split in SPLIT_SIZES:
+        chunks = [stream[i : i + split] for i in range(0, len(stream), split)]
+        results = []
+        for factory in (LegacyCapsuleBuffer, CapsuleBuffer):
+            start = time.perf_counter()
+            count = run(factory, chunks)
+            elapsed = time.perf_counter() - start
+            results.append((len(stream) / elapsed / 1e6, count))
+        (legacy_rate, legacy_count), (new_rate, new_count) = results
+        assert new_count == expected, "new implementation lost capsules"
+        print(
+            "%8d %14.1f %14s %14.1f %13.1fx"
+            % (
+                split,
+                legacy_rate,
+                "%d/%d" % (legacy_count, expected),
+                new_rate,
+                new_rate / legacy_rate,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capsule decoder benchmark")
+    parser.add_argument(
+        "--payload-size", type=int, default=1200, help="datagram payload size"
+    )
+    parser.add_argument(
+        "--total-size",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="total number of bytes to parse per run",
+    )
+    args = parser.parse_args()
+    main(payload_size=args.payload_size, total_size=args.total_size)
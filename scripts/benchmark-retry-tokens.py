@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for the retry token handler.
+
+Compares :class:`aioquic.quic.retry.QuicRetryTokenHandler` against the
+previous RSA-OAEP implementation, creating and validating the tokens a
+server handles for each connection attempt when retry is enabled.
+"""
+
+import argparse
+import time
+from typing import Callable, Tuple
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from aioquic.buffer import Buffer
+from aioquic.quic.connection import NetworkAddress
+from aioquic.quic.retry import QuicRetryTokenHandler, encode_address
+from aioquic.tls import pull_opaque, push_opaque
+
+ADDR = ("192.0.2.1", 4433)
+ORIGINAL_DESTINATION_CID = b"\x08\x07\x06\x05\x04\x03\x02\x01"
+RETRY_SOURCE_CID = b"abcdefgh"
+
+
+class LegacyRetryTokenHandler:
+    """
+    The RSA-OAEP implementation, kept for comparison.
+    """
+
+    def __init__(self) -> None:
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._padding = padding.OAEP(
+            mgf=padding.MGF1(hashes.SHA256()), algorithm=hashes.SHA256(), label=None
+        )
+
+    def create_token(
+        self,
+        addr: NetworkAddress,
+        original_destination_connection_id: bytes,
+        retry_source_connection_id: bytes,
+    ) -> bytes:
+        buf = Buffer(capacity=512)
+        push_opaque(buf, 1, encode_address(addr))
+        push_opaque(buf, 1, original_destination_connection_id)
+        push_opaque(buf, 1, retry_source_connection_id)
+        return self._key.public_key().encrypt(buf.data, self._padding)
+
+    def validate_token(self, addr: NetworkAddress, token: bytes) -> Tuple[bytes, bytes]:
+        buf = Buffer(data=self._key.decrypt(token, self._padding))
+        encoded_addr = pull_opaque(buf, 1)
+        original_destination_connection_id = pull_opaque(buf, 1)
+        retry_source_connection_id = pull_opaque(buf, 1)
+        if encoded_addr != encode_address(addr):
+            raise ValueError("Remote address does not match.")
+        return original_destination_connection_id, retry_source_connection_id
+
+
+def run(handler, count: int) -> Tuple[float, float]:
+    start = time.perf_counter()
+    tokens = [
+        handler.create_token(ADDR, ORIGINAL_DESTINATION_CID, RETRY_SOURCE_CID)
+        for i in range(count)
+    ]
+    created = time.perf_counter()
+    for token in tokens:
+        handler.validate_token(ADDR, token)
+    validated = time.perf_counter()
+    return count / (created - start), count / (validated - created)
+
+
+def main(count: int) -> None:
+    factories: Tuple[Tuple[str, Callable], ...] = (
+        ("legacy", LegacyRetryTokenHandler),
+        ("aead", QuicRetryTokenHandler),
+    )
+    print("%8s %16s %16s" % ("handler", "create/s", "validate/s"))
+    for name, factory in factories:
+        create_rate, validate_rate = run(factory(), count)
+        print("%8s %16.0f %16.0f" % (name, create_rate, validate_rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retry token benchmark")
+    parser.add_argument(
+        "--count", type=int, default=2000, help="number of tokens per handler"
+    )
+    args = parser.parse_args()
+    main(count=args.count)
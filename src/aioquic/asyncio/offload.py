@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import socket
+import struct
+import sys
+from typing import Callable, List, Optional, Tuple
+
+from ..quic.connection import NetworkAddress
+
+logger = logging.getLogger("quic")
+
+# Linux socket options, see udp(7)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+
+# the kernel accepts at most 64 segments per send
+MAX_SEGMENTS = 64
+MAX_SEND_SIZE = 65507
+
+# how many coalesced buffers are read per event loop iteration
+RECV_BATCH_SIZE = 16
+RECV_BUFFER_SIZE = 65535
+
+DatagramsHandler = Callable[[List[bytes], NetworkAddress], None]
+
+
+class UdpOffload:
+    """
+    Linux UDP segmentation offload for a datagram transport.
+
+    With generic segmentation offload (GSO), consecutive datagrams of the
+    same size for the same address are sent in a single `sendmsg` call, the
+    kernel splitting them into individual datagrams. With generic receive
+    offload (GRO), the kernel coalesces datagrams from the same flow, which
+    are read directly from the socket and split before being handed to
+    `datagrams_received`.
+
+    Use :meth:`create` which returns `None` if offloads are not available.
+
+    :param transport: The datagram transport whose socket should be used.
+    :param sock: A duplicate of the transport's socket.
+    :param datagrams_received: A callable invoked with the list of datagrams
+                               received from an address, or `None` to keep
+                               receiving through the transport.
+    """
+
+    def __init__(
+        self,
+        transport: asyncio.DatagramTransport,
+        sock: socket.socket,
+        datagrams_received: Optional[DatagramsHandler],
+    ) -> None:
+        self._datagrams_received = datagrams_received
+        self._gso = True
+        self._loop = asyncio.get_running_loop()
+        self._recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+        self._sock = sock
+        self._transport = transport
+
+        if datagrams_received is not None:
+            sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+            transport.pause_reading()
+            self._loop.add_reader(sock.fileno(), self._read)
+
+    @classmethod
+    def create(
+        cls,
+        transport: asyncio.DatagramTransport,
+        datagrams_received: Optional[DatagramsHandler] = None,
+    ) -> Optional["UdpOffload"]:
+        """
+        Enable offloads on the transport's socket if the platform supports them.
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        transport_sock = transport.get_extra_info("socket")
+        if transport_sock is None:
+            return None
+
+        sock = socket.socket(fileno=os.dup(transport_sock.fileno()))
+        try:
+            sock.setblocking(False)
+            sock.getsockopt(socket.SOL_UDP, UDP_SEGMENT)
+            return cls(transport, sock, datagrams_received)
+        except (AttributeError, NotImplementedError, OSError) as exc:
+            logger.debug("UDP offloads are not available: %s", exc)
+            sock.close()
+            return None
+
+    def close(self) -> None:
+        """
+        Stop reading from the socket and close the duplicate socket.
+        """
+        if self._datagrams_received is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._datagrams_received = None
+        self._sock.close()
+
+    def send(self, datagrams: List[Tuple[bytes, NetworkAddress]]) -> None:
+        """
+        Send datagrams, batching runs of same-size datagrams for an address.
+        """
+        transport = self._transport
+        count = len(datagrams)
+        i = 0
+        while i < count:
+            data, addr = datagrams[i]
+            size = len(data)
+
+            # collect datagrams of the same size for the same address, the
+            # last segment may be shorter
+            j = i + 1
+            total = size
+            while (
+                j < count
+                and j - i < MAX_SEGMENTS
+                and datagrams[j][1] == addr
+                and len(datagrams[j][0]) <= size
+                and total + len(datagrams[j][0]) <= MAX_SEND_SIZE
+            ):
+                total += len(datagrams[j][0])
+                j += 1
+                if len(datagrams[j - 1][0]) < size:
+                    break
+
+            if j - i == 1 or not self._gso or transport.get_write_buffer_size():
+                # keep ordering with datagrams buffered by the transport
+                for k in range(i, j):
+                    transport.sendto(*datagrams[k])
+            else:
+                try:
+                    self._sock.sendmsg(
+                        [datagrams[k][0] for k in range(i, j)],
+                        [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))],
+                        0,
+                        addr,
+                    )
+                except OSError as exc:
+                    # the transport buffers the datagrams if the socket
+                    # would block, and reports other errors
+                    if not isinstance(exc, BlockingIOError):
+                        logger.debug("Disabling UDP GSO: %s", exc)
+                        self._gso = False
+                    for k in range(i, j):
+                        transport.sendto(*datagrams[k])
+            i = j
+
+    def _read(self) -> None:
+        buf = self._recv_buffer
+        for _ in range(RECV_BATCH_SIZE):
+            try:
+                size, ancdata, _, addr = self._sock.recvmsg_into(
+                    [buf], socket.CMSG_SPACE(4)
+                )
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                logger.debug("UDP socket error: %s", exc)
+                return
+            if not size:
+                continue
+
+            segment_size = size
+            for level, kind, value in ancdata:
+                if level == socket.SOL_UDP and kind == UDP_GRO:
+                    segment_size = struct.unpack("=i", value[:4])[0]
+            self._datagrams_received(
+                [
+                    bytes(buf[start : min(start + segment_size, size)])
+                    for start in range(0, size, segment_size)
+                ],
+                addr,
+            )
+            if self._datagrams_received is None:
+                return
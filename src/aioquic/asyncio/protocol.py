@@ -1,9 +1,10 @@
 import asyncio
-from typing import Any, Callable, Dict, Optional, Text, Tuple, Union, cast
+from typing import Any, Callable, Dict, List, Optional, Text, Tuple, Union, cast
 
 from ..quic import events
 from ..quic.connection import NetworkAddress, QuicConnection
 from ..quic.packet import QuicErrorCode
+from .offload import UdpOffload
 
 QuicConnectionIdHandler = Callable[[bytes], None]
 QuicStreamHandler = Callable[[asyncio.StreamReader, asyncio.StreamWriter], None]
@@ -19,6 +20,7 @@ class QuicConnectionProtocol(asyncio.DatagramProtocol):
         self._connected = False
         self._connected_waiter: Optional[asyncio.Future[None]] = None
         self._loop = loop
+        self._offload: Optional[UdpOffload] = None
         self._ping_waiters: Dict[int, asyncio.Future[None]] = {}
         self._quic = quic
         self._stream_readers: Dict[int, asyncio.StreamReader] = {}
@@ -31,11 +33,34 @@ class QuicConnectionProtocol(asyncio.DatagramProtocol):
         self._connection_id_issued_handler: QuicConnectionIdHandler = lambda c: None
         self._connection_id_retired_handler: QuicConnectionIdHandler = lambda c: None
         self._connection_terminated_handler: Callable[[], None] = lambda: None
+        self._handshake_completed_handler: Callable[[], None] = lambda: None
         if stream_handler is not None:
             self._stream_handler = stream_handler
         else:
             self._stream_handler = lambda r, w: None
 
+    @property
+    def congestion_window(self) -> int:
+        """
+        The congestion window of the connection, in bytes.
+        """
+        return self._quic.congestion_window
+
+    @property
+    def is_closed(self) -> bool:
+        """
+        Whether the connection is closed.
+        """
+        return self._closed.is_set()
+
+    @property
+    def smoothed_rtt(self) -> float:
+        """
+        The smoothed round-trip time of the connection in seconds, or the
+        initial RTT if it was not measured yet.
+        """
+        return self._quic.smoothed_rtt
+
     def change_connection_id(self) -> None:
         """
         Change the connection ID used to communicate with the peer.
@@ -118,8 +143,12 @@ class QuicConnectionProtocol(asyncio.DatagramProtocol):
         self._transmit_task = None
 
         # send datagrams
-        for data, addr in self._quic.datagrams_to_send(now=self._loop.time()):
-            self._transport.sendto(data, addr)
+        datagrams = self._quic.datagrams_to_send(now=self._loop.time())
+        if self._offload is not None and len(datagrams) > 1:
+            self._offload.send(datagrams)
+        else:
+            for data, addr in datagrams:
+                self._transport.sendto(data, addr)
 
         # re-arm timer
         timer_at = self._quic.get_timer()
@@ -190,6 +219,13 @@ class QuicConnectionProtocol(asyncio.DatagramProtocol):
         self._stream_readers[stream_id] = reader
         return reader, writer
 
+    def _datagrams_received(self, datagrams: List[bytes], addr: NetworkAddress) -> None:
+        now = self._loop.time()
+        for data in datagrams:
+            self._quic.receive_datagram(data, addr, now=now)
+        self._process_events()
+        self.transmit()
+
     def _handle_timer(self) -> None:
         now = max(self._timer_at, self._loop.time())
         self._timer = None
@@ -221,9 +257,10 @@ class QuicConnectionProtocol(asyncio.DatagramProtocol):
 
                 self._closed.set()
             elif isinstance(event, events.HandshakeCompleted):
+                self._connected = True
+                self._handshake_completed_handler()
                 if self._connected_waiter is not None:
                     waiter = self._connected_waiter
-                    self._connected = True
                     self._connected_waiter = None
                     waiter.set_result(None)
             elif isinstance(event, events.PingAcknowledged):
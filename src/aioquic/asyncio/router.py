@@ -0,0 +1,162 @@
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import struct
+from typing import TYPE_CHECKING, Optional, Text, Tuple, Union, cast
+
+from ..quic.connection import NetworkAddress
+from ..quic.connection_id import ConnectionIdGenerator
+
+if TYPE_CHECKING:
+    from .server import QuicServer
+
+logger = logging.getLogger("quic")
+
+# the first byte of connection IDs carries the worker index
+MAX_WORKERS = 256
+
+
+def decode_address(data: bytes) -> Tuple[NetworkAddress, int]:
+    """
+    Decode a peer address prepended to a forwarded datagram, returning the
+    address and the offset of the datagram.
+    """
+    if data[0] == 4:
+        host = socket.inet_ntop(socket.AF_INET, data[1:5])
+        (port,) = struct.unpack_from("!H", data, 5)
+        return (host, port), 7
+    elif data[0] == 6:
+        host = socket.inet_ntop(socket.AF_INET6, data[1:17])
+        port, flowinfo, scope_id = struct.unpack_from("!HII", data, 17)
+        return (host, port, flowinfo, scope_id), 27
+    else:
+        raise ValueError("Unsupported address family %d" % data[0])
+
+
+def encode_address(addr: NetworkAddress) -> bytes:
+    """
+    Encode a peer address to be prepended to a forwarded datagram.
+    """
+    ip = ipaddress.ip_address(addr[0])
+    if ip.version == 4:
+        return b"\x04" + ip.packed + struct.pack("!H", addr[1])
+    else:
+        flowinfo, scope_id = addr[2:4] if len(addr) >= 4 else (0, 0)
+        return b"\x06" + ip.packed + struct.pack("!HII", addr[1], flowinfo, scope_id)
+
+
+class QuicWorkerRouter(ConnectionIdGenerator, asyncio.DatagramProtocol):
+    """
+    Route datagrams between the workers of a sharded server.
+
+    Each worker process binds the same UDP address with ``SO_REUSEPORT``
+    and the kernel spreads incoming datagrams across them based on the
+    peer's address. The connection IDs issued by a worker start with its
+    index, so a datagram which reaches the wrong worker, for instance after
+    a NAT rebinding, is forwarded to the owning worker over a Unix datagram
+    socket. The owning worker replies through its own UDP socket, which
+    shares the server's address.
+
+    The router is the :class:`~aioquic.quic.connection_id.ConnectionIdGenerator`
+    of the worker's connections.
+
+    :param index: The index of this worker, starting at 0.
+    :param workers: The total number of workers.
+    :param socket_dir: A directory in which each worker binds its
+                       ``worker-<index>.sock`` socket.
+    """
+
+    def __init__(self, *, index: int, workers: int, socket_dir: str) -> None:
+        assert 0 < workers <= MAX_WORKERS, "Unsupported number of workers"
+        assert 0 <= index < workers, "Worker index is out of range"
+
+        self.index = index
+        self.workers = workers
+        self.datagrams_forwarded = 0
+        self.datagrams_received = 0
+
+        self._server: Optional["QuicServer"] = None
+        self._socket_dir = socket_dir
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    def close(self) -> None:
+        """
+        Stop receiving forwarded datagrams.
+        """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+            try:
+                os.unlink(self.socket_path(self.index))
+            except OSError:
+                pass
+
+    def forward(self, cid: bytes, data: bytes, addr: NetworkAddress) -> bool:
+        """
+        Forward a datagram to the worker which issued the connection ID `cid`.
+
+        Returns `False` if the datagram belongs to this worker.
+        """
+        worker = self.worker_for_cid(cid)
+        if worker is None or worker == self.index or self._transport is None:
+            return False
+        self._transport.sendto(encode_address(addr) + data, self.socket_path(worker))
+        self.datagrams_forwarded += 1
+        return True
+
+    def generate(self, length: int) -> bytes:
+        """
+        Return a new connection ID which routes to this worker.
+        """
+        return bytes([self.index]) + os.urandom(length - 1)
+
+    def socket_path(self, index: int) -> str:
+        """
+        Return the path of the Unix socket for the worker with the given index.
+        """
+        return os.path.join(self._socket_dir, "worker-%d.sock" % index)
+
+    async def start(self, server: "QuicServer") -> None:
+        """
+        Start receiving datagrams forwarded by other workers.
+        """
+        path = self.socket_path(self.index)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self._server = server
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=path, family=socket.AF_UNIX
+        )
+
+    def worker_for_cid(self, cid: bytes) -> Optional[int]:
+        """
+        Return the index of the worker which issued the connection ID `cid`.
+        """
+        if cid and cid[0] < self.workers:
+            return cid[0]
+        return None
+
+    # asyncio.DatagramProtocol
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self._transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: Union[bytes, Text], addr: NetworkAddress) -> None:
+        data = cast(bytes, data)
+        try:
+            peer_addr, offset = decode_address(data)
+        except (IndexError, struct.error, ValueError):
+            return
+
+        self.datagrams_received += 1
+        if self._server is not None:
+            self._server.datagram_received(data[offset:], peer_addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # the target worker may have exited
+        logger.debug("Could not forward datagram: %s", exc)
@@ -1,23 +1,41 @@
 import asyncio
-import os
+from dataclasses import replace
 from functools import partial
-from typing import Callable, Dict, Optional, Text, Union, cast
+from typing import Callable, Dict, List, Optional, Set, Text, Union, cast
 
 from ..buffer import Buffer
 from ..quic.configuration import SMALLEST_MAX_DATAGRAM_SIZE, QuicConfiguration
 from ..quic.connection import NetworkAddress, QuicConnection
+from ..quic.connection_id import ConnectionIdGenerator, derive_stateless_reset_token
 from ..quic.packet import (
+    PACKET_LONG_HEADER,
+    STATELESS_RESET_MIN_SIZE,
     QuicPacketType,
     encode_quic_retry,
+    encode_quic_stateless_reset,
     encode_quic_version_negotiation,
     pull_quic_header,
 )
-from ..quic.retry import QuicRetryTokenHandler
+from ..quic.retry import QuicRetryTokenHandler, is_new_token
 from ..tls import SessionTicketFetcher, SessionTicketHandler
+from .offload import UdpOffload
 from .protocol import QuicConnectionProtocol, QuicStreamHandler
+from .router import QuicWorkerRouter
 
 __all__ = ["serve"]
 
+# stateless resets are one byte shorter than the packet which triggered them,
+# to prevent loops between endpoints, and at most this size
+STATELESS_RESET_MAX_SIZE = 42
+
+# how many stateless resets are sent per second at most
+STATELESS_RESET_MAX_RATE = 100
+
+# dictionaries do not shrink when entries are deleted, so the connection
+# table is copied once this many connection IDs were removed from it, and
+# more than it holds
+COMPACTION_THRESHOLD = 1024
+
 
 class QuicServer(asyncio.DatagramProtocol):
     def __init__(
@@ -27,31 +45,94 @@ class QuicServer(asyncio.DatagramProtocol):
         create_protocol: Callable = QuicConnectionProtocol,
         session_ticket_fetcher: Optional[SessionTicketFetcher] = None,
         session_ticket_handler: Optional[SessionTicketHandler] = None,
+        max_connections: Optional[int] = None,
+        max_handshakes: Optional[int] = None,
         retry: bool = False,
+        retry_threshold: Optional[int] = None,
+        retry_token_handler: Optional[QuicRetryTokenHandler] = None,
+        router: Optional[QuicWorkerRouter] = None,
         stream_handler: Optional[QuicStreamHandler] = None,
     ) -> None:
+        if router is not None:
+            if type(configuration.connection_id_generator) is not ConnectionIdGenerator:
+                raise ValueError(
+                    "A router cannot be combined with a custom connection ID generator"
+                )
+
+            # issue connection IDs which route to this worker
+            configuration = replace(configuration, connection_id_generator=router)
+
         self._configuration = configuration
+        self._connection_id_end = 1 + configuration.connection_id_length
+        self._connection_ids: Dict[QuicConnectionProtocol, Set[bytes]] = {}
+        self._connection_ids_removed = 0
         self._create_protocol = create_protocol
+        self._handshakes_pending = 0
         self._loop = asyncio.get_running_loop()
+        self._max_connections = max_connections
+        self._max_handshakes = max_handshakes
+        self._offload: Optional[UdpOffload] = None
         self._protocols: Dict[bytes, QuicConnectionProtocol] = {}
+        self._router = router
         self._session_ticket_fetcher = session_ticket_fetcher
         self._session_ticket_handler = session_ticket_handler
         self._transport: Optional[asyncio.DatagramTransport] = None
 
         self._stream_handler = stream_handler
 
-        if retry:
+        # admission control metrics
+        self.initials_accepted = 0
+        self.initials_dropped = 0
+        self.initials_retried = 0
+        self.stateless_resets_sent = 0
+
+        self._stateless_reset_count = 0
+        self._stateless_reset_window = 0.0
+
+        # a retry is required above `retry_threshold` pending handshakes,
+        # or always if no threshold is given
+        if retry_threshold is not None:
+            self._retry_threshold: Optional[int] = retry_threshold
+        elif retry or retry_token_handler is not None:
+            self._retry_threshold = 0
+        else:
+            self._retry_threshold = None
+
+        if retry_token_handler is not None:
+            self._retry = retry_token_handler
+        elif self._retry_threshold is not None:
             self._retry = QuicRetryTokenHandler()
         else:
             self._retry = None
 
+    @property
+    def connections(self) -> int:
+        """
+        The number of connections.
+        """
+        return len(self._connection_ids)
+
+    @property
+    def handshakes_pending(self) -> int:
+        """
+        The number of connections whose handshake is not complete yet.
+        """
+        return self._handshakes_pending
+
     def close(self) -> None:
         """
         Close any ongoing connections and stop listening.
         """
-        for protocol in set(self._protocols.values()):
+        for protocol in list(self._connection_ids):
             protocol.close()
+        self._connection_ids.clear()
+        self._handshakes_pending = 0
         self._protocols.clear()
+        if self._offload is not None:
+            self._offload.close()
+            self._offload = None
+        if self._router is not None:
+            self._router.close()
         self._transport.close()
 
     def connection_made(self, transport: asyncio.BaseTransport) -> None:
@@ -59,6 +140,15 @@ class QuicServer(asyncio.DatagramProtocol):
 
     def datagram_received(self, data: Union[bytes, Text], addr: NetworkAddress) -> None:
         data = cast(bytes, data)
+
+        # fast path for short header packets, whose destination connection ID
+        # is at a fixed offset
+        if data and not data[0] & PACKET_LONG_HEADER:
+            protocol = self._protocols.get(data[1 : self._connection_id_end])
+            if protocol is not None:
+                protocol.datagram_received(data, addr)
+                return
+
         buf = Buffer(data=data)
 
         try:
@@ -84,6 +174,26 @@ class QuicServer(asyncio.DatagramProtocol):
             return
 
         protocol = self._protocols.get(header.destination_cid, None)
+
+        # connection IDs issued by another worker, except for the client's
+        # initial choice which was not issued by any worker
+        if (
+            protocol is None
+            and self._router is not None
+            and (
+                header.packet_type != QuicPacketType.INITIAL
+                or (header.token and not is_new_token(header.token))
+            )
+            and self._router.forward(header.destination_cid, data, addr)
+        ):
+            return
+
+        # a short header packet for a connection we have no state for
+        if protocol is None and header.packet_type == QuicPacketType.ONE_RTT:
+            self._send_stateless_reset(header.destination_cid, len(data), addr)
+            return
+
+        address_validated = False
         original_destination_connection_id: Optional[bytes] = None
         retry_source_connection_id: Optional[bytes] = None
         if (
@@ -91,11 +201,55 @@ class QuicServer(asyncio.DatagramProtocol):
             and len(data) >= SMALLEST_MAX_DATAGRAM_SIZE
             and header.packet_type == QuicPacketType.INITIAL
         ):
+            # shed load before doing any cryptographic work
+            if (
+                self._max_connections is not None
+                and len(self._connection_ids) >= self._max_connections
+            ):
+                self.initials_dropped += 1
+                return
+            if self._max_handshakes is not None or self._retry_threshold:
+                handshakes_pending = self.handshakes_pending
+            else:
+                handshakes_pending = 0
+            if (
+                self._max_handshakes is not None
+                and handshakes_pending >= self._max_handshakes
+            ):
+                self.initials_dropped += 1
+                return
+
+            # a token from a NEW_TOKEN frame validates the address, otherwise
+            # proceed as if there was no token
+            if (
+                self._retry is not None
+                and header.token
+                and is_new_token(header.token)
+            ):
+                try:
+                    self._retry.validate_new_token(addr, header.token)
+                    address_validated = True
+                except ValueError:
+                    pass
+
             # retry
-            if self._retry is not None:
-                if not header.token:
+            if self._retry is not None and not address_validated:
+                if header.token and not is_new_token(header.token):
+                    # validate retry token
+                    try:
+                        (
+                            original_destination_connection_id,
+                            retry_source_connection_id,
+                        ) = self._retry.validate_token(addr, header.token)
+                    except ValueError:
+                        self.initials_dropped += 1
+                        return
+                    address_validated = True
+                elif handshakes_pending >= self._retry_threshold:
                     # create a retry token
-                    source_cid = os.urandom(8)
+                    source_cid = self._configuration.connection_id_generator.generate(
+                        self._configuration.connection_id_length
+                    )
                     self._transport.sendto(
                         encode_quic_retry(
                             version=header.version,
@@ -108,22 +262,17 @@ class QuicServer(asyncio.DatagramProtocol):
                         ),
                         addr,
                     )
+                    self.initials_retried += 1
                     return
                 else:
-                    # validate retry token
-                    try:
-                        (
-                            original_destination_connection_id,
-                            retry_source_connection_id,
-                        ) = self._retry.validate_token(addr, header.token)
-                    except ValueError:
-                        return
+                    original_destination_connection_id = header.destination_cid
             else:
                 original_destination_connection_id = header.destination_cid
 
             # create new connection
             connection = QuicConnection(
                 configuration=self._configuration,
+                address_validated=address_validated,
                 original_destination_connection_id=original_destination_connection_id,
                 retry_source_connection_id=retry_source_connection_id,
                 session_ticket_fetcher=self._session_ticket_fetcher,
@@ -133,6 +282,11 @@ class QuicServer(asyncio.DatagramProtocol):
                 connection, stream_handler=self._stream_handler
             )
             protocol.connection_made(self._transport)
+            protocol._offload = self._offload
+
+            # allow the client to skip the retry when it reconnects
+            if self._retry is not None:
+                connection.send_new_token(self._retry.create_new_token(addr))
 
             # register callbacks
             protocol._connection_id_issued_handler = partial(
@@ -144,26 +298,100 @@ class QuicServer(asyncio.DatagramProtocol):
             protocol._connection_terminated_handler = partial(
                 self._connection_terminated, protocol=protocol
             )
+            protocol._handshake_completed_handler = partial(
+                self._handshake_completed, protocol=protocol
+            )
 
+            self._connection_ids[protocol] = {
+                header.destination_cid,
+                connection.host_cid,
+            }
+            self._handshakes_pending += 1
             self._protocols[header.destination_cid] = protocol
             self._protocols[connection.host_cid] = protocol
+            self.initials_accepted += 1
 
         if protocol is not None:
             protocol.datagram_received(data, addr)
 
+    def _send_stateless_reset(
+        self, cid: bytes, size: int, addr: NetworkAddress
+    ) -> None:
+        key = self._configuration.stateless_reset_key
+        size = min(size - 1, STATELESS_RESET_MAX_SIZE)
+        if key is None or size < STATELESS_RESET_MIN_SIZE:
+            return
+
+        now = self._loop.time()
+        if now - self._stateless_reset_window >= 1.0:
+            self._stateless_reset_count = 0
+            self._stateless_reset_window = now
+        if self._stateless_reset_count >= STATELESS_RESET_MAX_RATE:
+            return
+        self._stateless_reset_count += 1
+
+        self._transport.sendto(
+            encode_quic_stateless_reset(
+                size=size,
+                stateless_reset_token=derive_stateless_reset_token(key, cid),
+            ),
+            addr,
+        )
+        self.stateless_resets_sent += 1
+
+    def _datagrams_received(self, datagrams: List[bytes], addr: NetworkAddress) -> None:
+        for data in datagrams:
+            self.datagram_received(data, addr)
+
+    def _compact(self) -> None:
+        """
+        Copy the connection table to release the memory of removed entries.
+        """
+        if (
+            self._connection_ids_removed >= COMPACTION_THRESHOLD
+            and self._connection_ids_removed > len(self._protocols)
+        ):
+            self._protocols = dict(self._protocols)
+            self._connection_ids_removed = 0
+
     def _connection_id_issued(self, cid: bytes, protocol: QuicConnectionProtocol):
+        connection_ids = self._connection_ids.get(protocol)
+        if connection_ids is None:
+            # the connection was already terminated
+            return
+        connection_ids.add(cid)
         self._protocols[cid] = protocol
 
     def _connection_id_retired(
         self, cid: bytes, protocol: QuicConnectionProtocol
     ) -> None:
+        connection_ids = self._connection_ids.get(protocol)
+        if connection_ids is None:
+            # the connection was already terminated
+            return
         assert self._protocols[cid] == protocol
         del self._protocols[cid]
+        connection_ids.discard(cid)
+        self._connection_ids_removed += 1
+        self._compact()
+
+    def _handshake_completed(self, protocol: QuicConnectionProtocol) -> None:
+        if protocol in self._connection_ids:
+            self._handshakes_pending -= 1
 
     def _connection_terminated(self, protocol: QuicConnectionProtocol):
-        for cid, proto in list(self._protocols.items()):
-            if proto == protocol:
+        connection_ids = self._connection_ids.pop(protocol, None)
+        if connection_ids is None:
+            # the server was closed
+            return
+        if not protocol._connected:
+            # the handshake will never complete
+            self._handshakes_pending -= 1
+        for cid in connection_ids:
+            if self._protocols.get(cid) is protocol:
                 del self._protocols[cid]
+                self._connection_ids_removed += 1
+        self._compact()
 
 
 async def serve(
@@ -174,8 +402,14 @@ async def serve(
     create_protocol: Callable = QuicConnectionProtocol,
     session_ticket_fetcher: Optional[SessionTicketFetcher] = None,
     session_ticket_handler: Optional[SessionTicketHandler] = None,
+    max_connections: Optional[int] = None,
+    max_handshakes: Optional[int] = None,
     retry: bool = False,
+    retry_threshold: Optional[int] = None,
+    retry_token_handler: Optional[QuicRetryTokenHandler] = None,
+    router: Optional[QuicWorkerRouter] = None,
     stream_handler: QuicStreamHandler = None,
+    udp_offload: bool = False,
 ) -> QuicServer:
     """
     Start a QUIC server at the given `host` and `port`.
@@ -195,24 +429,73 @@ async def serve(
     * ``session_ticket_handler`` is a callback which is invoked by the TLS
       engine when a new session ticket is issued. It should store the session
       ticket for future lookup.
+    * ``max_connections`` caps the number of connections. Initial packets which
+      would create more connections are dropped.
+    * ``max_handshakes`` caps the number of connections whose handshake is not
+      complete yet. Initial packets which would create more connections are
+      dropped before any cryptographic work is done.
     * ``retry`` specifies whether client addresses should be validated prior to
-      the cryptographic handshake using a retry packet.
+      the cryptographic handshake using a retry packet. Clients are also
+      sent a NEW_TOKEN frame, which lets them skip the retry the next time
+      they connect.
+    * ``retry_threshold`` only requires a retry once the number of pending
+      handshakes reaches the given value, so that addresses are validated
+      when the server is under load. It implies ``retry``.
+    * ``retry_token_handler`` is a
+      :class:`~aioquic.quic.retry.QuicRetryTokenHandler` used to create and
+      validate retry tokens, and implies ``retry``. Server processes whose
+      handlers share the same key validate each other's tokens.
+    * ``router`` is a :class:`~aioquic.asyncio.router.QuicWorkerRouter` which
+      makes this server one worker of a sharded server. The UDP socket is
+      bound with ``SO_REUSEPORT`` so that several processes can share the
+      address, and datagrams for connections owned by another worker are
+      forwarded to it. The router generates the connection IDs, so it cannot
+      be combined with a custom ``connection_id_generator`` in the
+      configuration.
     * ``stream_handler`` is a callback which is invoked whenever a stream is
       created. It must accept two arguments: a :class:`asyncio.StreamReader`
       and a :class:`asyncio.StreamWriter`.
+    * ``udp_offload`` enables UDP segmentation and receive offloads (GSO and
+      GRO) on Linux, reducing the number of system calls for bulk transfers.
+      It is ignored on other platforms.
+
+    If the configuration has a ``stateless_reset_key``, short header packets
+    for unknown connections are answered with a stateless reset, so that
+    clients of a restarted server do not wait for their idle timeout. At most
+    100 stateless resets are sent per second.
+
+    The returned server exposes admission control metrics: the number of
+    Initial packets which created a connection, triggered a retry or were
+    dropped are counted in ``initials_accepted``, ``initials_retried`` and
+    ``initials_dropped``, ``connections`` is the number of connections and
+    ``handshakes_pending`` the number of connections whose handshake is not
+    complete yet. Stateless resets are
+    counted in ``stateless_resets_sent``.
     """
 
     loop = asyncio.get_running_loop()
 
-    _, protocol = await loop.create_datagram_endpoint(
+    transport, protocol = await loop.create_datagram_endpoint(
         lambda: QuicServer(
             configuration=configuration,
             create_protocol=create_protocol,
             session_ticket_fetcher=session_ticket_fetcher,
             session_ticket_handler=session_ticket_handler,
+            max_connections=max_connections,
+            max_handshakes=max_handshakes,
             retry=retry,
+            retry_threshold=retry_threshold,
+            retry_token_handler=retry_token_handler,
+            router=router,
             stream_handler=stream_handler,
         ),
         local_addr=(host, port),
+        reuse_port=router is not None,
     )
+    if router is not None:
+        await router.start(protocol)
+    if udp_offload:
+        protocol._offload = UdpOffload.create(
+            transport, datagrams_received=protocol._datagrams_received
+        )
     return protocol
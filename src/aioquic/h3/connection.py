@@ -4,8 +4,15 @@ from enum import Enum, IntEnum
 from typing import Dict, FrozenSet, List, Optional, Set
 
 import pylsqpack
-from aioquic.buffer import UINT_VAR_MAX_SIZE, Buffer, BufferReadError, encode_uint_var
+from aioquic.buffer import (
+    UINT_VAR_MAX_SIZE,
+    Buffer,
+    BufferReadError,
+    encode_uint_var,
+    size_uint_var,
+)
 from aioquic.h3.events import (
+    DatagramDropped,
     DatagramReceived,
     DataReceived,
     H3Event,
@@ -16,7 +23,12 @@ from aioquic.h3.events import (
 )
 from aioquic.h3.exceptions import InvalidStreamTypeError, NoAvailablePushIDError
 from aioquic.quic.connection import QuicConnection, stream_is_unidirectional
-from aioquic.quic.events import DatagramFrameReceived, QuicEvent, StreamDataReceived
+from aioquic.quic.events import (
+    DatagramFrameDropped,
+    DatagramFrameReceived,
+    QuicEvent,
+    StreamDataReceived,
+)
 from aioquic.quic.logger import QuicLoggerTrace
 
 logger = logging.getLogger("http3")
@@ -450,6 +462,16 @@ class H3Connection:
                         )
                 elif isinstance(event, DatagramFrameReceived):
                     return self._receive_datagram(event.data)
+                elif (
+                    isinstance(event, DatagramFrameDropped)
+                    and event.flow_id is not None
+                ):
+                    return [
+                        DatagramDropped(
+                            data=event.data[size_uint_var(event.flow_id) :],
+                            stream_id=event.flow_id * 4,
+                        )
+                    ]
             except ProtocolError as exc:
                 self._is_done = True
                 self._quic.close(
@@ -458,7 +480,19 @@ class H3Connection:
 
         return []
 
-    def send_datagram(self, stream_id: int, data: bytes) -> None:
+    def max_datagram_size(self, stream_id: int) -> Optional[int]:
+        """
+        Return the largest HTTP/3 datagram payload which can be sent for the
+        specified stream, or `None` if it is not known yet.
+
+        :param stream_id: The stream ID.
+        """
+        max_size = self._quic.max_datagram_frame_data_size
+        if max_size is None:
+            return None
+        return max(0, max_size - size_uint_var(stream_id // 4))
+
+    def send_datagram(self, stream_id: int, data: bytes, prefix: bytes = b"") -> None:
         """
         Send a datagram for the specified stream.
 
@@ -469,6 +503,8 @@ class H3Connection:
 
         :param stream_id: The stream ID.
         :param data: The HTTP/3 datagram payload.
+        :param prefix: Bytes to send before `data` in the payload, such as a
+                       context ID, without copying `data`.
         """
 
         # check stream ID is valid
@@ -476,7 +512,12 @@ class H3Connection:
             raise InvalidStreamTypeError(
                 "Datagrams can only be sent for client-initiated bidirectional streams"
             )
-        self._quic.send_datagram_frame(encode_uint_var(stream_id // 4) + data)
+        quarter_stream_id = stream_id // 4
+        self._quic.send_datagram_frame(
+            data,
+            flow_id=quarter_stream_id,
+            prefix=encode_uint_var(quarter_stream_id) + prefix,
+        )
 
     def send_push_promise(self, stream_id: int, headers: Headers) -> int:
         """
@@ -592,6 +633,13 @@ class H3Connection:
             stream_id, encode_frame(FrameType.HEADERS, frame_data), end_stream
         )
 
+    @property
+    def datagrams_pending(self) -> int:
+        """
+        Return the number of datagrams queued on the QUIC connection.
+        """
+        return self._quic.datagrams_pending
+
     @property
     def received_settings(self) -> Optional[Dict[int, int]]:
         """
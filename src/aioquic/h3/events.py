@@ -30,6 +30,20 @@ class DataReceived(H3Event):
     "The Push ID or `None` if this is not a push."
 
 
+@dataclass
+class DatagramDropped(H3Event):
+    """
+    The DatagramDropped event is fired when a datagram sent for a stream was
+    dropped from the send queue without being sent.
+    """
+
+    data: bytes
+    "The HTTP/3 datagram payload which was dropped."
+
+    stream_id: int
+    "The ID of the stream the datagram was sent for."
+
+
 @dataclass
 class DatagramReceived(H3Event):
     """
@@ -1,28 +1,83 @@
-from aioquic._buffer import BufferWriteError
-from aioquic.buffer import Buffer, BufferReadError, UINT_VAR_MAX_SIZE
-from dataclasses import dataclass
+import ipaddress
+from aioquic.buffer import Buffer, BufferReadError, UINT_VAR_MAX_SIZE, size_uint_var
+from collections import deque
+from dataclasses import dataclass, field
 from enum import IntEnum
-from typing import List, Optional, Tuple
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+from .exceptions import MasqueError
 
 
 MAX_CAPSULE_SIZE = 0xFFFF
 
+IpAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+IpPrefix = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class CapsuleType(IntEnum):
+    DATAGRAM = 0x00
+    ADDRESS_ASSIGN = 0x01
+    ADDRESS_REQUEST = 0x02
+    ROUTE_ADVERTISEMENT = 0x03
+    CLOSE_WEBTRANSPORT_SESSION = 0x2843
+    DRAIN_WEBTRANSPORT_SESSION = 0x78AE
+
 class Capsule:
     """
     Base class for capsules
+
+    Subclasses set `capsule_type` so that decoded capsules can be
+    dispatched to the handler registered for their type.
     """
+    capsule_type: int
 
 @dataclass
 class DatagramCapsule(Capsule):
-    data: bytes
+    data: Union[bytes, memoryview]
+    capsule_type = CapsuleType.DATAGRAM
 
+@dataclass
+class AssignedAddress:
+    request_id: int
+    prefix: IpPrefix
 
-class CapsuleType(IntEnum):
-    DATAGRAM = 0x00
+@dataclass
+class IpAddressRange:
+    start: IpAddress
+    end: IpAddress
+    ip_protocol: int = 0
+
+@dataclass
+class AddressAssignCapsule(Capsule):
+    addresses: List[AssignedAddress] = field(default_factory=list)
+    capsule_type = CapsuleType.ADDRESS_ASSIGN
+
+@dataclass
+class AddressRequestCapsule(Capsule):
+    addresses: List[AssignedAddress] = field(default_factory=list)
+    capsule_type = CapsuleType.ADDRESS_REQUEST
+
+@dataclass
+class RouteAdvertisementCapsule(Capsule):
+    ranges: List[IpAddressRange] = field(default_factory=list)
+    capsule_type = CapsuleType.ROUTE_ADVERTISEMENT
+
+@dataclass
+class CloseWebTransportSessionCapsule(Capsule):
+    error_code: int = 0
+    reason: str = ""
+    capsule_type = CapsuleType.CLOSE_WEBTRANSPORT_SESSION
 
-def _encode_capsule(capsule_type: CapsuleType, payload: bytes) -> bytes:
+@dataclass
+class DrainWebTransportSessionCapsule(Capsule):
+    capsule_type = CapsuleType.DRAIN_WEBTRANSPORT_SESSION
+
+
+CapsuleDecoder = Callable[[memoryview], Capsule]
+
+def _encode_capsule(capsule_type: int, payload: bytes) -> bytes:
     buf = Buffer(capacity=UINT_VAR_MAX_SIZE * 2 + len(payload))
-    buf.push_uint_var(capsule_type.value)
+    buf.push_uint_var(capsule_type)
     buf.push_uint_var(len(payload))
     buf.push_bytes(payload)
 
@@ -31,60 +86,329 @@ def _encode_capsule(capsule_type: CapsuleType, payload: bytes) -> bytes:
 def encode_datagram_capsule(data: bytes) -> bytes:
     return _encode_capsule(CapsuleType.DATAGRAM, data)
 
-class CapsuleBuffer():
-    def __init__(self) -> None:
-        self._buf: Buffer = Buffer(capacity=MAX_CAPSULE_SIZE)
-        self._capsule_buffer: bytes = b''
-        self._start: int = 0
-
-
-    # def read_capsule_data(self, data: bytes) -> List[Capsule]:
-    #     self._capsule_buffer += data
-    #     buf = Buffer(data=self._capsule_buffer)
-    #     capsules: List[Capsule] = []
-    #     consumed = 0       
-    #     while not buf.eof():
-    #         try:
-    #             ctype = buf.pull_uint_var()
-    #             clen = buf.pull_uint_var()
-    #             cdata = buf.pull_bytes(clen)
-    #         except BufferReadError:
-    #             break
-    #         if ctype == CapsuleType.DATAGRAM:
-    #             capsules.append(DatagramCapsule(data=cdata))
-    #         else:
-    #             capsules.append(Capsule())
-    #         consumed = buf.tell()
-    #     self._capsule_buffer = self._capsule_buffer[consumed:]
-    #     return capsules
-
-    def read_capsule_data(self, data: bytes) -> List[Capsule]:
+def encode_datagram_capsules(
+    datagrams: Iterable[Union[bytes, memoryview]], context_id: Optional[int] = None
+) -> bytearray:
+    """
+    Encode several DATAGRAM capsules into a single buffer.
+
+    The buffer is sized once for all the capsules and each payload is copied
+    into it exactly once, so the result can be handed to the HTTP layer in a
+    single call.
+
+    :param datagrams: The HTTP datagram payloads, which may be the memoryviews
+                      returned by :class:`CapsuleBuffer`.
+    :param context_id: If set, this context ID is prepended to each payload.
+    """
+    datagrams = list(datagrams)
+    prefix_size = 0 if context_id is None else size_uint_var(context_id)
+    capacity = 0
+    for data in datagrams:
+        length = prefix_size + len(data)
+        capacity += 1 + size_uint_var(length) + length
+
+    buf = bytearray(capacity)
+    pos = 0
+    for data in datagrams:
+        pos = _push_uint_var(buf, pos, CapsuleType.DATAGRAM)
+        pos = _push_uint_var(buf, pos, prefix_size + len(data))
+        if context_id is not None:
+            pos = _push_uint_var(buf, pos, context_id)
+        end = pos + len(data)
+        buf[pos:end] = data
+        pos = end
+    return buf
+
+def _pull_ip_address(buf: Buffer, version: int) -> IpAddress:
+    if version == 4:
+        return ipaddress.IPv4Address(buf.pull_bytes(4))
+    elif version == 6:
+        return ipaddress.IPv6Address(buf.pull_bytes(16))
+    raise MasqueError(f"Invalid IP version {version}")
+
+def _pull_assigned_addresses(data: memoryview) -> List[AssignedAddress]:
+    buf = Buffer(data=bytes(data))
+    addresses = []
+    while not buf.eof():
+        request_id = buf.pull_uint_var()
+        version = buf.pull_uint8()
+        address = _pull_ip_address(buf, version)
+        prefix_length = buf.pull_uint8()
         try:
-            self._buf.push_bytes(data)
-        except BufferWriteError:
-            self._buf.seek(self._start)
-            return []
-
-        end = self._buf.tell()
-        self._buf.seek(self._start)
-        capsules = []       
-        while self._buf.tell() < end:
-            try:
-                type = self._buf.pull_uint_var()
-                length = self._buf.pull_uint_var()
-                if self._buf.tell() + length > end:
-                    self._buf.seek(end)
+            prefix = ipaddress.ip_network((address, prefix_length))
+        except ValueError as exc:
+            raise MasqueError(str(exc))
+        addresses.append(AssignedAddress(request_id=request_id, prefix=prefix))
+    return addresses
+
+def _push_assigned_addresses(addresses: List[AssignedAddress]) -> bytes:
+    buf = Buffer(capacity=len(addresses) * (UINT_VAR_MAX_SIZE + 18))
+    for address in addresses:
+        buf.push_uint_var(address.request_id)
+        buf.push_uint8(address.prefix.version)
+        buf.push_bytes(address.prefix.network_address.packed)
+        buf.push_uint8(address.prefix.prefixlen)
+    return buf.data
+
+def decode_datagram_capsule(data: memoryview) -> Capsule:
+    return DatagramCapsule(data=data)
+
+def decode_address_assign_capsule(data: memoryview) -> Capsule:
+    return AddressAssignCapsule(addresses=_pull_assigned_addresses(data))
+
+def decode_address_request_capsule(data: memoryview) -> Capsule:
+    return AddressRequestCapsule(addresses=_pull_assigned_addresses(data))
+
+def decode_route_advertisement_capsule(data: memoryview) -> Capsule:
+    buf = Buffer(data=bytes(data))
+    ranges = []
+    while not buf.eof():
+        version = buf.pull_uint8()
+        start = _pull_ip_address(buf, version)
+        end = _pull_ip_address(buf, version)
+        ranges.append(IpAddressRange(start=start, end=end, ip_protocol=buf.pull_uint8()))
+    return RouteAdvertisementCapsule(ranges=ranges)
+
+def decode_close_webtransport_session_capsule(data: memoryview) -> Capsule:
+    buf = Buffer(data=bytes(data))
+    error_code = buf.pull_uint32()
+    reason = buf.pull_bytes(buf.capacity - buf.tell()).decode("utf8", errors="replace")
+    return CloseWebTransportSessionCapsule(error_code=error_code, reason=reason)
+
+def decode_drain_webtransport_session_capsule(data: memoryview) -> Capsule:
+    return DrainWebTransportSessionCapsule()
+
+def encode_address_assign_capsule(addresses: List[AssignedAddress]) -> bytes:
+    return _encode_capsule(CapsuleType.ADDRESS_ASSIGN, _push_assigned_addresses(addresses))
+
+def encode_address_request_capsule(addresses: List[AssignedAddress]) -> bytes:
+    return _encode_capsule(CapsuleType.ADDRESS_REQUEST, _push_assigned_addresses(addresses))
+
+def encode_route_advertisement_capsule(ranges: List[IpAddressRange]) -> bytes:
+    buf = Buffer(capacity=len(ranges) * 34)
+    for address_range in ranges:
+        buf.push_uint8(address_range.start.version)
+        buf.push_bytes(address_range.start.packed)
+        buf.push_bytes(address_range.end.packed)
+        buf.push_uint8(address_range.ip_protocol)
+    return _encode_capsule(CapsuleType.ROUTE_ADVERTISEMENT, buf.data)
+
+def encode_close_webtransport_session_capsule(error_code: int, reason: str = "") -> bytes:
+    encoded_reason = reason.encode("utf8")
+    buf = Buffer(capacity=4 + len(encoded_reason))
+    buf.push_uint32(error_code)
+    buf.push_bytes(encoded_reason)
+    return _encode_capsule(CapsuleType.CLOSE_WEBTRANSPORT_SESSION, buf.data)
+
+def encode_drain_webtransport_session_capsule() -> bytes:
+    return _encode_capsule(CapsuleType.DRAIN_WEBTRANSPORT_SESSION, b"")
+
+
+CAPSULE_DECODERS: Dict[int, CapsuleDecoder] = {
+    CapsuleType.DATAGRAM: decode_datagram_capsule,
+    CapsuleType.ADDRESS_ASSIGN: decode_address_assign_capsule,
+    CapsuleType.ADDRESS_REQUEST: decode_address_request_capsule,
+    CapsuleType.ROUTE_ADVERTISEMENT: decode_route_advertisement_capsule,
+    CapsuleType.CLOSE_WEBTRANSPORT_SESSION: decode_close_webtransport_session_capsule,
+    CapsuleType.DRAIN_WEBTRANSPORT_SESSION: decode_drain_webtransport_session_capsule,
+}
+
+def _pull_uint_var(data: memoryview, pos: int) -> Tuple[int, int]:
+    """
+    Decode a variable-length integer at `pos` and return it along with the
+    position following it.
+
+    :class:`~aioquic.buffer.Buffer` does not accept memoryviews, hence this
+    small pure-Python decoder.
+    """
+    if pos >= len(data):
+        raise BufferReadError("Read out of bounds")
+    first = data[pos]
+    if first < 0x40:
+        return first, pos + 1
+    size = 1 << (first >> 6)
+    end = pos + size
+    if end > len(data):
+        raise BufferReadError("Read out of bounds")
+    value = int.from_bytes(data[pos:end], "big") & ((1 << (size * 8 - 2)) - 1)
+    return value, end
+
+def _push_uint_var(buf: bytearray, pos: int, value: int) -> int:
+    """
+    Encode a variable-length integer at `pos` and return the position
+    following it.
+    """
+    size = size_uint_var(value)
+    prefix = (size.bit_length() - 1) << (size * 8 - 2)
+    buf[pos : pos + size] = (value | prefix).to_bytes(size, "big")
+    return pos + size
+
+class CapsuleBuffer():
+    """
+    Incremental capsule decoder.
+
+    Received chunks are kept as a list of segments instead of being copied
+    into a contiguous buffer. A capsule which lies entirely within a single
+    chunk is handed to its decoder as a memoryview slice of that chunk, only
+    capsules straddling several chunks are joined.
+
+    Capsules whose type has no decoder are skipped as their bytes arrive,
+    without their payload ever being buffered.
+
+    :param decoders: A mapping from capsule type to decoder, defaults to
+                     :data:`CAPSULE_DECODERS`. The mapping is used by
+                     reference, so decoders can be registered later on.
+    :param max_capsule_size: The largest capsule payload accepted, larger
+                             capsules raise a :class:`MasqueError`.
+    """
+    def __init__(
+        self,
+        decoders: Optional[Dict[int, CapsuleDecoder]] = None,
+        max_capsule_size: int = MAX_CAPSULE_SIZE,
+    ) -> None:
+        self._decoders = CAPSULE_DECODERS if decoders is None else decoders
+        self._header: Optional[Tuple[int, int, int]] = None
+        self._max_capsule_size = max_capsule_size
+        self._segments: Deque[memoryview] = deque()
+        self._size = 0
+        self._skip = 0
+
+    def read_capsule_data(self, data: Union[bytes, memoryview]) -> List[Capsule]:
+        capsules: List[Capsule] = []
+        view = memoryview(data)
+
+        if self._skip:
+            # drop the remainder of an unknown capsule
+            skipped = min(self._skip, len(view))
+            self._skip -= skipped
+            view = view[skipped:]
+
+        if self._segments:
+            # complete the capsules straddling previously received chunks
+            if view:
+                self._segments.append(view)
+                self._size += len(view)
+            while len(self._segments) > 1:
+                if self._header is None:
+                    header = self._peek(UINT_VAR_MAX_SIZE * 2)
+                    try:
+                        type, start = _pull_uint_var(header, 0)
+                        length, start = _pull_uint_var(header, start)
+                    except BufferReadError:
+                        return capsules
+                    self._header = (type, start, length)
+                type, start, length = self._header
+                decoder = self._decoders.get(type)
+                if decoder is None:
+                    self._header = None
+                    self._drop(start)
+                    skipped = min(length, self._size)
+                    self._drop(skipped)
+                    self._skip = length - skipped
+                    continue
+                self._check_length(length)
+                if start + length > self._size:
                     return capsules
-                capsule_data = self._buf.pull_bytes(length)
-                if type == CapsuleType.DATAGRAM:
-                    capsules.append(DatagramCapsule(data=capsule_data))
-                else:
-                    capsules.append(Capsule())
-                self._start = self._buf.tell()
-            except BufferReadError:
+                self._header = None
+                self._drop(start)
+                capsules.append(self._decode(decoder, self._consume(length)))
+            if not self._segments:
                 return capsules
-        self._start = 0
-        self._buf.seek(self._start)
+            view = self._segments.popleft()
+            self._header = None
+            self._size = 0
+
+        # parse straight out of the chunk
+        pos = 0
+        end = len(view)
+        while pos < end:
+            try:
+                type, start = _pull_uint_var(view, pos)
+                length, start = _pull_uint_var(view, start)
+            except BufferReadError:
+                break
+            decoder = self._decoders.get(type)
+            if decoder is None:
+                if start + length > end:
+                    self._skip = start + length - end
+                    pos = end
+                    break
+                pos = start + length
+                continue
+            self._check_length(length)
+            if start + length > end:
+                self._header = (type, start - pos, length)
+                break
+            pos = start + length
+            capsules.append(self._decode(decoder, view[start:pos]))
+        if pos < end:
+            self._segments.append(view[pos:])
+            self._size = end - pos
         return capsules
 
+    def _check_length(self, length: int) -> None:
+        if length > self._max_capsule_size:
+            raise MasqueError(
+                f"Capsule length {length} exceeds limit {self._max_capsule_size}"
+            )
+
+    def _consume(self, length: int) -> memoryview:
+        """
+        Remove `length` bytes from the front of the segments and return them.
+        """
+        if length == 0:
+            # the segments may all have been dropped with the header
+            return memoryview(b"")
+        self._size -= length
+        first = self._segments[0]
+        if len(first) > length:
+            self._segments[0] = first[length:]
+            return first[:length]
+        elif len(first) == length:
+            return self._segments.popleft()
+
+        chunks = []
+        while length:
+            segment = self._segments[0]
+            if len(segment) > length:
+                chunks.append(segment[:length])
+                self._segments[0] = segment[length:]
+                break
+            chunks.append(self._segments.popleft())
+            length -= len(segment)
+        return memoryview(b"".join(chunks))
+
+    def _decode(self, decoder: CapsuleDecoder, data: memoryview) -> Capsule:
+        try:
+            return decoder(data)
+        except BufferReadError:
+            raise MasqueError("Malformed capsule")
+
+    def _drop(self, length: int) -> None:
+        """
+        Remove `length` bytes from the front of the segments.
+        """
+        self._size -= length
+        while length:
+            segment = self._segments[0]
+            if len(segment) > length:
+                self._segments[0] = segment[length:]
+                break
+            self._segments.popleft()
+            length -= len(segment)
+
+    def _peek(self, length: int) -> memoryview:
+        """
+        Return up to `length` bytes from the front of the segments.
+        """
+        first = self._segments[0]
+        if len(first) >= length:
+            return first[:length]
 
+        chunks = []
+        for segment in self._segments:
+            chunks.append(segment[:length])
+            length -= len(chunks[-1])
+            if not length:
+                break
+        return memoryview(b"".join(chunks))
@@ -0,0 +1,61 @@
+from typing import Optional, Union
+
+
+class DatagramContext:
+    """
+    A context for HTTP datagrams exchanged over a tunnel (:rfc:`9298`
+    section 4).
+
+    The base class carries payloads unmodified, subclasses can rewrite them,
+    for instance to elide bytes which both peers know.
+    """
+
+    def compress(self, data: bytes) -> Optional[bytes]:
+        """
+        Return the payload to send in this context, or `None` if `data`
+        cannot be carried by this context.
+        """
+        return data
+
+    def decompress(self, data: Union[bytes, memoryview]) -> Optional[bytes]:
+        """
+        Return the original data for a received payload, or `None` if the
+        payload should be dropped.
+        """
+        return bytes(data)
+
+
+class QuicShortHeaderContext(DatagramContext):
+    """
+    A compression context eliding the destination connection ID of QUIC
+    short header packets, in the spirit of the QUIC-aware proxying draft.
+
+    Tunneled QUIC connections use the same destination connection ID for
+    most of their packets, so these bytes can be removed before sending and
+    reinserted on reception by a peer which registered the same context.
+
+    There is no capsule announcing contexts, so both ends must register the
+    context under the same ID out of band. :class:`~aioquic.masque.proxy.MasqueProxy`
+    does not register contexts, this is a client API for use with peers
+    which agreed on the context by other means.
+
+    :param connection_id: The destination connection ID to elide.
+    """
+
+    def __init__(self, connection_id: bytes) -> None:
+        self.connection_id = connection_id
+        self._end = 1 + len(connection_id)
+
+    def compress(self, data: bytes) -> Optional[bytes]:
+        if (
+            len(data) > self._end
+            and not data[0] & 0x80
+            and data[1 : self._end] == self.connection_id
+        ):
+            return data[:1] + data[self._end :]
+        return None
+
+    def decompress(self, data: Union[bytes, memoryview]) -> Optional[bytes]:
+        if not data or data[0] & 0x80:
+            return None
+        return b"".join((data[:1], self.connection_id, data[1:]))
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from typing import List, Optional, Tuple
 
+from .capsule import AssignedAddress, IpAddressRange
+
 class MasqueEvent:
     """
     Base class for Masque events.
@@ -18,4 +20,19 @@ class Connected(MasqueEvent):
 @dataclass
 class ConnectFailed(MasqueEvent):
     stream_id: int
-    reason: Optional[str] = None
\ No newline at end of file
+    reason: Optional[str] = None
+
+@dataclass
+class AddressAssigned(MasqueEvent):
+    stream_id: int
+    addresses: List[AssignedAddress]
+
+@dataclass
+class AddressRequested(MasqueEvent):
+    stream_id: int
+    addresses: List[AssignedAddress]
+
+@dataclass
+class RoutesAdvertised(MasqueEvent):
+    stream_id: int
+    ranges: List[IpAddressRange]
@@ -0,0 +1,278 @@
+import asyncio
+import contextlib
+import logging
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Protocol, Tuple
+
+from ..asyncio.client import connect
+from ..asyncio.protocol import QuicConnectionProtocol
+from ..quic.configuration import QuicConfiguration
+from ..quic.congestion.base import K_GRANULARITY
+
+logger = logging.getLogger("masque")
+
+ProxyKey = Tuple[str, int]
+TunnelKey = Tuple[str, int, str]
+
+
+class MasqueClientProtocol(Protocol):
+    """
+    The interface of the protocols created by a :class:`MasqueConnectionPool`
+    for its connections to proxies.
+    """
+
+    async def connect_udp(
+        self, uri: str, addr: str, **kwargs: Any
+    ) -> Optional[QuicConnectionProtocol]: ...
+
+    def close_udp(self, protocol: QuicConnectionProtocol) -> None: ...
+
+
+@dataclass
+class _PooledConnection:
+    protocol: QuicConnectionProtocol
+    exit_stack: contextlib.AsyncExitStack
+
+
+@dataclass
+class _ProxyLock:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+
+@dataclass
+class _PooledTunnel:
+    client: QuicConnectionProtocol
+    key: TunnelKey
+    protocol: QuicConnectionProtocol
+    last_used: float
+    users: int = 0
+
+
+def _connection_score(protocol: QuicConnectionProtocol) -> float:
+    """
+    Estimate the throughput available on a connection, in bytes per second.
+    """
+    return protocol.congestion_window / max(protocol.smoothed_rtt, K_GRANULARITY)
+
+
+class MasqueConnectionPool:
+    """
+    A pool of connections to MASQUE proxies and of the CONNECT-UDP tunnels
+    opened over them.
+
+    Up to `connections_per_proxy` connections are opened to each proxy and
+    kept open until the pool is closed. New tunnels are opened on the
+    connection with the most available throughput, estimated from its
+    congestion window and smoothed RTT.
+
+    Tunnels are shared: asking for a tunnel to a target which already has
+    one through the same proxy returns the existing inner connection, and
+    concurrent requests for the same target wait for a single CONNECT-UDP
+    request. Callers hand tunnels back with :meth:`release`, and tunnels
+    which nobody uses are closed after `idle_timeout` seconds.
+
+    :param configuration: The QUIC configuration of the connections to the
+                          proxies.
+    :param create_protocol: A callable returning the protocol of a connection
+                            to a proxy, which must provide the methods of
+                            :class:`MasqueClientProtocol`.
+    :param connections_per_proxy: The number of connections opened to each
+                                  proxy.
+    :param idle_timeout: The number of seconds after which an unused tunnel
+                         is closed.
+    :param connect: The function opening connections, defaults to
+                    :func:`~aioquic.asyncio.connect`.
+    """
+
+    def __init__(
+        self,
+        *,
+        configuration: QuicConfiguration,
+        create_protocol: Callable[..., QuicConnectionProtocol],
+        connections_per_proxy: int = 1,
+        idle_timeout: float = 30.0,
+        connect: Callable[..., Any] = connect,
+    ) -> None:
+        assert connections_per_proxy > 0, "At least one connection per proxy is needed"
+
+        self._configuration = configuration
+        self._connect = connect
+        self._connections: Dict[ProxyKey, List[_PooledConnection]] = {}
+        self._connections_per_proxy = connections_per_proxy
+        self._create_protocol = create_protocol
+        self._idle_timeout = idle_timeout
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+        self._locks: Dict[ProxyKey, _ProxyLock] = {}
+        self._loop = asyncio.get_running_loop()
+        self._opening: Dict[TunnelKey, asyncio.Future[Optional[_PooledTunnel]]] = {}
+        self._tunnels: Dict[TunnelKey, _PooledTunnel] = {}
+        self._tunnels_by_protocol: Dict[QuicConnectionProtocol, _PooledTunnel] = {}
+
+        # statistics
+        self.tunnels_evicted = 0
+        self.tunnels_opened = 0
+        self.tunnels_reused = 0
+
+    async def close(self) -> None:
+        """
+        Close all the tunnels and the connections to the proxies.
+        """
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        for tunnel in list(self._tunnels.values()):
+            self._close_tunnel(tunnel)
+        for connections in self._connections.values():
+            for connection in connections:
+                await connection.exit_stack.aclose()
+        self._connections.clear()
+        self._locks = {proxy: lock for proxy, lock in self._locks.items() if lock.users}
+
+    async def connect_udp(
+        self, proxy_host: str, proxy_port: int, uri: str, addr: str, **kwargs: Any
+    ) -> Optional[QuicConnectionProtocol]:
+        """
+        Return a QUIC connection to `addr` tunneled through the given proxy,
+        reusing an existing tunnel if possible.
+
+        The arguments are passed to the `connect_udp` method of the proxy
+        connection's protocol, and are ignored when a tunnel is reused.
+        Returns `None` if the tunnel could not be opened.
+        """
+        key = (proxy_host, proxy_port, addr)
+        tunnel = self._tunnels.get(key)
+        if tunnel is not None and (
+            tunnel.protocol.is_closed or tunnel.client.is_closed
+        ):
+            self._close_tunnel(tunnel)
+            tunnel = None
+
+        if tunnel is not None:
+            self.tunnels_reused += 1
+        else:
+            opening = self._opening.get(key)
+            if opening is None:
+                opening = self._opening[key] = asyncio.ensure_future(
+                    self._open_tunnel(key, uri, kwargs)
+                )
+                opening.add_done_callback(lambda _: self._opening.pop(key, None))
+            else:
+                self.tunnels_reused += 1
+            tunnel = await asyncio.shield(opening)
+            if tunnel is None:
+                return None
+
+        tunnel.users += 1
+        return tunnel.protocol
+
+    def release(self, protocol: QuicConnectionProtocol) -> None:
+        """
+        Hand back a connection returned by :meth:`connect_udp`.
+        """
+        tunnel = self._tunnels_by_protocol.get(protocol)
+        if tunnel is not None and tunnel.users:
+            tunnel.users -= 1
+            tunnel.last_used = self._loop.time()
+
+    async def warm_up(self, proxy_host: str, proxy_port: int) -> None:
+        """
+        Open the connections to a proxy ahead of the first tunnel.
+        """
+        proxy = (proxy_host, proxy_port)
+        async with self._lock(proxy):
+            connections = self._live_connections(proxy)
+            while len(connections) < self._connections_per_proxy:
+                connections.append(await self._open_connection(proxy))
+
+    def _check_idle(self) -> None:
+        self._idle_timer = None
+        deadline = self._loop.time() - self._idle_timeout
+        for tunnel in list(self._tunnels.values()):
+            if tunnel.protocol.is_closed or (
+                not tunnel.users and tunnel.last_used <= deadline
+            ):
+                logger.debug("Closing idle tunnel to %s", tunnel.key[2])
+                self._close_tunnel(tunnel)
+                self.tunnels_evicted += 1
+        self._schedule_idle_check()
+
+    def _close_tunnel(self, tunnel: _PooledTunnel) -> None:
+        del self._tunnels[tunnel.key]
+        del self._tunnels_by_protocol[tunnel.protocol]
+        if not tunnel.client.is_closed:
+            tunnel.client.close_udp(tunnel.protocol)  # type: ignore
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, proxy: ProxyKey) -> AsyncIterator[None]:
+        """
+        Serialize the opening of connections to a proxy.
+
+        The lock is forgotten once nobody holds or awaits it and no
+        connection to the proxy is pooled.
+        """
+        proxy_lock = self._locks.get(proxy)
+        if proxy_lock is None:
+            proxy_lock = self._locks[proxy] = _ProxyLock()
+        proxy_lock.users += 1
+        try:
+            async with proxy_lock.lock:
+                yield
+        finally:
+            proxy_lock.users -= 1
+            if not proxy_lock.users and not self._connections.get(proxy):
+                del self._locks[proxy]
+                self._connections.pop(proxy, None)
+
+    def _live_connections(self, proxy: ProxyKey) -> List[_PooledConnection]:
+        connections = self._connections.setdefault(proxy, [])
+        for connection in [c for c in connections if c.protocol.is_closed]:
+            connections.remove(connection)
+            asyncio.ensure_future(connection.exit_stack.aclose())
+        return connections
+
+    async def _open_connection(self, proxy: ProxyKey) -> _PooledConnection:
+        exit_stack = contextlib.AsyncExitStack()
+        protocol = await exit_stack.enter_async_context(
+            self._connect(
+                proxy[0],
+                proxy[1],
+                configuration=self._configuration,
+                create_protocol=self._create_protocol,
+            )
+        )
+        return _PooledConnection(protocol=protocol, exit_stack=exit_stack)
+
+    async def _open_tunnel(
+        self, key: TunnelKey, uri: str, kwargs: Dict[str, Any]
+    ) -> Optional[_PooledTunnel]:
+        client = await self._select_connection((key[0], key[1]))
+        protocol = await client.connect_udp(uri, key[2], **kwargs)  # type: ignore
+        if protocol is None:
+            return None
+
+        tunnel = _PooledTunnel(
+            client=client, key=key, protocol=protocol, last_used=self._loop.time()
+        )
+        self._tunnels[key] = tunnel
+        self._tunnels_by_protocol[protocol] = tunnel
+        self.tunnels_opened += 1
+        self._schedule_idle_check()
+        return tunnel
+
+    def _schedule_idle_check(self) -> None:
+        if self._idle_timer is None and self._tunnels:
+            self._idle_timer = self._loop.call_later(
+                self._idle_timeout / 2, self._check_idle
+            )
+
+    async def _select_connection(self, proxy: ProxyKey) -> QuicConnectionProtocol:
+        async with self._lock(proxy):
+            connections = self._live_connections(proxy)
+            if len(connections) < self._connections_per_proxy:
+                connections.append(await self._open_connection(proxy))
+                return connections[-1].protocol
+            return max(
+                (connection.protocol for connection in connections),
+                key=_connection_score,
+            )
@@ -0,0 +1,496 @@
+import asyncio
+import logging
+import socket
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import unquote
+
+from ..h3.connection import H3Connection
+from ..h3.events import (
+    DataReceived,
+    DatagramDropped,
+    DatagramReceived,
+    H3Event,
+    HeadersReceived,
+)
+from ..quic.connection import NetworkAddress
+from .events import MasqueEvent, ProxiedDatagramReceived
+from .exceptions import MasqueError
+from .resolver import Resolver
+from .tunnel import ConnectState, UdpTunnel
+
+logger = logging.getLogger("masque")
+
+# how many datagrams are read from a target socket per event loop iteration
+RECV_BATCH_SIZE = 64
+RECV_BUFFER_SIZE = 65536
+
+# how often to check whether paused target sockets can resume reading
+RESUME_READING_INTERVAL = 0.01
+
+# clients may send datagrams before the CONNECT-UDP response, these are
+# buffered until the target socket is ready, for a limited number of streams
+MAX_EARLY_DATAGRAMS = 32
+MAX_EARLY_STREAMS = 16
+
+
+class UdpProxyTunnel(UdpTunnel):
+    """
+    The proxy end of a CONNECT-UDP tunnel.
+
+    It decodes datagrams and capsules exactly like the client end, but the
+    proxy allocates odd context IDs (:rfc:`9298` section 4).
+    """
+
+    def __init__(
+        self,
+        http3_connection: H3Connection,
+        stream_id: int,
+        target_host: str,
+        target_port: int,
+    ) -> None:
+        super().__init__(http3_connection, stream_id)
+        self._next_context_id = 1
+        self.target_host = target_host
+        self.target_port = target_port
+        self.last_activity = 0.0
+        self.pending_datagrams: List[bytes] = []
+        self.transport: Optional[Union[asyncio.DatagramTransport, _TargetSocket]] = None
+        self.writing_paused = False
+
+    def handle_http_event(self, event: H3Event) -> List[MasqueEvent]:
+        if (
+            isinstance(event, DataReceived)
+            and self._connect_state == ConnectState.INITIALIZED
+        ):
+            # capsules sent before the response, while the target is opened
+            return self._receive_capsules(event.data)
+        return super().handle_http_event(event)
+
+
+class _TargetSocket:
+    """
+    A connected, non-blocking UDP socket towards a target.
+
+    Readable sockets are drained in batches into the proxy's receive buffer,
+    and datagrams are written straight to the socket instead of going
+    through an asyncio transport. Datagrams which do not fit in the socket's
+    send buffer are dropped.
+    """
+
+    def __init__(
+        self, proxy: "MasqueProxy", tunnel: UdpProxyTunnel, sock: socket.socket
+    ) -> None:
+        self._loop = proxy._loop
+        self._proxy = proxy
+        self._reading = False
+        self._sock = sock
+        self._tunnel = tunnel
+        self.resume_reading()
+
+    def close(self) -> None:
+        self.pause_reading()
+        self._sock.close()
+
+    def pause_reading(self) -> None:
+        if self._reading:
+            self._loop.remove_reader(self._sock.fileno())
+            self._reading = False
+
+    def resume_reading(self) -> None:
+        if not self._reading:
+            self._loop.add_reader(self._sock.fileno(), self._read)
+            self._reading = True
+
+    def sendto(self, data: bytes) -> None:
+        try:
+            self._sock.send(data)
+        except BlockingIOError:
+            self._tunnel.datagrams_dropped += 1
+        except OSError as exc:
+            logger.debug(
+                "Target socket error on stream %d: %s", self._tunnel.stream_id, exc
+            )
+
+    def _read(self) -> None:
+        buf = self._proxy._recv_buffer
+        datagrams: List[bytes] = []
+        for _ in range(RECV_BATCH_SIZE):
+            try:
+                size = self._sock.recv_into(buf)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                logger.debug(
+                    "Target socket error on stream %d: %s", self._tunnel.stream_id, exc
+                )
+                break
+            datagrams.append(bytes(buf[:size]))
+        if datagrams:
+            self._proxy._target_datagrams_received(self._tunnel, datagrams)
+
+
+class _TargetProtocol(asyncio.DatagramProtocol):
+    """
+    The fallback for event loops which cannot watch file descriptors.
+    """
+
+    def __init__(self, proxy: "MasqueProxy", tunnel: UdpProxyTunnel) -> None:
+        self._proxy = proxy
+        self._tunnel = tunnel
+
+    def datagram_received(self, data: bytes, addr: NetworkAddress) -> None:
+        self._proxy._target_datagrams_received(self._tunnel, [data])
+
+    def error_received(self, exc: Exception) -> None:
+        logger.debug("Target socket error on stream %d: %s", self._tunnel.stream_id, exc)
+
+    def pause_writing(self) -> None:
+        self._tunnel.writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._tunnel.writing_paused = False
+
+
+class MasqueProxy:
+    """
+    The proxy side of CONNECT-UDP (:rfc:`9298`) for one HTTP/3 connection.
+
+    The proxy keeps a table of tunnels keyed by request stream ID, each with
+    its own connected UDP socket towards the target. Target sockets are
+    read in batches of up to `RECV_BATCH_SIZE` datagrams into a shared
+    buffer, unless the event loop cannot watch file descriptors, in which
+    case asyncio datagram endpoints are used.
+
+    Datagrams received from targets are queued on the QUIC connection and a
+    single transmit is performed per event loop iteration for all tunnels,
+    or once per `flush_delay` seconds if set, letting several DATAGRAM frames
+    share an outer packet.
+    When too many datagrams are queued on the QUIC connection, reading from
+    target sockets is paused, and datagrams towards a target are dropped
+    while its socket's write buffer is full. Tunnels are torn down after
+    `idle_timeout` seconds without traffic.
+
+    Datagrams which clients send optimistically, before receiving the
+    response to their CONNECT-UDP request or even before the request
+    reached the proxy, are buffered until the target socket is ready, up to
+    `MAX_EARLY_DATAGRAMS` per tunnel. This applies to DATAGRAM capsules as
+    well, and a tunnel closed before the response is rejected.
+
+    Only the uncompressed context ID 0 is supported: datagrams sent with
+    other context IDs, such as those of a
+    :class:`~aioquic.masque.context.QuicShortHeaderContext`, are dropped.
+
+    :param http: The HTTP/3 connection, which must have been created with
+                 `enable_masque=True`.
+    :param transmit: A callable sending pending QUIC datagrams, typically
+                     :meth:`~aioquic.asyncio.QuicConnectionProtocol.transmit`.
+    :param idle_timeout: The number of seconds after which an idle tunnel
+                         is closed.
+    :param flush_delay: The number of seconds to wait for more datagrams
+                        before transmitting, `0` to transmit on the next event
+                        loop iteration or `None` to transmit every datagram
+                        immediately.
+    :param max_pending_datagrams: The number of datagrams queued on the QUIC
+                                  connection above which target sockets stop
+                                  being read.
+    :param resolver: The :class:`~aioquic.masque.resolver.Resolver` for target
+                     host names, which can be a
+                     :class:`~aioquic.masque.resolver.CachingResolver` shared
+                     by all the proxies of a server.
+    """
+
+    def __init__(
+        self,
+        http: H3Connection,
+        transmit: Callable[[], None],
+        *,
+        idle_timeout: float = 30.0,
+        flush_delay: Optional[float] = 0.0,
+        max_pending_datagrams: int = 1024,
+        resolver: Optional[Resolver] = None,
+    ) -> None:
+        self._flush_delay = flush_delay
+        self._http = http
+        self._idle_timeout = idle_timeout
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+        self._loop = asyncio.get_running_loop()
+        self._max_pending_datagrams = max_pending_datagrams
+        self._raw_sockets = True
+        self._recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+        self._reading_paused = False
+        self._early_datagrams: Dict[int, List[bytes]] = {}
+        self._last_request_stream_id = -1
+        self._resolver = resolver if resolver is not None else Resolver()
+        self._transmit = transmit
+        self._transmit_task: Optional[asyncio.Handle] = None
+        self._tunnels: Dict[int, UdpProxyTunnel] = {}
+
+    @property
+    def tunnels(self) -> Dict[int, UdpProxyTunnel]:
+        """
+        The active tunnels, keyed by request stream ID.
+        """
+        return self._tunnels
+
+    def close(self) -> None:
+        """
+        Close all the tunnels and their target sockets.
+        """
+        for stream_id in list(self._tunnels.keys()):
+            self._close_tunnel(stream_id, end_stream=False)
+        self._early_datagrams.clear()
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if self._transmit_task is not None:
+            self._transmit_task.cancel()
+            self._transmit_task = None
+
+    def handle_http_event(self, event: H3Event) -> bool:
+        """
+        Handle an HTTP event and return whether it was consumed by the proxy.
+
+        CONNECT-UDP requests and the data and datagrams of their streams are
+        consumed, other events should be handled by the caller.
+        """
+        if isinstance(event, HeadersReceived) and event.stream_id not in self._tunnels:
+            self._last_request_stream_id = max(
+                self._last_request_stream_id, event.stream_id
+            )
+            headers = dict(event.headers)
+            if (
+                headers.get(b":method") != b"CONNECT"
+                or headers.get(b":protocol") != b"connect-udp"
+            ):
+                self._early_datagrams.pop(event.stream_id, None)
+                return False
+            self._accept(event.stream_id, headers.get(b":path", b"").decode())
+            return True
+
+        tunnel = self._tunnels.get(getattr(event, "stream_id", None))
+        if tunnel is None:
+            if (
+                isinstance(event, DatagramReceived)
+                and event.stream_id > self._last_request_stream_id
+            ):
+                # the request for this datagram has not been received yet,
+                # assuming requests arrive in stream order
+                return self._receive_early_datagram(event.stream_id, event.data)
+            return False
+
+        if isinstance(event, DatagramDropped):
+            tunnel.handle_http_event(event)
+        elif isinstance(event, (DataReceived, DatagramReceived)):
+            tunnel.last_activity = self._loop.time()
+            try:
+                masque_events = tunnel.handle_http_event(event)
+            except MasqueError as exc:
+                logger.debug("Closing tunnel on stream %d: %s", tunnel.stream_id, exc)
+                self._close_tunnel(tunnel.stream_id, end_stream=True)
+                return True
+            for masque_event in masque_events:
+                if isinstance(masque_event, ProxiedDatagramReceived):
+                    self._send_to_target(tunnel, masque_event.datagram)
+            if isinstance(event, DataReceived) and event.stream_ended:
+                self._close_tunnel(tunnel.stream_id, end_stream=True)
+        return True
+
+    def _accept(self, stream_id: int, path: str) -> None:
+        # Accept path: /.well-known/masque/udp/{host}/{port}/
+        parts = path.strip("/").split("/")
+        if (
+            len(parts) != 5
+            or parts[:3] != [".well-known", "masque", "udp"]
+            or not parts[4].isdigit()
+        ):
+            logger.debug("Invalid CONNECT-UDP path %s", path)
+            self._reject(stream_id, 400)
+            return
+
+        tunnel = UdpProxyTunnel(
+            self._http, stream_id, target_host=unquote(parts[3]), target_port=int(parts[4])
+        )
+        tunnel.last_activity = self._loop.time()
+        self._tunnels[stream_id] = tunnel
+        for data in self._early_datagrams.pop(stream_id, []):
+            for masque_event in tunnel.handle_http_event(
+                DatagramReceived(data=data, stream_id=stream_id)
+            ):
+                if isinstance(masque_event, ProxiedDatagramReceived):
+                    self._send_to_target(tunnel, masque_event.datagram)
+        asyncio.ensure_future(self._open(tunnel))
+
+    def _check_idle(self) -> None:
+        self._idle_timer = None
+        deadline = self._loop.time() - self._idle_timeout
+        for stream_id, tunnel in list(self._tunnels.items()):
+            if tunnel.last_activity <= deadline:
+                logger.debug("Closing idle tunnel on stream %d", stream_id)
+                self._close_tunnel(stream_id, end_stream=True)
+        self._schedule_idle_check()
+
+    def _close_tunnel(self, stream_id: int, end_stream: bool) -> None:
+        tunnel = self._tunnels.pop(stream_id)
+        if tunnel.transport is not None:
+            tunnel.transport.close()
+        if not end_stream:
+            return
+        if tunnel.connected:
+            self._http.send_data(stream_id, b"", end_stream=True)
+            self._transmit_soon()
+        else:
+            # the tunnel is closed before the response was sent
+            self._reject(stream_id, 400)
+
+    async def _open(self, tunnel: UdpProxyTunnel) -> None:
+        try:
+            infos = await self._resolver.resolve(
+                tunnel.target_host, tunnel.target_port
+            )
+        except socket.gaierror:
+            infos = []
+        except Exception as exc:
+            # a failing resolver must not leave the request unanswered
+            logger.debug("Could not resolve %s: %s", tunnel.target_host, exc)
+            if tunnel.stream_id in self._tunnels:
+                del self._tunnels[tunnel.stream_id]
+                self._reject(tunnel.stream_id, 502)
+            return
+        if tunnel.stream_id not in self._tunnels:
+            return
+        if not infos:
+            del self._tunnels[tunnel.stream_id]
+            self._reject(tunnel.stream_id, 404)
+            return
+
+        # prefer IPv4 addresses
+        infos.sort(key=lambda info: info[0] != socket.AF_INET)
+        try:
+            transport = await self._connect_target(tunnel, infos[0][0], infos[0][4])
+        except (OSError, ValueError) as exc:
+            logger.debug("Could not reach %s: %s", tunnel.target_host, exc)
+            if tunnel.stream_id in self._tunnels:
+                del self._tunnels[tunnel.stream_id]
+                self._reject(tunnel.stream_id, 502)
+            return
+        if tunnel.stream_id not in self._tunnels:
+            transport.close()
+            return
+
+        tunnel.transport = transport
+        if self._reading_paused:
+            transport.pause_reading()
+        tunnel.mark_connected()
+        self._http.send_headers(
+            stream_id=tunnel.stream_id,
+            headers=[(b":status", b"200"), (b"capsule-protocol", b"?1")],
+        )
+        pending, tunnel.pending_datagrams = tunnel.pending_datagrams, []
+        for data in pending:
+            self._send_to_target(tunnel, data)
+        self._transmit_soon()
+        self._schedule_idle_check()
+
+    async def _connect_target(
+        self, tunnel: UdpProxyTunnel, family: int, addr: NetworkAddress
+    ) -> Union[asyncio.DatagramTransport, _TargetSocket]:
+        if self._raw_sockets:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            try:
+                sock.setblocking(False)
+                sock.connect(addr)
+                return _TargetSocket(self, tunnel, sock)
+            except NotImplementedError:
+                sock.close()
+                self._raw_sockets = False
+            except BaseException:
+                sock.close()
+                raise
+
+        transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _TargetProtocol(self, tunnel), remote_addr=addr
+        )
+        return transport
+
+    def _pending_datagrams(self) -> int:
+        return self._http.datagrams_pending
+
+    def _reject(self, stream_id: int, status: int) -> None:
+        self._http.send_headers(
+            stream_id=stream_id,
+            headers=[(b":status", str(status).encode())],
+            end_stream=True,
+        )
+        self._transmit_soon()
+
+    def _schedule_idle_check(self) -> None:
+        if self._idle_timer is None and self._tunnels:
+            self._idle_timer = self._loop.call_later(
+                self._idle_timeout / 2, self._check_idle
+            )
+
+    def _receive_early_datagram(self, stream_id: int, data: bytes) -> bool:
+        datagrams = self._early_datagrams.get(stream_id)
+        if datagrams is None:
+            if len(self._early_datagrams) >= MAX_EARLY_STREAMS:
+                return False
+            datagrams = self._early_datagrams[stream_id] = []
+        if len(datagrams) < MAX_EARLY_DATAGRAMS:
+            datagrams.append(data)
+        return True
+
+    def _send_to_target(self, tunnel: UdpProxyTunnel, data: bytes) -> None:
+        if tunnel.transport is None:
+            # the target socket is not ready yet
+            if len(tunnel.pending_datagrams) < MAX_EARLY_DATAGRAMS:
+                tunnel.pending_datagrams.append(data)
+            else:
+                tunnel.datagrams_dropped += 1
+            return
+        if tunnel.writing_paused:
+            tunnel.datagrams_dropped += 1
+            return
+        tunnel.transport.sendto(data)
+
+    def _set_reading_paused(self, paused: bool) -> None:
+        self._reading_paused = paused
+        for tunnel in self._tunnels.values():
+            if tunnel.transport is not None:
+                if paused:
+                    tunnel.transport.pause_reading()
+                else:
+                    tunnel.transport.resume_reading()
+
+    def _target_datagrams_received(
+        self, tunnel: UdpProxyTunnel, datagrams: List[bytes]
+    ) -> None:
+        if tunnel.stream_id not in self._tunnels:
+            return
+        tunnel.last_activity = self._loop.time()
+        tunnel.send_datagrams(datagrams)
+        if self._flush_delay is None:
+            self._transmit()
+        if self._pending_datagrams() >= self._max_pending_datagrams:
+            self._set_reading_paused(True)
+        if self._flush_delay is not None or self._reading_paused:
+            self._transmit_soon()
+
+    def _transmit_soon(self) -> None:
+        if self._transmit_task is None:
+            if self._flush_delay:
+                self._transmit_task = self._loop.call_later(
+                    self._flush_delay, self._flush
+                )
+            else:
+                self._transmit_task = self._loop.call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._transmit_task = None
+        self._transmit()
+        if self._reading_paused:
+            if self._pending_datagrams() < self._max_pending_datagrams // 2:
+                self._set_reading_paused(False)
+            else:
+                self._transmit_task = self._loop.call_later(
+                    RESUME_READING_INTERVAL, self._flush
+                )
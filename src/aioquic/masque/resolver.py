@@ -0,0 +1,166 @@
+import asyncio
+import ipaddress
+import socket
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+# an entry returned by `getaddrinfo`: family, type, proto, canonname, sockaddr
+AddressInfo = Tuple[int, int, int, str, Tuple[Any, ...]]
+
+
+def _with_port(infos: List[AddressInfo], port: int) -> List[AddressInfo]:
+    return [info[:4] + ((info[4][0], port) + info[4][2:],) for info in infos]
+
+
+class Resolver:
+    """
+    Resolves the host names of tunnel targets.
+
+    The default implementation calls the event loop's `getaddrinfo`, which
+    usually runs in the default executor. Subclasses can use another
+    mechanism, for instance a fixed table in tests.
+    """
+
+    async def resolve(self, host: str, port: int) -> List[AddressInfo]:
+        """
+        Return the UDP addresses of `host`, in the format of `getaddrinfo`.
+
+        Raises :class:`socket.gaierror` if the name cannot be resolved.
+        """
+        return await asyncio.get_running_loop().getaddrinfo(
+            host, port, family=socket.AF_UNSPEC, type=socket.SOCK_DGRAM
+        )
+
+
+class StaticResolver(Resolver):
+    """
+    Resolves host names from a fixed table, without any network access.
+
+    IP address literals resolve to themselves.
+
+    :param hosts: The addresses of each host name.
+    """
+
+    def __init__(self, hosts: Dict[str, List[str]]) -> None:
+        self.hosts = hosts
+
+    async def resolve(self, host: str, port: int) -> List[AddressInfo]:
+        try:
+            addresses = [ipaddress.ip_address(host)]
+        except ValueError:
+            if host not in self.hosts:
+                raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+            addresses = [ipaddress.ip_address(address) for address in self.hosts[host]]
+
+        infos: List[AddressInfo] = []
+        for address in addresses:
+            if address.version == 4:
+                family = socket.AF_INET
+                sockaddr: Tuple[Any, ...] = (str(address), port)
+            else:
+                family = socket.AF_INET6
+                sockaddr = (str(address), port, 0, 0)
+            infos.append((family, socket.SOCK_DGRAM, socket.IPPROTO_UDP, "", sockaddr))
+        return infos
+
+
+@dataclass
+class _CacheEntry:
+    expires: float
+    infos: List[AddressInfo]
+    error: Optional[socket.gaierror] = None
+
+
+class CachingResolver(Resolver):
+    """
+    Caches the results of another resolver.
+
+    Addresses are cached per host name for `ttl` seconds, whatever the port,
+    and names which could not be resolved are cached for `negative_ttl`
+    seconds. Concurrent lookups for the same name share a single request to
+    the underlying resolver, and at most `max_concurrency` requests run at
+    the same time. Once the cache holds `max_entries` names, the oldest
+    ones are evicted.
+
+    A single instance is meant to be shared by all the proxies of a server.
+
+    :param resolver: The underlying resolver, defaults to :class:`Resolver`.
+    :param ttl: The number of seconds during which addresses are cached.
+    :param negative_ttl: The number of seconds during which resolution
+                         failures are cached.
+    :param max_concurrency: The number of concurrent requests to the
+                            underlying resolver.
+    :param max_entries: The number of host names in the cache.
+    """
+
+    def __init__(
+        self,
+        resolver: Optional[Resolver] = None,
+        *,
+        ttl: float = 60.0,
+        negative_ttl: float = 5.0,
+        max_concurrency: int = 16,
+        max_entries: int = 4096,
+    ) -> None:
+        assert max_concurrency > 0, "At least one concurrent request is needed"
+
+        self._cache: Dict[str, _CacheEntry] = {}
+        self._loop = asyncio.get_running_loop()
+        self._max_entries = max_entries
+        self._negative_ttl = negative_ttl
+        self._pending: Dict[str, asyncio.Future[_CacheEntry]] = {}
+        self._resolver = resolver if resolver is not None else Resolver()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._ttl = ttl
+
+        # statistics
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.lookups_coalesced = 0
+
+    def clear(self) -> None:
+        """
+        Forget all the cached results.
+        """
+        self._cache.clear()
+
+    async def resolve(self, host: str, port: int) -> List[AddressInfo]:
+        entry = self._cache.get(host)
+        if entry is not None and entry.expires > self._loop.time():
+            self.cache_hits += 1
+        else:
+            pending = self._pending.get(host)
+            if pending is None:
+                self.cache_misses += 1
+                pending = self._pending[host] = asyncio.ensure_future(
+                    self._lookup(host)
+                )
+                pending.add_done_callback(lambda _: self._pending.pop(host, None))
+            else:
+                self.lookups_coalesced += 1
+            entry = await asyncio.shield(pending)
+
+        if entry.error is not None:
+            raise socket.gaierror(*entry.error.args)
+        return _with_port(entry.infos, port)
+
+    async def _lookup(self, host: str) -> _CacheEntry:
+        async with self._semaphore:
+            try:
+                infos = await self._resolver.resolve(host, 0)
+            except socket.gaierror as exc:
+                entry = _CacheEntry(
+                    expires=self._loop.time() + self._negative_ttl, infos=[], error=exc
+                )
+            else:
+                entry = _CacheEntry(expires=self._loop.time() + self._ttl, infos=infos)
+
+        self._cache.pop(host, None)
+        if len(self._cache) >= self._max_entries:
+            now = self._loop.time()
+            for expired in [k for k, v in self._cache.items() if v.expires <= now]:
+                del self._cache[expired]
+            while len(self._cache) >= self._max_entries:
+                del self._cache[next(iter(self._cache))]
+        self._cache[host] = entry
+        return entry
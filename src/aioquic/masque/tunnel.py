@@ -1,50 +1,165 @@
-from aioquic.buffer import encode_uint_var
+from aioquic.buffer import BufferReadError, encode_uint_var
 from aioquic.masque.events import ConnectFailed, Connected, MasqueEvent, ProxiedDatagramReceived
+from aioquic.masque.events import AddressAssigned, AddressRequested, RoutesAdvertised
 from ..h3.connection import H3Connection, Headers
-from ..h3.events import DataReceived, DatagramReceived, H3Event, HeadersReceived
-from .capsule import CapsuleBuffer, DatagramCapsule
-from .capsule import encode_datagram_capsule
+from ..h3.events import DataReceived, DatagramDropped, DatagramReceived, H3Event, HeadersReceived
+from .capsule import CAPSULE_DECODERS, Capsule, CapsuleBuffer, CapsuleDecoder, CapsuleType, DatagramCapsule
+from .capsule import AddressAssignCapsule, AddressRequestCapsule, AssignedAddress, IpAddressRange
+from .capsule import IpPrefix, RouteAdvertisementCapsule
+from .capsule import encode_address_assign_capsule, encode_address_request_capsule
+from .capsule import encode_datagram_capsules, encode_route_advertisement_capsule, _pull_uint_var
+from .context import DatagramContext
 from .exceptions import MasqueError
 from enum import Enum
-from typing import Any, Callable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
 UDP_PAYLOAD = 0x0
 UDP_PAYLOAD_BYTE = b'\x00'
+IP_PACKET = 0x0
 
 def connect_udp_default_uri(authority: str, host: str, port: int) -> str:
     return f"https://{authority.rstrip('/')}/.well-known/masque/udp/{host}/{port}/"
 
+def connect_ip_default_uri(authority: str, target: str = "*", ipproto: str = "*") -> str:
+    return f"https://{authority.rstrip('/')}/.well-known/masque/ip/{target}/{ipproto}/"
+
 class ConnectState(Enum):
     INITIALIZED = 0
     CONNECT_SENT = 1
     CONNECTED = 2
     FAILED = 3
 
+CapsuleHandler = Callable[[Capsule], List[MasqueEvent]]
+
 class MasqueTunnel:
+    protocol: Optional[bytes] = None
+
     def __init__(self, http3_connection: H3Connection, stream_id: int) -> None:
-        self._capsule_buffer: CapsuleBuffer = CapsuleBuffer()
+        self._capsule_decoders: Dict[int, CapsuleDecoder] = {}
+        self._capsule_handlers: Dict[int, CapsuleHandler] = {}
+        self._capsule_buffer: CapsuleBuffer = CapsuleBuffer(decoders=self._capsule_decoders)
         self._connect_state: ConnectState = ConnectState.INITIALIZED
+        self._compression_contexts: List[Tuple[bytes, DatagramContext]] = []
+        self._contexts: Dict[int, DatagramContext] = {UDP_PAYLOAD: DatagramContext()}
         self._http: H3Connection = http3_connection
+        self._next_context_id = 2
         self.stream_id: int = stream_id
-    
-    def connect(self, uri: str) -> None:
-        raise NotImplementedError("This method must be implemented by subclasses.")
 
-    def handle_http_event(self, event: H3Event) -> List[MasqueEvent]:
+        # statistics
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.datagrams_dropped = 0
+        self.datagrams_received = 0
+        self.datagrams_sent = 0
+
+    @property
+    def connected(self) -> bool:
         """
-        Handling of HTTP events
+        Whether the CONNECT request succeeded and the tunnel can be used.
         """
-        raise NotImplementedError("This method must be implemented by subclasses.")
+        return self._connect_state == ConnectState.CONNECTED
 
-    def send_datagram(self, data: bytes, stream: bool = False):
-        raise NotImplementedError("This method must be implemented by subclasses.")
+    def mark_connected(self) -> None:
+        """
+        Mark the tunnel as connected.
 
-class UdpTunnel(MasqueTunnel):
-    def __init__(self, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
+        This is meant for the proxy end of a tunnel, which receives the
+        CONNECT request instead of sending it, once it sent a successful
+        response.
+        """
+        if self._connect_state != ConnectState.INITIALIZED:
+            raise MasqueError("Connect request already handled")
+        self._connect_state = ConnectState.CONNECTED
+
+    @property
+    def max_datagram_payload_size(self) -> Optional[int]:
+        """
+        The largest payload, such as a tunneled UDP datagram, which fits in an
+        HTTP datagram on this tunnel, or `None` if it is not known yet.
+
+        It is derived from the limits of the outer QUIC connection, minus the
+        quarter stream ID and the context ID, so it follows changes to them.
+        Larger payloads are dropped by the outer connection.
+        """
+        max_size = self._http.max_datagram_size(self.stream_id)
+        if max_size is None:
+            return None
+        return max(0, max_size - len(UDP_PAYLOAD_BYTE))
+
+    def allocate_context_id(self) -> int:
+        """
+        Allocate a new context ID.
+
+        Tunnels are the client end of the CONNECT request, so they allocate
+        even context IDs (:rfc:`9298` section 4).
+        """
+        context_id = self._next_context_id
+        self._next_context_id += 2
+        return context_id
+
+    def register_context(self, context_id: int, context: DatagramContext) -> None:
+        """
+        Register a datagram context.
+
+        Received datagrams for this context ID are passed to
+        :meth:`DatagramContext.decompress`. When sending, the registered
+        contexts are tried in turn with :meth:`DatagramContext.compress`
+        before falling back to the uncompressed context ID 0.
+
+        Contexts are not negotiated: the peer must register the same context
+        under the same ID by other means. :class:`~aioquic.masque.proxy.MasqueProxy`
+        never does, so only the uncompressed context can be used with it.
+
+        :param context_id: The context ID, either allocated with
+                           :meth:`allocate_context_id` or announced by the peer.
+        :param context: The context.
+        """
+        if context_id in self._contexts:
+            raise MasqueError(f"Context ID {context_id} is already registered")
+        self._contexts[context_id] = context
+        if context_id != UDP_PAYLOAD:
+            self._compression_contexts.append((encode_uint_var(context_id), context))
+
+    def unregister_context(self, context_id: int) -> None:
+        """
+        Unregister a datagram context, later datagrams for it are dropped.
+        """
+        context = self._contexts.pop(context_id)
+        self._compression_contexts = [
+            (prefix, ctx) for prefix, ctx in self._compression_contexts if ctx is not context
+        ]
+
+    def register_capsule_handler(
+        self,
+        capsule_type: int,
+        handler: CapsuleHandler,
+        decoder: Optional[CapsuleDecoder] = None,
+    ) -> None:
+        """
+        Register a handler for the given capsule type.
+
+        Capsules of types without a handler are skipped without being decoded.
+
+        :param capsule_type: The capsule type.
+        :param handler: A callable receiving the decoded capsule and returning
+                        a list of MASQUE events.
+        :param decoder: A callable decoding the capsule payload, defaults to
+                        the decoder from
+                        :data:`~aioquic.masque.capsule.CAPSULE_DECODERS`.
+                        The returned capsule's `capsule_type` must be
+                        `capsule_type`.
+        """
+        if decoder is None:
+            if capsule_type not in CAPSULE_DECODERS:
+                raise MasqueError(f"No decoder known for capsule type {capsule_type}")
+            decoder = CAPSULE_DECODERS[capsule_type]
+        self._capsule_decoders[capsule_type] = decoder
+        self._capsule_handlers[capsule_type] = handler
     
     def connect(self, uri: str) -> None:
+        if self.protocol is None:
+            raise NotImplementedError("Subclasses must define the CONNECT protocol.")
         if self._connect_state != ConnectState.INITIALIZED:
             raise MasqueError("Connect request already sent")
         if not uri.startswith("https://"):
@@ -56,13 +171,16 @@ class UdpTunnel(MasqueTunnel):
             (b':scheme', b'https'),
             (b':authority', parsed.netloc.encode()),
             (b':path', parsed.path.encode()),
-            (b':protocol', b'connect-udp'),
+            (b':protocol', self.protocol),
             (b'capsule-protocol', b'?1'),
         ]
         self._http.send_headers(stream_id=self.stream_id, headers=headers, end_stream=False)
         self._connect_state = ConnectState.CONNECT_SENT
 
     def handle_http_event(self, event: H3Event) -> List[MasqueEvent]:
+        """
+        Handling of HTTP events
+        """
         masque_events: List[MasqueEvent] = []
         if isinstance(event, HeadersReceived):
 
@@ -75,8 +193,9 @@ class UdpTunnel(MasqueTunnel):
                 if header == b':status' and value.isdigit(): 
                     if int(value) in range(200, 300):
                         status = True
-                    else:            
-                      return [ConnectFailed(self.stream_id, reason=f"Connect request failed with status {value.decode()}")]
+                    else:
+                        self._connect_state = ConnectState.FAILED
+                        return [ConnectFailed(self.stream_id, reason=f"Connect request failed with status {value.decode()}")]
                 elif header == b'capsule-protocol' and value == b'?1':
                     capsule = True
             if not status:
@@ -90,45 +209,198 @@ class UdpTunnel(MasqueTunnel):
             masque_events.append(Connected(self.stream_id))
         
         elif isinstance(event, DataReceived):
+            if self._connect_state == ConnectState.FAILED:
+                # the body of an error response
+                return masque_events
             if self._connect_state != ConnectState.CONNECTED:
                 raise MasqueError("Unknown data received")
             
-            for capsule in self._capsule_buffer.read_capsule_data(event.data):
-                if isinstance(capsule, DatagramCapsule):
-                    datagram = self._receive_datagram(capsule.data)
-                    if datagram:
-                        masque_events.append(ProxiedDatagramReceived(self.stream_id, datagram))
+            masque_events.extend(self._receive_capsules(event.data))
         
         elif isinstance(event, DatagramReceived):
             assert event.stream_id == self.stream_id
+            if self._connect_state == ConnectState.FAILED:
+                return masque_events
             datagram = self._receive_datagram(event.data)
             if datagram:
                 masque_events.append(ProxiedDatagramReceived(self.stream_id, datagram))
+
+        elif isinstance(event, DatagramDropped):
+            # the datagram was dropped from the QUIC send queue
+            self.datagrams_dropped += 1
         
         return masque_events
 
     def send_datagram(self, data: bytes, stream: bool = False):
-        context_id = encode_uint_var(UDP_PAYLOAD)
-        datagram = context_id + data
+        if self._compression_contexts:
+            self.send_datagrams([data], stream=stream)
+            return
+
+        self.datagrams_sent += 1
+        self.bytes_sent += len(data)
         if stream:
-            self._http.send_data(self.stream_id, encode_datagram_capsule(datagram), end_stream=False)
+            self._http.send_data(
+                self.stream_id,
+                encode_datagram_capsules([data], context_id=UDP_PAYLOAD),
+                end_stream=False,
+            )
         else:
-            self._http.send_datagram(self.stream_id, datagram)
+            self._http.send_datagram(self.stream_id, data, prefix=UDP_PAYLOAD_BYTE)
+
+    def send_datagrams(self, datagrams: Iterable[bytes], stream: bool = False):
+        """
+        Send several payloads at once.
 
-    def _receive_datagram(self, data: bytes) -> bytes:
-        ctx_size = 1 << ((data[0] & 0xc0) >> 6)
+        In stream mode all the capsules are written in a single DATA frame.
+        """
+        datagrams = list(datagrams)
+        self.datagrams_sent += len(datagrams)
+        self.bytes_sent += sum(len(data) for data in datagrams)
+        if self._compression_contexts:
+            payloads = [self._compress(data) for data in datagrams]
+            if stream:
+                self._http.send_data(
+                    self.stream_id, encode_datagram_capsules(payloads), end_stream=False
+                )
+            else:
+                for payload in payloads:
+                    self._http.send_datagram(self.stream_id, payload)
+        elif stream:
+            self._http.send_data(
+                self.stream_id,
+                encode_datagram_capsules(datagrams, context_id=UDP_PAYLOAD),
+                end_stream=False,
+            )
+        else:
+            for data in datagrams:
+                self._http.send_datagram(self.stream_id, data, prefix=UDP_PAYLOAD_BYTE)
+
+    def _compress(self, data: bytes) -> bytes:
+        """
+        Return the HTTP datagram payload for `data`, using the first
+        compression context which accepts it.
+        """
+        for prefix, context in self._compression_contexts:
+            compressed = context.compress(data)
+            if compressed is not None:
+                return prefix + compressed
+        return UDP_PAYLOAD_BYTE + data
+
+    def _handle_datagram_capsule(self, capsule: Capsule) -> List[MasqueEvent]:
+        assert isinstance(capsule, DatagramCapsule)
+        datagram = self._receive_datagram(capsule.data)
+        if datagram:
+            return [ProxiedDatagramReceived(self.stream_id, datagram)]
+        return []
+
+    def _receive_capsules(self, data: bytes) -> List[MasqueEvent]:
+        masque_events: List[MasqueEvent] = []
+        for capsule in self._capsule_buffer.read_capsule_data(data):
+            masque_events.extend(self._capsule_handlers[capsule.capsule_type](capsule))
+        return masque_events
+
+    def _receive_datagram(self, data: Union[bytes, memoryview]) -> bytes:
+        try:
+            context_id, start = _pull_uint_var(memoryview(data), 0)
+        except BufferReadError:
+            return b''
         # Drop datagrams that are too small to handle. 
-        if len(data) <= ctx_size:
+        if len(data) <= start:
             return b''
-        context_id = int.from_bytes(data[:ctx_size]) & 0x3f
         
         # Drop datagrams with unknown context IDs.
-        if context_id != UDP_PAYLOAD:
+        context = self._contexts.get(context_id)
+        if context is None:
             return b''
-        return data[ctx_size:]
+        datagram = context.decompress(data[start:]) or b''
+        if datagram:
+            self.datagrams_received += 1
+            self.bytes_received += len(datagram)
+        return datagram
+
+class UdpTunnel(MasqueTunnel):
+    """
+    A CONNECT-UDP tunnel (:rfc:`9298`).
+    """
+    protocol = b'connect-udp'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.register_capsule_handler(CapsuleType.DATAGRAM, self._handle_datagram_capsule)
+
+class IpTunnel(MasqueTunnel):
+    """
+    A CONNECT-IP tunnel (:rfc:`9484`).
+
+    Datagrams carry full IP packets. The addresses assigned by the peer and
+    the routes it advertised are kept in :attr:`assigned_addresses` and
+    :attr:`routes`.
+    """
+    protocol = b'connect-ip'
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.assigned_addresses: List[AssignedAddress] = []
+        self.routes: List[IpAddressRange] = []
+        self._next_request_id = 1
+        self.register_capsule_handler(CapsuleType.DATAGRAM, self._handle_datagram_capsule)
+        self.register_capsule_handler(CapsuleType.ADDRESS_ASSIGN, self._handle_address_assign)
+        self.register_capsule_handler(CapsuleType.ADDRESS_REQUEST, self._handle_address_request)
+        self.register_capsule_handler(CapsuleType.ROUTE_ADVERTISEMENT, self._handle_route_advertisement)
 
+    def assign_addresses(self, addresses: List[AssignedAddress]) -> None:
+        """
+        Send an ADDRESS_ASSIGN capsule, replacing previously assigned addresses.
+        """
+        self._send_capsule(encode_address_assign_capsule(addresses))
+
+    def advertise_routes(self, ranges: List[IpAddressRange]) -> None:
+        """
+        Send a ROUTE_ADVERTISEMENT capsule, replacing previously advertised routes.
+        """
+        self._send_capsule(encode_route_advertisement_capsule(ranges))
+
+    def request_address(self, prefix: IpPrefix) -> int:
+        """
+        Send an ADDRESS_REQUEST capsule and return the request ID.
+
+        :param prefix: The requested prefix, use an unspecified address such
+                       as ``0.0.0.0/32`` to let the peer choose.
+        """
+        request_id = self._next_request_id
+        self._send_capsule(
+            encode_address_request_capsule([AssignedAddress(request_id=request_id, prefix=prefix)])
+        )
+        self._next_request_id += 1
+        return request_id
 
+    def _handle_address_assign(self, capsule: Capsule) -> List[MasqueEvent]:
+        assert isinstance(capsule, AddressAssignCapsule)
+        self.assigned_addresses = capsule.addresses
+        return [AddressAssigned(self.stream_id, capsule.addresses)]
 
+    def _handle_address_request(self, capsule: Capsule) -> List[MasqueEvent]:
+        assert isinstance(capsule, AddressRequestCapsule)
+        return [AddressRequested(self.stream_id, capsule.addresses)]
 
+    def _handle_route_advertisement(self, capsule: Capsule) -> List[MasqueEvent]:
+        assert isinstance(capsule, RouteAdvertisementCapsule)
+        # RFC 9484 section 4.7.3: ranges are ordered by IP version, then IP
+        # protocol, then start address, and must not overlap.
+        for address_range in capsule.ranges:
+            if address_range.start > address_range.end:
+                raise MasqueError("Route advertisement range starts after its end")
+        for previous, current in zip(capsule.ranges, capsule.ranges[1:]):
+            previous_key = (previous.start.version, previous.ip_protocol)
+            current_key = (current.start.version, current.ip_protocol)
+            if previous_key > current_key or (
+                previous_key == current_key and previous.end >= current.start
+            ):
+                raise MasqueError("Route advertisement ranges are not ordered")
+        self.routes = capsule.ranges
+        return [RoutesAdvertised(self.stream_id, capsule.ranges)]
 
+    def _send_capsule(self, data: bytes) -> None:
+        if self._connect_state == ConnectState.INITIALIZED:
+            raise MasqueError("Connect request not sent")
+        self._http.send_data(self.stream_id, data, end_stream=False)
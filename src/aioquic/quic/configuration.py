@@ -9,6 +9,7 @@ from ..tls import (
     load_pem_private_key,
     load_pem_x509_certificates,
 )
+from .connection_id import ConnectionIdGenerator
 from .logger import QuicLogger
 from .packet import QuicProtocolVersion
 
@@ -33,11 +34,51 @@ class QuicConfiguration:
     Currently supported algorithms: `"reno", `"cubic"`.
     """
 
+    connection_id_generator: ConnectionIdGenerator = field(
+        default_factory=ConnectionIdGenerator
+    )
+    """
+    The generator for local connection IDs.
+
+    The default generator returns random connection IDs. Use a
+    :class:`~aioquic.quic.connection_id.QuicLbConnectionIdGenerator` to encode
+    a server ID which a load balancer can use to route packets.
+    """
+
     connection_id_length: int = 8
     """
     The length in bytes of local connection IDs.
     """
 
+    datagram_drop_policy: str = "drop-oldest"
+    """
+    Which DATAGRAM frame to drop when the send queue is full.
+
+    Currently supported policies: `"drop-oldest"`, `"drop-newest"`.
+    """
+
+    datagram_max_age: Optional[float] = None
+    """
+    The time in seconds after which queued DATAGRAM frames which could not be
+    sent yet, for instance because the congestion window is full, are dropped.
+
+    The age of a frame is measured from the first time the connection tried
+    to send it. If `None`, frames do not expire.
+    """
+
+    datagram_quantum: int = SMALLEST_MAX_DATAGRAM_SIZE
+    """
+    The number of bytes of DATAGRAM frames each flow can send per round when
+    several flows have frames waiting to be sent.
+    """
+
+    datagram_weight: int = 1
+    """
+    The share of the sending capacity given to DATAGRAM frames when both
+    DATAGRAM and STREAM frames are waiting to be sent, relative to
+    :attr:`stream_weight`.
+    """
+
     idle_timeout: float = 60.0
     """
     The idle timeout in seconds.
@@ -60,6 +101,18 @@ class QuicConfiguration:
     The maximum QUIC payload size in bytes to send, excluding UDP or IP overhead.
     """
 
+    max_datagrams_pending: Optional[int] = None
+    """
+    The maximum number of DATAGRAM frames queued for sending, or `None` for
+    no limit.
+    """
+
+    max_datagrams_pending_bytes: Optional[int] = None
+    """
+    The maximum total size in bytes of the DATAGRAM frames queued for sending,
+    or `None` for no limit.
+    """
+
     max_stream_data: int = 1048576
     """
     Per-stream flow control limit.
@@ -93,6 +146,24 @@ class QuicConfiguration:
     The TLS session ticket which should be used for session resumption.
     """
 
+    stateless_reset_key: Optional[bytes] = None
+    """
+    A secret key from which the stateless reset tokens of local connection IDs
+    are derived.
+
+    If set, a server can reset connections it has no state for, for instance
+    after it restarted, by sending a stateless reset. All the servers sharing
+    a listening address should use the same key. If `None`, tokens are
+    random and no stateless resets are sent.
+    """
+
+    stream_weight: int = 1
+    """
+    The share of the sending capacity given to STREAM frames when both
+    DATAGRAM and STREAM frames are waiting to be sent, relative to
+    :attr:`datagram_weight`.
+    """
+
     token: bytes = b""
     """
     The address validation token that can be used to validate future connections.
@@ -1,8 +1,9 @@
 import binascii
+import hmac
 import logging
 import os
 from collections import deque
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from functools import partial
 from typing import (
@@ -29,13 +30,21 @@ from ..buffer import (
 from . import events
 from .configuration import SMALLEST_MAX_DATAGRAM_SIZE, QuicConfiguration
 from .congestion.base import K_GRANULARITY
-from .crypto import CryptoError, CryptoPair, KeyUnavailableError, NoCallback
+from .connection_id import derive_stateless_reset_token
+from .crypto import (
+    AEAD_TAG_SIZE,
+    CryptoError,
+    CryptoPair,
+    KeyUnavailableError,
+    NoCallback,
+)
 from .logger import QuicLoggerTrace
 from .packet import (
     CONNECTION_ID_MAX_SIZE,
     NON_ACK_ELICITING_FRAME_TYPES,
     PROBING_FRAME_TYPES,
     RETRY_INTEGRITY_TAG_SIZE,
+    STATELESS_RESET_MIN_SIZE,
     STATELESS_RESET_TOKEN_SIZE,
     QuicErrorCode,
     QuicFrameType,
@@ -54,13 +63,19 @@ from .packet import (
     push_ack_frame,
     push_quic_transport_parameters,
 )
-from .packet_builder import QuicDeliveryState, QuicPacketBuilder, QuicPacketBuilderStop
+from .packet_builder import (
+    PACKET_NUMBER_SEND_SIZE,
+    QuicDeliveryState,
+    QuicPacketBuilder,
+    QuicPacketBuilderStop,
+)
 from .recovery import QuicPacketRecovery, QuicPacketSpace
 from .stream import FinalSizeError, QuicStream, StreamFinishedError
 
 logger = logging.getLogger("quic")
 
 CRYPTO_BUFFER_SIZE = 16384
+DATAGRAM_DROP_POLICIES = frozenset(["drop-newest", "drop-oldest"])
 EPOCH_SHORTCUTS = {
     "I": tls.Epoch.INITIAL,
     "H": tls.Epoch.HANDSHAKE,
@@ -101,6 +116,7 @@ MAX_STREAM_DATA_FRAME_CAPACITY = 1 + 2 * UINT_VAR_MAX_SIZE
 NEW_CONNECTION_ID_FRAME_CAPACITY = (
     1 + 2 * UINT_VAR_MAX_SIZE + 1 + CONNECTION_ID_MAX_SIZE + STATELESS_RESET_TOKEN_SIZE
 )
+NEW_TOKEN_FRAME_CAPACITY = 1 + UINT_VAR_MAX_SIZE  # + token length
 PATH_CHALLENGE_FRAME_CAPACITY = 1 + 8
 PATH_RESPONSE_FRAME_CAPACITY = 1 + 8
 PING_FRAME_CAPACITY = 1
@@ -212,6 +228,25 @@ class QuicNetworkPath:
         return self.is_validated or (self.bytes_sent + size) <= 3 * self.bytes_received
 
 
+@dataclass
+class QuicPendingDatagram:
+    data: bytes
+    flow_id: Optional[int]
+    prefix: bytes = b""
+    queued_at: Optional[float] = None
+    done: bool = False
+
+    @property
+    def size(self) -> int:
+        return len(self.prefix) + len(self.data)
+
+
+@dataclass
+class QuicDatagramFlow:
+    deficit: int
+    datagrams: Deque[QuicPendingDatagram] = field(default_factory=deque)
+
+
 @dataclass
 class QuicReceiveContext:
     epoch: tls.Epoch
@@ -252,6 +287,7 @@ class QuicConnection:
         self,
         *,
         configuration: QuicConfiguration,
+        address_validated: bool = False,
         original_destination_connection_id: Optional[bytes] = None,
         retry_source_connection_id: Optional[bytes] = None,
         session_ticket_fetcher: Optional[tls.SessionTicketFetcher] = None,
@@ -262,6 +298,10 @@ class QuicConnection:
             "The smallest allowed maximum datagram size is "
             f"{SMALLEST_MAX_DATAGRAM_SIZE} bytes"
         )
+        assert configuration.datagram_drop_policy in DATAGRAM_DROP_POLICIES, (
+            "Unsupported DATAGRAM drop policy "
+            f"{configuration.datagram_drop_policy}"
+        )
         if configuration.is_client:
             assert original_destination_connection_id is None, (
                 "Cannot set original_destination_connection_id for a client"
@@ -269,6 +309,7 @@ class QuicConnection:
             assert retry_source_connection_id is None, (
                 "Cannot set retry_source_connection_id for a client"
             )
+            assert not address_validated, "Cannot set address_validated for a client"
         else:
             assert token_handler is None, "Cannot set `token_handler` for a server"
             assert configuration.token == b"", (
@@ -289,6 +330,7 @@ class QuicConnection:
         self._is_client = configuration.is_client
 
         self._ack_delay = K_GRANULARITY
+        self._address_validated = address_validated
         self._close_at: Optional[float] = None
         self._close_event: Optional[events.ConnectionTerminated] = None
         self._connect_called = False
@@ -302,11 +344,18 @@ class QuicConnection:
         self._events: Deque[events.QuicEvent] = deque()
         self._handshake_complete = False
         self._handshake_confirmed = False
+        host_cid = configuration.connection_id_generator.generate(
+            configuration.connection_id_length
+        )
         self._host_cids = [
             QuicConnectionId(
-                cid=os.urandom(configuration.connection_id_length),
+                cid=host_cid,
                 sequence_number=0,
-                stateless_reset_token=os.urandom(16) if not self._is_client else None,
+                stateless_reset_token=(
+                    self._stateless_reset_token(host_cid)
+                    if not self._is_client
+                    else None
+                ),
                 was_sent=True,
             )
         ]
@@ -405,12 +454,19 @@ class QuicConnection:
 
         # things to send
         self._close_pending = False
-        self._datagrams_pending: Deque[bytes] = deque()
+        self._datagrams_dropped = 0
+        self._datagram_flows: Dict[Optional[int], QuicDatagramFlow] = {}
+        self._datagram_vtime = 0.0
+        self._datagrams_pending: Deque[QuicPendingDatagram] = deque()
+        self._datagrams_pending_bytes = 0
+        self._datagrams_pending_count = 0
         self._handshake_done_pending = False
+        self._new_tokens_pending: List[bytes] = []
         self._ping_pending: List[int] = []
         self._probe_pending = False
         self._retire_connection_ids: List[int] = []
         self._streams_blocked_pending = False
+        self._stream_vtime = 0.0
 
         # callbacks
         self._session_ticket_fetcher = session_ticket_fetcher
@@ -458,10 +514,62 @@ class QuicConnection:
     def configuration(self) -> QuicConfiguration:
         return self._configuration
 
+    @property
+    def congestion_window(self) -> int:
+        """
+        The congestion window, in bytes.
+        """
+        return self._loss.congestion_window
+
+    @property
+    def datagrams_dropped(self) -> int:
+        """
+        The number of DATAGRAM frames dropped from the send queue.
+        """
+        return self._datagrams_dropped
+
+    @property
+    def datagrams_pending(self) -> int:
+        """
+        The number of DATAGRAM frames queued for sending.
+        """
+        return self._datagrams_pending_count
+
+    @property
+    def max_datagram_frame_data_size(self) -> Optional[int]:
+        """
+        The largest amount of data which can be sent in a DATAGRAM frame, or
+        `None` if the peer's transport parameters were not received yet.
+
+        It is limited both by the peer's ``max_datagram_frame_size`` transport
+        parameter and by the space available in a 1-RTT packet.
+        """
+        if self._remote_max_datagram_frame_size is None:
+            return None
+
+        # the frame type and length are part of the frame size
+        frame_space = self._remote_max_datagram_frame_size - 1
+        packet_space = (
+            self._max_datagram_size
+            - (1 + len(self._peer_cid.cid) + PACKET_NUMBER_SEND_SIZE)
+            - AEAD_TAG_SIZE
+            - 1
+        )
+        space = min(frame_space, packet_space)
+        return max(0, space - size_uint_var(space))
+
     @property
     def original_destination_connection_id(self) -> bytes:
         return self._original_destination_connection_id
 
+    @property
+    def smoothed_rtt(self) -> float:
+        """
+        The smoothed round-trip time in seconds, or the initial RTT if it was
+        not measured yet.
+        """
+        return self._loss.smoothed_rtt
+
     def change_connection_id(self) -> None:
         """
         Switch to the next available connection ID and retire
@@ -577,6 +685,10 @@ class QuicConnection:
             self._close_pending = False
             self._close_begin(is_initiator=True, now=now)
         else:
+            # expire stale DATAGRAM frames
+            if self._configuration.datagram_max_age is not None:
+                self._expire_datagrams(now=now)
+
             # congestion control
             builder.max_flight_bytes = (
                 self._loss.congestion_window - self._loss.bytes_in_flight
@@ -848,6 +960,8 @@ class QuicConnection:
                             "raw": {"length": header.packet_length},
                         },
                     )
+                if header.packet_type == QuicPacketType.ONE_RTT:
+                    self._receive_stateless_reset(data=data, now=now)
                 return
 
             # Handle version negotiation packet.
@@ -891,6 +1005,9 @@ class QuicConnection:
                 )
                 crypto_frame_required = True
                 self._network_paths = [network_path]
+                if self._address_validated:
+                    # the client presented a valid address validation token
+                    network_path.is_validated = True
                 self._version = header.version
                 self._initialize(header.destination_cid)
 
@@ -947,6 +1064,13 @@ class QuicConnection:
                             "raw": {"length": header.packet_length},
                         },
                     )
+
+                # a short header packet which cannot be decrypted may be a
+                # stateless reset
+                if header.packet_type == QuicPacketType.ONE_RTT and (
+                    self._receive_stateless_reset(data=data, now=now)
+                ):
+                    return
                 continue
 
             # check reserved bits
@@ -1103,6 +1227,20 @@ class QuicConnection:
         stream = self._get_or_create_stream_for_send(stream_id)
         stream.sender.reset(error_code)
 
+    def send_new_token(self, token: bytes) -> None:
+        """
+        Send a NEW_TOKEN frame, which the client can use to validate its
+        address when it next connects.
+
+        The frame is sent once the handshake is complete.
+
+        .. aioquic_transmit::
+
+        :param token: The address validation token.
+        """
+        assert not self._is_client, "Clients must not send NEW_TOKEN frames"
+        self._new_tokens_pending.append(token)
+
     def send_ping(self, uid: int) -> None:
         """
         Send a PING frame to the peer.
@@ -1113,15 +1251,74 @@ class QuicConnection:
         """
         self._ping_pending.append(uid)
 
-    def send_datagram_frame(self, data: bytes) -> None:
+    def send_datagram_frame(
+        self, data: bytes, flow_id: Optional[int] = None, prefix: bytes = b""
+    ) -> None:
         """
         Send a DATAGRAM frame.
 
         .. aioquic_transmit::
 
+        Frames are queued per flow and the flows are served using deficit
+        round robin, so that one busy flow cannot delay the frames of the
+        others. Each flow can send up to
+        :attr:`~aioquic.quic.configuration.QuicConfiguration.datagram_quantum`
+        bytes per round.
+
+        If the send queue is full, a frame is dropped according to
+        :attr:`~aioquic.quic.configuration.QuicConfiguration.datagram_drop_policy`
+        and a :class:`~aioquic.quic.events.DatagramFrameDropped` event is fired.
+        Frames larger than :attr:`max_datagram_frame_data_size` are dropped
+        in the same way, as they could never be sent.
+
         :param data: The data to be sent.
-        """
-        self._datagrams_pending.append(data)
+        :param flow_id: An optional identifier of the flow the frame belongs to,
+                        for instance the quarter stream ID of an HTTP/3 datagram.
+        :param prefix: Bytes to send before `data` in the same frame. They are
+                       written directly into the packet, which avoids copying
+                       `data` to prepend a header.
+        """
+        configuration = self._configuration
+        size = len(prefix) + len(data)
+        max_size = self.max_datagram_frame_data_size
+        if max_size is not None and size > max_size:
+            self._drop_datagram(prefix + data, flow_id)
+            return
+
+        max_count = configuration.max_datagrams_pending
+        max_bytes = configuration.max_datagrams_pending_bytes
+        if max_count is not None or max_bytes is not None:
+            if max_count is None:
+                max_count = self._datagrams_pending_count + 1
+            if max_bytes is None:
+                max_bytes = self._datagrams_pending_bytes + size
+            if configuration.datagram_drop_policy == "drop-newest":
+                if (
+                    self._datagrams_pending_count >= max_count
+                    or self._datagrams_pending_bytes + size > max_bytes
+                ):
+                    self._drop_datagram(prefix + data, flow_id)
+                    return
+            else:
+                while self._datagrams_pending_count and (
+                    self._datagrams_pending_count >= max_count
+                    or self._datagrams_pending_bytes + size > max_bytes
+                ):
+                    self._drop_datagram(*self._pop_datagram())
+                if size > max_bytes:
+                    self._drop_datagram(prefix + data, flow_id)
+                    return
+
+        datagram = QuicPendingDatagram(data=data, flow_id=flow_id, prefix=prefix)
+        self._datagrams_pending.append(datagram)
+        self._datagrams_pending_bytes += size
+        self._datagrams_pending_count += 1
+        flow = self._datagram_flows.get(flow_id)
+        if flow is None:
+            flow = self._datagram_flows[flow_id] = QuicDatagramFlow(
+                deficit=configuration.datagram_quantum
+            )
+        flow.datagrams.append(datagram)
 
     def send_stream_data(
         self, stream_id: int, data: bytes, end_stream: bool = False
@@ -1317,6 +1514,28 @@ class QuicConnection:
             self._loss.discard_space(self._spaces[epoch])
             self._spaces[epoch].discarded = True
 
+    def _drop_datagram(self, data: bytes, flow_id: Optional[int]) -> None:
+        self._datagrams_dropped += 1
+        self._events.append(events.DatagramFrameDropped(data=data, flow_id=flow_id))
+
+    def _expire_datagrams(self, now: float) -> None:
+        pending = self._datagrams_pending
+
+        # stamp frames queued since the last call
+        i = len(pending) - 1
+        while i >= 0 and pending[i].queued_at is None:
+            pending[i].queued_at = now
+            i -= 1
+
+        # drop frames which waited too long
+        deadline = now - self._configuration.datagram_max_age
+        while self._datagrams_pending_count:
+            while pending[0].done:
+                pending.popleft()
+            if pending[0].queued_at >= deadline:
+                break
+            self._drop_datagram(*self._pop_datagram())
+
     def _find_network_path(self, addr: NetworkAddress) -> QuicNetworkPath:
         # check existing network paths
         for idx, network_path in enumerate(self._network_paths):
@@ -2382,6 +2601,15 @@ class QuicConnection:
         if delivery != QuicDeliveryState.ACKED:
             connection_id.was_sent = False
 
+    def _on_new_token_delivery(
+        self, delivery: QuicDeliveryState, token: bytes
+    ) -> None:
+        """
+        Callback when a NEW_TOKEN frame is acknowledged or lost.
+        """
+        if delivery != QuicDeliveryState.ACKED:
+            self._new_tokens_pending.append(token)
+
     def _on_ping_delivery(
         self, delivery: QuicDeliveryState, uids: Sequence[int]
     ) -> None:
@@ -2543,6 +2771,34 @@ class QuicConnection:
                     },
                 )
 
+    def _receive_stateless_reset(self, data: bytes, now: float) -> bool:
+        """
+        Handle a datagram which may be a stateless reset, that is it ends with
+        the stateless reset token of the connection ID in use.
+
+        Tokens of connection IDs which were not used yet are not checked, as
+        required by :rfc:`9000` section 10.3.1.
+
+        Returns whether the connection was reset.
+        """
+        if len(data) < STATELESS_RESET_MIN_SIZE:
+            return False
+        expected = self._peer_cid.stateless_reset_token
+        if not expected or not hmac.compare_digest(
+            expected, data[-STATELESS_RESET_TOKEN_SIZE:]
+        ):
+            return False
+
+        self._logger.info("Stateless reset received")
+        if self._close_event is None:
+            self._close_event = events.ConnectionTerminated(
+                error_code=QuicErrorCode.NO_ERROR,
+                frame_type=None,
+                reason_phrase="Stateless reset",
+            )
+        self._close_begin(is_initiator=False, now=now)
+        return True
+
     def _receive_version_negotiation_packet(
         self, header: QuicHeader, now: float
     ) -> None:
@@ -2643,11 +2899,14 @@ class QuicConnection:
         Generate new connection IDs.
         """
         while len(self._host_cids) < min(8, self._remote_active_connection_id_limit):
+            cid = self._configuration.connection_id_generator.generate(
+                self._configuration.connection_id_length
+            )
             self._host_cids.append(
                 QuicConnectionId(
-                    cid=os.urandom(self._configuration.connection_id_length),
+                    cid=cid,
                     sequence_number=self._host_cid_seq,
-                    stateless_reset_token=os.urandom(16),
+                    stateless_reset_token=self._stateless_reset_token(cid),
                 )
             )
             self._host_cid_seq += 1
@@ -2664,6 +2923,26 @@ class QuicConnection:
         )
         self._retire_connection_ids.append(connection_id.sequence_number)
 
+    def _pop_datagram(self) -> Tuple[bytes, Optional[int]]:
+        """
+        Remove the oldest queued DATAGRAM frame and return its data and flow.
+        """
+        pending = self._datagrams_pending
+        while pending[0].done:
+            pending.popleft()
+        datagram = pending.popleft()
+        datagram.done = True
+
+        # the oldest frame is necessarily at the head of its flow
+        flow = self._datagram_flows[datagram.flow_id]
+        flow.datagrams.popleft()
+        if not flow.datagrams:
+            del self._datagram_flows[datagram.flow_id]
+
+        self._datagrams_pending_bytes -= datagram.size
+        self._datagrams_pending_count -= 1
+        return datagram.prefix + datagram.data, datagram.flow_id
+
     def _push_crypto_data(self) -> None:
         for epoch, buf in self._crypto_buffers.items():
             self._crypto_streams[epoch].sender.write(buf.data)
@@ -2914,6 +3193,16 @@ class QuicConnection:
         self._logger.debug("%s -> %s", self._state, state)
         self._state = state
 
+    def _stateless_reset_token(self, cid: bytes) -> bytes:
+        """
+        Return the stateless reset token for a local connection ID.
+        """
+        if self._configuration.stateless_reset_key is not None:
+            return derive_stateless_reset_token(
+                self._configuration.stateless_reset_key, cid
+            )
+        return os.urandom(STATELESS_RESET_TOKEN_SIZE)
+
     def _stream_can_receive(self, stream_id: int) -> bool:
         return stream_is_client_initiated(
             stream_id
@@ -2942,6 +3231,24 @@ class QuicConnection:
         if not self._streams_blocked_bidi and not self._streams_blocked_uni:
             self._streams_blocked_pending = False
 
+    def _update_application_vtimes(
+        self, datagram_bytes: int, datagrams_first: bool, stream_bytes: int
+    ) -> None:
+        configuration = self._configuration
+        self._datagram_vtime += datagram_bytes / configuration.datagram_weight
+        self._stream_vtime += stream_bytes / configuration.stream_weight
+
+        # a class which had the whole packet and sent nothing is idle,
+        # it must not accumulate credit
+        if datagrams_first and not datagram_bytes:
+            self._datagram_vtime = max(self._datagram_vtime, self._stream_vtime)
+        elif not datagrams_first and not stream_bytes:
+            self._stream_vtime = max(self._stream_vtime, self._datagram_vtime)
+
+        base = min(self._datagram_vtime, self._stream_vtime)
+        self._datagram_vtime -= base
+        self._stream_vtime -= base
+
     def _update_traffic_key(
         self,
         direction: tls.Direction,
@@ -3025,6 +3332,11 @@ class QuicConnection:
                     self._write_handshake_done_frame(builder=builder)
                     self._handshake_done_pending = False
 
+                # NEW_TOKEN
+                for token in self._new_tokens_pending[:]:
+                    self._write_new_token_frame(builder=builder, token=token)
+                    self._new_tokens_pending.pop(0)
+
                 # PATH CHALLENGE
                 if not (network_path.is_validated or network_path.local_challenge_sent):
                     challenge = os.urandom(8)
@@ -3096,72 +3408,86 @@ class QuicConnection:
                     builder=builder, space=space, stream=crypto_stream
                 )
 
-            # DATAGRAM
-            while self._datagrams_pending:
-                try:
-                    self._write_datagram_frame(
-                        builder=builder,
-                        data=self._datagrams_pending[0],
-                        frame_type=QuicFrameType.DATAGRAM_WITH_LENGTH,
-                    )
-                    self._datagrams_pending.popleft()
-                except QuicPacketBuilderStop:
-                    break
-
-            sent: Set[QuicStream] = set()
-            discarded: Set[QuicStream] = set()
-            try:
-                for stream in self._streams_queue:
-                    # if the stream is finished, discard it
-                    if stream.is_finished:
-                        self._logger.debug("Stream %d discarded", stream.stream_id)
-                        self._streams.pop(stream.stream_id)
-                        self._streams_finished.add(stream.stream_id)
-                        discarded.add(stream)
-                        continue
-
-                    if stream.receiver.stop_pending:
-                        # STOP_SENDING
-                        self._write_stop_sending_frame(builder=builder, stream=stream)
-
-                    if stream.sender.reset_pending:
-                        # RESET_STREAM
-                        self._write_reset_stream_frame(builder=builder, stream=stream)
-                    elif not stream.is_blocked and not stream.sender.buffer_is_empty:
-                        # STREAM
-                        used = self._write_stream_frame(
-                            builder=builder,
-                            space=space,
-                            stream=stream,
-                            max_offset=min(
-                                stream.sender.highest_offset
-                                + self._remote_max_data
-                                - self._remote_max_data_used,
-                                stream.max_stream_data_remote,
-                            ),
-                        )
-                        self._remote_max_data_used += used
-                        if used > 0:
-                            sent.add(stream)
-
-            finally:
-                # Make a new stream service order, putting served ones at the end.
-                #
-                # This method of updating the streams queue ensures that discarded
-                # streams are removed and ones which sent are moved to the end even
-                # if an exception occurs in the loop.
-                self._streams_queue = [
-                    stream
-                    for stream in self._streams_queue
-                    if not (stream in discarded or stream in sent)
-                ]
-                self._streams_queue.extend(sent)
+            # DATAGRAM and STREAM, the class which is behind on its share of
+            # the bytes goes first, the other one uses the remaining space
+            datagrams_first = self._datagram_vtime <= self._stream_vtime
+            if datagrams_first:
+                datagram_bytes = self._write_datagram_frames(builder=builder)
+                stream_bytes = self._write_stream_frames(builder=builder, space=space)
+            else:
+                stream_bytes = self._write_stream_frames(builder=builder, space=space)
+                datagram_bytes = self._write_datagram_frames(builder=builder)
+            self._update_application_vtimes(
+                datagram_bytes=datagram_bytes,
+                datagrams_first=datagrams_first,
+                stream_bytes=stream_bytes,
+            )
 
             if builder.packet_is_empty:
                 break
             else:
                 self._loss._pacer.update_after_send(now=now)
 
+    def _write_stream_frames(
+        self, builder: QuicPacketBuilder, space: QuicPacketSpace
+    ) -> int:
+        """
+        Write STOP_SENDING, RESET_STREAM and STREAM frames for queued streams.
+
+        Returns the number of bytes of stream data which were written.
+        """
+        discarded: Set[QuicStream] = set()
+        sent: Set[QuicStream] = set()
+        total = 0
+        try:
+            for stream in self._streams_queue:
+                # if the stream is finished, discard it
+                if stream.is_finished:
+                    self._logger.debug("Stream %d discarded", stream.stream_id)
+                    self._streams.pop(stream.stream_id)
+                    self._streams_finished.add(stream.stream_id)
+                    discarded.add(stream)
+                    continue
+
+                if stream.receiver.stop_pending:
+                    # STOP_SENDING
+                    self._write_stop_sending_frame(builder=builder, stream=stream)
+
+                if stream.sender.reset_pending:
+                    # RESET_STREAM
+                    self._write_reset_stream_frame(builder=builder, stream=stream)
+                elif not stream.is_blocked and not stream.sender.buffer_is_empty:
+                    # STREAM
+                    used = self._write_stream_frame(
+                        builder=builder,
+                        space=space,
+                        stream=stream,
+                        max_offset=min(
+                            stream.sender.highest_offset
+                            + self._remote_max_data
+                            - self._remote_max_data_used,
+                            stream.max_stream_data_remote,
+                        ),
+                    )
+                    self._remote_max_data_used += used
+                    if used > 0:
+                        sent.add(stream)
+                        total += used
+
+        finally:
+            # Make a new stream service order, putting served ones at the end.
+            #
+            # This method of updating the streams queue ensures that discarded
+            # streams are removed and ones which sent are moved to the end even
+            # if an exception occurs in the loop.
+            self._streams_queue = [
+                stream
+                for stream in self._streams_queue
+                if not (stream in discarded or stream in sent)
+            ]
+            self._streams_queue.extend(sent)
+        return total
+
     def _write_handshake(
         self, builder: QuicPacketBuilder, epoch: tls.Epoch, now: float
     ) -> None:
@@ -3336,8 +3662,74 @@ class QuicConnection:
 
         return False
 
+    def _write_datagram_frames(self, builder: QuicPacketBuilder) -> int:
+        """
+        Write queued DATAGRAM frames, serving the flows using deficit round robin.
+
+        When the next frame of a flow does not fit in the packet, the other
+        flows get to fill the remaining space, and the flow is served first in
+        the next packet.
+
+        Returns the number of bytes of datagram data which were written.
+        """
+        flows = self._datagram_flows
+        max_size = self.max_datagram_frame_data_size
+        quantum = self._configuration.datagram_quantum
+        blocked: Dict[Optional[int], QuicDatagramFlow] = {}
+        total = 0
+        while flows:
+            flow_id = next(iter(flows))
+            flow = flows[flow_id]
+            datagram = flow.datagrams[0]
+            size = datagram.size
+            if max_size is not None and size > max_size:
+                # the frame was queued before the peer's limit was known
+                self._drop_datagram(datagram.prefix + datagram.data, flow_id)
+            else:
+                if size > flow.deficit:
+                    # the flow used its share for this round, move it to the end
+                    flow.deficit += quantum
+                    del flows[flow_id]
+                    flows[flow_id] = flow
+                    continue
+
+                try:
+                    self._write_datagram_frame(
+                        builder=builder,
+                        data=datagram.data,
+                        frame_type=QuicFrameType.DATAGRAM_WITH_LENGTH,
+                        prefix=datagram.prefix,
+                    )
+                except QuicPacketBuilderStop:
+                    # the packet only has room for smaller frames
+                    blocked[flow_id] = flows.pop(flow_id)
+                    continue
+                flow.deficit -= size
+                total += size
+
+            flow.datagrams.popleft()
+            if not flow.datagrams:
+                del flows[flow_id]
+            datagram.done = True
+            self._datagrams_pending_bytes -= size
+            self._datagrams_pending_count -= 1
+
+        # flows which did not fit keep their order for the next packet
+        flows.update(blocked)
+
+        # forget frames which were sent
+        pending = self._datagrams_pending
+        while pending and pending[0].done:
+            pending.popleft()
+
+        return total
+
     def _write_datagram_frame(
-        self, builder: QuicPacketBuilder, data: bytes, frame_type: QuicFrameType
+        self,
+        builder: QuicPacketBuilder,
+        data: bytes,
+        frame_type: QuicFrameType,
+        prefix: bytes = b"",
     ) -> bool:
         """
         Write a DATAGRAM frame.
@@ -3345,11 +3737,13 @@ class QuicConnection:
         Returns True if the frame was processed, False otherwise.
         """
         assert frame_type == QuicFrameType.DATAGRAM_WITH_LENGTH
-        length = len(data)
+        length = len(prefix) + len(data)
         frame_size = 1 + size_uint_var(length) + length
 
         buf = builder.start_frame(frame_type, capacity=frame_size)
         buf.push_uint_var(length)
+        if prefix:
+            buf.push_bytes(prefix)
         buf.push_bytes(data)
 
         # log frame
@@ -3404,6 +3798,22 @@ class QuicConnection:
                 )
             )
 
+    def _write_new_token_frame(self, builder: QuicPacketBuilder, token: bytes) -> None:
+        buf = builder.start_frame(
+            QuicFrameType.NEW_TOKEN,
+            capacity=NEW_TOKEN_FRAME_CAPACITY + len(token),
+            handler=self._on_new_token_delivery,
+            handler_args=(token,),
+        )
+        buf.push_uint_var(len(token))
+        buf.push_bytes(token)
+
+        # log frame
+        if self._quic_logger is not None:
+            builder.quic_logger_frames.append(
+                self._quic_logger.encode_new_token_frame(token=token)
+            )
+
     def _write_path_challenge_frame(
         self, builder: QuicPacketBuilder, challenge: bytes
     ) -> None:
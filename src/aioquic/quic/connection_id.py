@@ -0,0 +1,167 @@
+import hashlib
+import hmac
+import os
+from typing import Optional
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# QUIC-LB reserves the config rotation codepoint 0b111 for unroutable IDs
+QUIC_LB_MAX_CONFIG_ID = 6
+
+
+def derive_stateless_reset_token(key: bytes, cid: bytes) -> bytes:
+    """
+    Derive the stateless reset token for the connection ID `cid` from `key`.
+
+    An endpoint which lost the state of a connection can compute the token
+    again from the connection ID to reset the connection.
+    """
+    return hmac.new(key, cid, hashlib.sha256).digest()[:16]
+
+
+class ConnectionIdGenerator:
+    """
+    Generates the connection IDs a QUIC endpoint issues to its peer.
+
+    The default implementation returns random bytes. Subclasses can encode
+    routing information, so that a load balancer or a sharded server can
+    find the process which owns a connection without sharing state.
+    """
+
+    def generate(self, length: int) -> bytes:
+        """
+        Return a new connection ID of `length` bytes.
+        """
+        return os.urandom(length)
+
+
+class QuicLbConnectionIdGenerator(ConnectionIdGenerator):
+    """
+    Generates connection IDs carrying an encrypted server ID, following the
+    QUIC-LB draft.
+
+    Each connection ID consists of a first octet holding the configuration
+    ID and the length of the connection ID, followed by the server ID and a
+    random nonce. When a `key` is provided, the server ID and nonce are
+    encrypted with AES-128, in a single pass if they add up to 16 bytes and
+    using a four-pass Feistel network otherwise.
+
+    The load balancer uses the same parameters and :meth:`decode_server_id`
+    to route packets.
+
+    :param server_id: The server ID to encode, from 1 to 15 bytes.
+    :param nonce_length: The length of the random nonce, from 4 to 18 bytes.
+    :param key: A 16-byte AES key, or `None` to send the server ID in clear.
+    :param config_id: The configuration ID, from 0 to 6, which allows the
+                      load balancer to rotate keys.
+    """
+
+    def __init__(
+        self,
+        *,
+        server_id: bytes,
+        nonce_length: int,
+        key: Optional[bytes] = None,
+        config_id: int = 0,
+    ) -> None:
+        if not 1 <= len(server_id) <= 15:
+            raise ValueError("Server ID must be between 1 and 15 bytes")
+        if not 4 <= nonce_length <= 18:
+            raise ValueError("Nonce must be between 4 and 18 bytes")
+        if len(server_id) + nonce_length > 19:
+            raise ValueError("Server ID and nonce cannot exceed 19 bytes")
+        if not 0 <= config_id <= QUIC_LB_MAX_CONFIG_ID:
+            raise ValueError("Configuration ID must be between 0 and 6")
+        if key is not None and len(key) != 16:
+            raise ValueError("Key must be 16 bytes")
+
+        self.config_id = config_id
+        self.length = 1 + len(server_id) + nonce_length
+        self.nonce_length = nonce_length
+        self.server_id = server_id
+
+        self._first_octet = (config_id << 5) | (self.length - 1)
+        self._plaintext_length = len(server_id) + nonce_length
+        self._half_length = (self._plaintext_length + 1) // 2
+        if key is not None:
+            self._cipher: Optional[Cipher] = Cipher(algorithms.AES(key), modes.ECB())
+        else:
+            self._cipher = None
+
+    def decode_server_id(self, cid: bytes) -> Optional[bytes]:
+        """
+        Return the server ID encoded in `cid`, or `None` if `cid` was not
+        generated with this configuration.
+        """
+        if len(cid) != self.length or cid[0] >> 5 != self.config_id:
+            return None
+        if self._cipher is None:
+            plaintext = cid[1:]
+        elif self._plaintext_length == 16:
+            decryptor = self._cipher.decryptor()
+            plaintext = decryptor.update(cid[1:]) + decryptor.finalize()
+        else:
+            plaintext = self._four_pass(cid[1:], decrypt=True)
+        return plaintext[: len(self.server_id)]
+
+    def generate(self, length: int) -> bytes:
+        assert length == self.length, (
+            f"QUIC-LB connection IDs are {self.length} bytes long, "
+            "set `connection_id_length` accordingly"
+        )
+        plaintext = self.server_id + os.urandom(self.nonce_length)
+        if self._cipher is None:
+            ciphertext = plaintext
+        elif self._plaintext_length == 16:
+            encryptor = self._cipher.encryptor()
+            ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        else:
+            ciphertext = self._four_pass(plaintext, decrypt=False)
+        return bytes([self._first_octet]) + ciphertext
+
+    def _expand(self, side: bytes, index: int) -> bytes:
+        encryptor = self._cipher.encryptor()
+        return encryptor.update(
+            side.ljust(14, b"\x00") + bytes([self._plaintext_length, index])
+        )
+
+    def _four_pass(self, data: bytes, decrypt: bool) -> bytes:
+        """
+        Run the four-pass Feistel network over `data`.
+
+        For odd lengths, the middle byte is split between both halves: the
+        left half keeps its high nibble and the right half its low nibble.
+        """
+        half = self._half_length
+        odd = self._plaintext_length % 2 == 1
+
+        def mask_left(value: bytearray) -> bytearray:
+            if odd:
+                value[-1] &= 0xF0
+            return value
+
+        def mask_right(value: bytearray) -> bytearray:
+            if odd:
+                value[0] &= 0x0F
+            return value
+
+        def xor(target: bytearray, side: bytearray, index: int) -> bytearray:
+            pad = self._expand(bytes(side), index)
+            return bytearray(a ^ b for a, b in zip(target, pad[:half]))
+
+        left = mask_left(bytearray(data[:half]))
+        right = mask_right(bytearray(data[self._plaintext_length - half :]))
+        if decrypt:
+            left = mask_left(xor(left, right, 4))
+            right = mask_right(xor(right, left, 3))
+            left = mask_left(xor(left, right, 2))
+            right = mask_right(xor(right, left, 1))
+        else:
+            right = mask_right(xor(right, left, 1))
+            left = mask_left(xor(left, right, 2))
+            right = mask_right(xor(right, left, 3))
+            left = mask_left(xor(left, right, 4))
+
+        if odd:
+            return bytes(left[:-1] + bytes([left[-1] | right[0]]) + right[1:])
+        return bytes(left + right)
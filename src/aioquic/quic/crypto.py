@@ -9,6 +9,7 @@ from .packet import (
     is_long_header,
 )
 
+AEAD_TAG_SIZE = 16
 CIPHER_SUITES = {
     CipherSuite.AES_128_GCM_SHA256: (b"aes-128-ecb", b"aes-128-gcm"),
     CipherSuite.AES_256_GCM_SHA384: (b"aes-256-ecb", b"aes-256-gcm"),
@@ -176,7 +177,7 @@ class CryptoPair:
         send_setup_cb: Callback = NoCallback,
         send_teardown_cb: Callback = NoCallback,
     ) -> None:
-        self.aead_tag_size = 16
+        self.aead_tag_size = AEAD_TAG_SIZE
         self.recv = CryptoContext(setup_cb=recv_setup_cb, teardown_cb=recv_teardown_cb)
         self.send = CryptoContext(setup_cb=send_setup_cb, teardown_cb=send_teardown_cb)
         self._update_key_requested = False
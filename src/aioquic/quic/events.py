@@ -36,6 +36,21 @@ class ConnectionTerminated(QuicEvent):
     "The human-readable reason for which the connection was closed."
 
 
+@dataclass
+class DatagramFrameDropped(QuicEvent):
+    """
+    The DatagramFrameDropped event is fired when a DATAGRAM frame is removed
+    from the send queue without being sent, because the queue was full or
+    the frame expired.
+    """
+
+    data: bytes
+    "The data which was dropped."
+
+    flow_id: Optional[int] = None
+    "The flow the frame belonged to, or `None`."
+
+
 @dataclass
 class DatagramFrameReceived(QuicEvent):
     """
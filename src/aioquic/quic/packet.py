@@ -21,6 +21,7 @@ RETRY_AEAD_KEY_VERSION_2 = binascii.unhexlify("8fb4b01b56ac48e260fbcbcead7ccc92"
 RETRY_AEAD_NONCE_VERSION_1 = binascii.unhexlify("461599d35d632bf2239825bb")
 RETRY_AEAD_NONCE_VERSION_2 = binascii.unhexlify("d86969bc2d7c6d9990efb04a")
 RETRY_INTEGRITY_TAG_SIZE = 16
+STATELESS_RESET_MIN_SIZE = 21
 STATELESS_RESET_TOKEN_SIZE = 16
 
 
@@ -314,6 +315,20 @@ def encode_quic_retry(
     return buf.data
 
 
+def encode_quic_stateless_reset(size: int, stateless_reset_token: bytes) -> bytes:
+    """
+    Encode a stateless reset of `size` bytes, which looks like a short header
+    packet ending with the stateless reset token.
+    """
+    assert size >= STATELESS_RESET_MIN_SIZE, "Stateless reset is too short"
+    unpredictable = os.urandom(size - STATELESS_RESET_TOKEN_SIZE)
+    return (
+        bytes([(unpredictable[0] & ~PACKET_LONG_HEADER) | PACKET_FIXED_BIT])
+        + unpredictable[1:]
+        + stateless_reset_token
+    )
+
+
 def encode_quic_version_negotiation(
     source_cid: bytes, destination_cid: bytes, supported_versions: List[int]
 ) -> bytes:
@@ -127,6 +127,10 @@ class QuicPacketRecovery:
     def congestion_window(self) -> int:
         return self._cc.congestion_window
 
+    @property
+    def smoothed_rtt(self) -> float:
+        return self._rtt_smoothed if self._rtt_initialized else self._rtt_initial
+
     def discard_space(self, space: QuicPacketSpace) -> None:
         assert space in self.spaces
 
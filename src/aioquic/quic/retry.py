@@ -1,53 +1,206 @@
+import hashlib
 import ipaddress
-from typing import Tuple
+import os
+import time
+from typing import Dict, List, Optional, Tuple
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-from ..buffer import Buffer
+from ..buffer import Buffer, BufferReadError
 from ..tls import pull_opaque, push_opaque
 from .connection import NetworkAddress
 
+MAX_USED_NEW_TOKENS = 4096
+NEW_TOKEN_LIFETIME = 86400.0
+RETRY_TOKEN_KEY_SIZE = 32
+RETRY_TOKEN_LIFETIME = 10.0
+RETRY_TOKEN_NONCE_SIZE = 12
+
+# the first byte of a token tells which kind of token it is
+TOKEN_TYPE_RETRY = 0
+TOKEN_TYPE_NEW_TOKEN = 1
+TOKEN_HEADER_SIZE = 2 + RETRY_TOKEN_NONCE_SIZE
+
 
 def encode_address(addr: NetworkAddress) -> bytes:
     return ipaddress.ip_address(addr[0]).packed + bytes([addr[1] >> 8, addr[1] & 0xFF])
 
 
+def is_new_token(token: bytes) -> bool:
+    """
+    Return whether `token` looks like a token issued in a NEW_TOKEN frame,
+    as opposed to a Retry packet.
+    """
+    return token[:1] == bytes([TOKEN_TYPE_NEW_TOKEN])
+
+
 class QuicRetryTokenHandler:
-    def __init__(self) -> None:
-        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    """
+    Creates and validates address validation tokens, sent either in Retry
+    packets or in NEW_TOKEN frames for future connections.
+
+    Tokens are encrypted and authenticated with AES-GCM and carry the time
+    at which they were issued, so servers can validate them without keeping
+    any state. Servers which share the same `key` validate each other's
+    tokens.
+
+    NEW_TOKEN tokens are valid for a single connection: the handler
+    remembers up to `max_used_new_tokens` accepted tokens and rejects their
+    reuse. When it must forget an unexpired token, all the tokens issued
+    until then are rejected. Reuse is only detected by the handler which
+    accepted the token, not by other servers sharing its key.
+
+    :param key: A 32-byte key, defaults to a random key.
+    :param lifetime: The time in seconds after which Retry tokens expire.
+    :param new_token_lifetime: The time in seconds after which NEW_TOKEN
+                               tokens expire.
+    :param max_used_new_tokens: The number of accepted NEW_TOKEN tokens
+                                which are remembered.
+    """
+
+    def __init__(
+        self,
+        key: Optional[bytes] = None,
+        lifetime: float = RETRY_TOKEN_LIFETIME,
+        new_token_lifetime: float = NEW_TOKEN_LIFETIME,
+        max_used_new_tokens: int = MAX_USED_NEW_TOKENS,
+    ) -> None:
+        self.lifetime = lifetime
+        self.new_token_lifetime = new_token_lifetime
+        self._keys: List[Tuple[int, AESGCM]] = []
+        self._max_used_new_tokens = max_used_new_tokens
+        self._used_new_tokens: Dict[bytes, float] = {}
+        self._used_new_tokens_floor = 0.0
+        self.rotate_key(key)
+
+    def create_new_token(
+        self, addr: NetworkAddress, now: Optional[float] = None
+    ) -> bytes:
+        """
+        Create a token to send in a NEW_TOKEN frame.
+
+        The token is bound to the client's IP address but not its port, which
+        usually changes between connections.
+        """
+        if now is None:
+            now = time.time()
+
+        buf = Buffer(capacity=32)
+        buf.push_uint64(int(now * 1000))
+        push_opaque(buf, 1, ipaddress.ip_address(addr[0]).packed)
+        return self._seal(TOKEN_TYPE_NEW_TOKEN, buf.data)
 
     def create_token(
         self,
         addr: NetworkAddress,
         original_destination_connection_id: bytes,
         retry_source_connection_id: bytes,
+        now: Optional[float] = None,
     ) -> bytes:
-        buf = Buffer(capacity=512)
+        if now is None:
+            now = time.time()
+
+        buf = Buffer(capacity=64)
+        buf.push_uint64(int(now * 1000))
         push_opaque(buf, 1, encode_address(addr))
         push_opaque(buf, 1, original_destination_connection_id)
         push_opaque(buf, 1, retry_source_connection_id)
-        return self._key.public_key().encrypt(
-            buf.data,
-            padding.OAEP(
-                mgf=padding.MGF1(hashes.SHA256()), algorithm=hashes.SHA256(), label=None
-            ),
-        )
-
-    def validate_token(self, addr: NetworkAddress, token: bytes) -> Tuple[bytes, bytes]:
-        buf = Buffer(
-            data=self._key.decrypt(
-                token,
-                padding.OAEP(
-                    mgf=padding.MGF1(hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None,
-                ),
-            )
-        )
-        encoded_addr = pull_opaque(buf, 1)
-        original_destination_connection_id = pull_opaque(buf, 1)
-        retry_source_connection_id = pull_opaque(buf, 1)
+        return self._seal(TOKEN_TYPE_RETRY, buf.data)
+
+    def rotate_key(self, key: Optional[bytes] = None) -> None:
+        """
+        Start issuing tokens with a new key.
+
+        Tokens issued with the previous key remain valid until they expire,
+        so servers sharing a key should rotate it at least `lifetime` seconds
+        apart. NEW_TOKEN tokens issued before the previous rotation are
+        rejected, and the clients presenting them go through a Retry.
+
+        :param key: A 32-byte key, defaults to a random key.
+        """
+        if key is None:
+            key = os.urandom(RETRY_TOKEN_KEY_SIZE)
+        elif len(key) != RETRY_TOKEN_KEY_SIZE:
+            raise ValueError("Retry token key must be %d bytes" % RETRY_TOKEN_KEY_SIZE)
+
+        key_id = hashlib.sha256(key).digest()[0]
+        self._keys = [(key_id, AESGCM(key))] + self._keys[:1]
+
+    def validate_new_token(
+        self, addr: NetworkAddress, token: bytes, now: Optional[float] = None
+    ) -> None:
+        """
+        Validate a token sent by a client which received it in a NEW_TOKEN frame.
+
+        Raises `ValueError` if the token is not valid or was already used.
+        """
+        if now is None:
+            now = time.time()
+
+        try:
+            buf = Buffer(data=self._open(TOKEN_TYPE_NEW_TOKEN, token))
+            issued_at = buf.pull_uint64() / 1000
+            encoded_addr = pull_opaque(buf, 1)
+        except BufferReadError:
+            raise ValueError("Token is invalid.")
+        if now - issued_at > self.new_token_lifetime:
+            raise ValueError("Token has expired.")
+        if encoded_addr != ipaddress.ip_address(addr[0]).packed:
+            raise ValueError("Remote address does not match.")
+
+        # tokens are identified by their nonce
+        nonce = token[2:TOKEN_HEADER_SIZE]
+        if issued_at <= self._used_new_tokens_floor or nonce in self._used_new_tokens:
+            raise ValueError("Token has already been used.")
+        if len(self._used_new_tokens) >= self._max_used_new_tokens:
+            for expired in [
+                k
+                for k, v in self._used_new_tokens.items()
+                if now - v > self.new_token_lifetime
+            ]:
+                del self._used_new_tokens[expired]
+            while len(self._used_new_tokens) >= self._max_used_new_tokens:
+                oldest = next(iter(self._used_new_tokens))
+                self._used_new_tokens_floor = max(
+                    self._used_new_tokens_floor, self._used_new_tokens.pop(oldest)
+                )
+        self._used_new_tokens[nonce] = issued_at
+
+    def validate_token(
+        self, addr: NetworkAddress, token: bytes, now: Optional[float] = None
+    ) -> Tuple[bytes, bytes]:
+        if now is None:
+            now = time.time()
+
+        try:
+            buf = Buffer(data=self._open(TOKEN_TYPE_RETRY, token))
+            issued_at = buf.pull_uint64() / 1000
+            encoded_addr = pull_opaque(buf, 1)
+            original_destination_connection_id = pull_opaque(buf, 1)
+            retry_source_connection_id = pull_opaque(buf, 1)
+        except BufferReadError:
+            raise ValueError("Token is invalid.")
+        if now - issued_at > self.lifetime:
+            raise ValueError("Token has expired.")
         if encoded_addr != encode_address(addr):
             raise ValueError("Remote address does not match.")
         return original_destination_connection_id, retry_source_connection_id
+
+    def _open(self, token_type: int, token: bytes) -> bytes:
+        if len(token) > TOKEN_HEADER_SIZE and token[0] == token_type:
+            nonce = token[2:TOKEN_HEADER_SIZE]
+            for key_id, aead in self._keys:
+                if key_id == token[1]:
+                    try:
+                        return aead.decrypt(
+                            nonce, token[TOKEN_HEADER_SIZE:], token[:1]
+                        )
+                    except InvalidTag:
+                        pass
+        raise ValueError("Token is invalid.")
+
+    def _seal(self, token_type: int, data: bytes) -> bytes:
+        key_id, aead = self._keys[0]
+        header = bytes([token_type, key_id]) + os.urandom(RETRY_TOKEN_NONCE_SIZE)
+        return header + aead.encrypt(header[2:], data, header[:1])
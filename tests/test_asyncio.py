@@ -3,15 +3,23 @@ import binascii
 import contextlib
 import random
 import socket
+import sys
+import tempfile
 from typing import AsyncGenerator, Optional
 from unittest import TestCase, skipIf
 from unittest.mock import patch
 
 from aioquic.asyncio.client import connect
+from aioquic.asyncio.offload import UdpOffload
 from aioquic.asyncio.protocol import QuicConnectionProtocol
-from aioquic.asyncio.server import serve
+from aioquic.asyncio.router import QuicWorkerRouter
+from aioquic.asyncio.server import STATELESS_RESET_MAX_RATE, QuicServer, serve
 from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.connection_id import QuicLbConnectionIdGenerator
 from aioquic.quic.logger import QuicLogger
+from aioquic.quic.packet import pull_quic_header
+from aioquic.quic.retry import QuicRetryTokenHandler
 from cryptography.hazmat.primitives import serialization
 
 from .utils import (
@@ -228,6 +236,24 @@ class HighLevelTest(TestCase):
             response = await self.run_client(port=server_port, request=data)
             self.assertEqual(response, data)
 
+    @skipIf(not sys.platform.startswith("linux"), "UDP offloads require Linux")
+    @asynctest
+    async def test_connect_and_serve_large_with_udp_offload(self):
+        data = b"Z" * 2097152
+        with patch.object(
+            UdpOffload, "send", autospec=True, side_effect=UdpOffload.send
+        ) as mock_send:
+            async with self.run_server(udp_offload=True) as server_port:
+                response = await self.run_client(
+                    port=server_port, request=data, udp_offload=True
+                )
+                self.assertEqual(response, data)
+
+        # datagrams were handed to the offload in batches
+        self.assertGreater(mock_send.call_count, 0)
+        self.assertGreater(max(len(call[0][1]) for call in mock_send.call_args_list), 1)
+        self.assertTrue(all(call[0][0]._gso for call in mock_send.call_args_list))
+
     @asynctest
     async def test_connect_and_serve_without_client_configuration(self):
         async with self.run_server() as server_port:
@@ -311,6 +337,51 @@ class HighLevelTest(TestCase):
             response = await self.run_client(port=server_port)
             self.assertEqual(response, b"gnip")
 
+    @asynctest
+    async def test_connect_and_serve_with_retry_token_handler(self):
+        handler = QuicRetryTokenHandler(key=b"k" * 32)
+        async with self.run_server(retry_token_handler=handler) as server_port:
+            with patch.object(
+                handler, "validate_token", wraps=handler.validate_token
+            ) as mock_validate:
+                response = await self.run_client(port=server_port)
+            self.assertEqual(response, b"gnip")
+            self.assertEqual(mock_validate.call_count, 1)
+
+    @asynctest
+    async def test_connect_and_serve_with_retry_new_token(self):
+        handler = QuicRetryTokenHandler()
+        async with self.run_server(retry_token_handler=handler) as server_port:
+            # the first connection goes through a retry and receives a token
+            tokens = []
+            response = await self.run_client(
+                port=server_port, token_handler=tokens.append
+            )
+            self.assertEqual(response, b"gnip")
+            self.assertEqual(len(tokens), 1)
+
+            # the next connection presents the token and skips the retry
+            with patch.object(
+                handler, "validate_token", wraps=handler.validate_token
+            ) as mock_validate:
+                response = await self.run_client(
+                    configuration=QuicConfiguration(is_client=True, token=tokens[0]),
+                    port=server_port,
+                )
+            self.assertEqual(response, b"gnip")
+            self.assertEqual(mock_validate.call_count, 0)
+
+            # presenting the same token again goes through a retry
+            with patch.object(
+                handler, "validate_token", wraps=handler.validate_token
+            ) as mock_validate:
+                response = await self.run_client(
+                    configuration=QuicConfiguration(is_client=True, token=tokens[0]),
+                    port=server_port,
+                )
+            self.assertEqual(response, b"gnip")
+            self.assertEqual(mock_validate.call_count, 1)
+
     @asynctest
     async def test_connect_and_serve_with_retry_bad_original_destination_connection_id(
         self,
@@ -373,6 +444,54 @@ class HighLevelTest(TestCase):
             )
             self.assertEqual(response, b"gnip")
 
+    @skipIf(not hasattr(socket, "AF_UNIX"), "Unix sockets are not available")
+    @asynctest
+    async def test_connect_and_serve_with_workers(self) -> None:
+        with tempfile.TemporaryDirectory() as socket_dir:
+            routers = [
+                QuicWorkerRouter(index=index, workers=2, socket_dir=socket_dir)
+                for index in range(2)
+            ]
+            async with self.run_server(router=routers[0]) as server_port:
+                async with self.run_server(router=routers[1]) as other_port:
+                    configuration = QuicConfiguration(is_client=True)
+                    configuration.load_verify_locations(cafile=SERVER_CACERTFILE)
+                    async with connect(
+                        self.server_host, server_port, configuration=configuration
+                    ) as client:
+                        await client.ping()
+
+                        # datagrams which reach the other worker are forwarded
+                        transport = client._transport
+                        sendto = transport.sendto
+
+                        def sendto_other(data, addr):
+                            sendto(data, (addr[0], other_port) + tuple(addr[2:]))
+
+                        with patch.object(transport, "sendto", sendto_other):
+                            await asyncio.wait_for(client.ping(), 5)
+
+            self.assertGreater(routers[1].datagrams_forwarded, 0)
+            self.assertEqual(
+                routers[0].datagrams_received, routers[1].datagrams_forwarded
+            )
+
+    @asynctest
+    async def test_serve_with_router_and_connection_id_generator(self) -> None:
+        configuration = QuicConfiguration(
+            connection_id_generator=QuicLbConnectionIdGenerator(
+                server_id=b"\x01", nonce_length=7
+            ),
+            is_client=False,
+        )
+        router = QuicWorkerRouter(index=0, workers=2, socket_dir="/nonexistent")
+        with self.assertRaises(ValueError) as cm:
+            QuicServer(configuration=configuration, router=router)
+        self.assertEqual(
+            str(cm.exception),
+            "A router cannot be combined with a custom connection ID generator",
+        )
+
     @asynctest
     async def test_connect_timeout(self) -> None:
         with self.assertRaises(ConnectionError):
@@ -440,6 +559,25 @@ class HighLevelTest(TestCase):
                 await client.ping()
                 await client.ping()
 
+    @asynctest
+    async def test_ping_short_header_fast_path(self) -> None:
+        async with self.run_server() as server_port:
+            configuration = QuicConfiguration(is_client=True)
+            configuration.load_verify_locations(cafile=SERVER_CACERTFILE)
+            async with connect(
+                self.server_host, server_port, configuration=configuration
+            ) as client:
+                await client.ping()
+
+                # short header packets are routed without parsing the header
+                with patch(
+                    "aioquic.asyncio.server.pull_quic_header",
+                    side_effect=pull_quic_header,
+                ) as mock_pull:
+                    await client.ping()
+                    await client.ping()
+                self.assertEqual(mock_pull.call_count, 0)
+
     @asynctest
     async def test_ping_parallel(self) -> None:
         async with self.run_server() as server_port:
@@ -463,6 +601,176 @@ class HighLevelTest(TestCase):
         server.datagram_received(binascii.unhexlify("c00000000080"), ("1.2.3.4", 1234))
         server.close()
 
+    def client_initial(self) -> bytes:
+        client = QuicConnection(configuration=QuicConfiguration(is_client=True))
+        client.connect(("::1", 4433), now=0.0)
+        return client.datagrams_to_send(now=0.0)[0][0]
+
+    @asynctest
+    async def test_server_max_connections(self) -> None:
+        configuration = QuicConfiguration(is_client=False)
+        configuration.load_cert_chain(SERVER_CERTFILE, SERVER_KEYFILE)
+        server = await serve(
+            host="::",
+            port=0,
+            configuration=configuration,
+            max_connections=1,
+            stream_handler=handle_stream,
+        )
+        try:
+            server_port = server._transport.get_extra_info("sockname")[1]
+            client_configuration = QuicConfiguration(is_client=True)
+            client_configuration.load_verify_locations(cafile=SERVER_CACERTFILE)
+            with patch("aioquic.asyncio.server.COMPACTION_THRESHOLD", 1):
+                async with connect(
+                    self.server_host, server_port, configuration=client_configuration
+                ) as client:
+                    await client.ping()
+                    self.assertEqual(server.connections, 1)
+                    protocol = next(iter(server._connection_ids))
+                    protocols = server._protocols
+
+                    # further connections are refused
+                    server.datagram_received(
+                        self.client_initial(), ("::1", 1234, 0, 0)
+                    )
+                    self.assertEqual(server.connections, 1)
+                    self.assertEqual(server.initials_accepted, 1)
+                    self.assertEqual(server.initials_dropped, 1)
+
+                # the connection's IDs are removed when it terminates
+                for i in range(100):
+                    if not server.connections:
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(server.connections, 0)
+                self.assertEqual(server._protocols, {})
+                self.assertIsNot(server._protocols, protocols)
+
+                # late callbacks of the terminated connection are ignored
+                server._connection_id_issued(b"\x01" * 8, protocol)
+                server._connection_id_retired(b"\x02" * 8, protocol)
+                self.assertEqual(server._protocols, {})
+                self.assertEqual(server.connections, 0)
+        finally:
+            server.close()
+
+    @asynctest
+    async def test_server_max_handshakes(self) -> None:
+        configuration = QuicConfiguration(is_client=False)
+        configuration.load_cert_chain(SERVER_CERTFILE, SERVER_KEYFILE)
+        server = await serve(
+            host="::", port=0, configuration=configuration, max_handshakes=1
+        )
+        try:
+            server.datagram_received(self.client_initial(), ("::1", 1234, 0, 0))
+            self.assertEqual(server.handshakes_pending, 1)
+            self.assertEqual(server.initials_accepted, 1)
+
+            # further handshakes are shed
+            server.datagram_received(self.client_initial(), ("::1", 1235, 0, 0))
+            self.assertEqual(server.handshakes_pending, 1)
+            self.assertEqual(server.initials_accepted, 1)
+            self.assertEqual(server.initials_dropped, 1)
+            self.assertEqual(server.initials_retried, 0)
+
+            # a connection terminated during its handshake is counted once
+            protocol = next(iter(server._connection_ids))
+            protocol._connection_terminated_handler()
+            self.assertEqual(server.handshakes_pending, 0)
+            protocol._handshake_completed_handler()
+            protocol._connection_terminated_handler()
+            self.assertEqual(server.handshakes_pending, 0)
+        finally:
+            server.close()
+
+    @asynctest
+    async def test_server_retry_threshold(self) -> None:
+        configuration = QuicConfiguration(is_client=False)
+        configuration.load_cert_chain(SERVER_CERTFILE, SERVER_KEYFILE)
+        server = await serve(
+            host="::",
+            port=0,
+            configuration=configuration,
+            retry_threshold=1,
+            stream_handler=handle_stream,
+        )
+        try:
+            # below the threshold, no retry is required
+            server.datagram_received(self.client_initial(), ("::1", 1234, 0, 0))
+            self.assertEqual(server.handshakes_pending, 1)
+            self.assertEqual(server.initials_accepted, 1)
+            self.assertEqual(server.initials_retried, 0)
+
+            # at the threshold, a retry is required
+            server.datagram_received(self.client_initial(), ("::1", 1235, 0, 0))
+            self.assertEqual(server.handshakes_pending, 1)
+            self.assertEqual(server.initials_accepted, 1)
+            self.assertEqual(server.initials_dropped, 0)
+            self.assertEqual(server.initials_retried, 1)
+
+            # the client answering the retry is accepted
+            server_port = server._transport.get_extra_info("sockname")[1]
+            response = await self.run_client(port=server_port)
+            self.assertEqual(response, b"gnip")
+            self.assertEqual(server.initials_accepted, 2)
+            self.assertEqual(server.initials_retried, 2)
+
+            # its handshake completed, only the first one is pending
+            self.assertEqual(server.handshakes_pending, 1)
+        finally:
+            server.close()
+
+    @asynctest
+    async def test_server_stateless_reset(self) -> None:
+        configuration = QuicConfiguration(
+            is_client=False, stateless_reset_key=b"secret"
+        )
+        configuration.load_cert_chain(SERVER_CERTFILE, SERVER_KEYFILE)
+        server = await serve(
+            host="::", port=0, configuration=configuration, stream_handler=handle_stream
+        )
+        try:
+            server_port = server._transport.get_extra_info("sockname")[1]
+            client_configuration = QuicConfiguration(is_client=True)
+            client_configuration.load_verify_locations(cafile=SERVER_CACERTFILE)
+            async with connect(
+                self.server_host, server_port, configuration=client_configuration
+            ) as client:
+                await client.ping()
+
+                # the server loses the connection's state
+                server._protocols.clear()
+                with self.assertRaises(ConnectionError):
+                    await asyncio.wait_for(client.ping(), 5)
+                self.assertEqual(
+                    client._quic._close_event.reason_phrase, "Stateless reset"
+                )
+            self.assertEqual(server.stateless_resets_sent, 1)
+        finally:
+            server.close()
+
+    @asynctest
+    async def test_server_stateless_reset_rate_limit(self) -> None:
+        configuration = QuicConfiguration(
+            is_client=False, stateless_reset_key=b"secret"
+        )
+        configuration.load_cert_chain(SERVER_CERTFILE, SERVER_KEYFILE)
+        server = await serve(host="::", port=0, configuration=configuration)
+        try:
+            for i in range(STATELESS_RESET_MAX_RATE + 10):
+                server.datagram_received(
+                    b"\x40" + bytes(48), ("::1", 1234, 0, 0)
+                )
+            self.assertEqual(server.stateless_resets_sent, STATELESS_RESET_MAX_RATE)
+
+            # packets too short to be answered with a smaller reset
+            server._stateless_reset_window = 0.0
+            server.datagram_received(b"\x40" + bytes(20), ("::1", 1234, 0, 0))
+            self.assertEqual(server.stateless_resets_sent, STATELESS_RESET_MAX_RATE)
+        finally:
+            server.close()
+
     @asynctest
     async def test_combined_key(self) -> None:
         config1 = QuicConfiguration()
@@ -16,9 +16,14 @@ from aioquic.quic.connection import (
     NetworkAddress,
     QuicConnection,
     QuicConnectionError,
+    QuicConnectionState,
     QuicNetworkPath,
     QuicReceiveContext,
 )
+from aioquic.quic.connection_id import (
+    QuicLbConnectionIdGenerator,
+    derive_stateless_reset_token,
+)
 from aioquic.quic.crypto import CryptoPair
 from aioquic.quic.logger import QuicLogger
 from aioquic.quic.packet import (
@@ -29,6 +34,7 @@ from aioquic.quic.packet import (
     QuicTransportParameters,
     QuicVersionInformation,
     encode_quic_retry,
+    encode_quic_stateless_reset,
     encode_quic_version_negotiation,
     push_quic_transport_parameters,
 )
@@ -1125,6 +1131,33 @@ class QuicConnectionTest(TestCase):
                 sequence_numbers(client._peer_cid_available), [2, 3, 4, 5, 6, 7, 8]
             )
 
+    def test_change_connection_id_with_generator(self):
+        generator = QuicLbConnectionIdGenerator(
+            key=b"\x11" * 16, nonce_length=8, server_id=b"\x01\x02"
+        )
+        with client_and_server(
+            server_options={
+                "connection_id_generator": generator,
+                "connection_id_length": generator.length,
+            }
+        ) as (client, server):
+            # all the connection IDs issued by the server encode its ID
+            self.assertEqual(len(client._peer_cid_available), 7)
+            for connection_id in [client._peer_cid] + client._peer_cid_available:
+                self.assertEqual(len(connection_id.cid), 11)
+                self.assertEqual(
+                    generator.decode_server_id(connection_id.cid), b"\x01\x02"
+                )
+
+            # the client changes connection ID
+            client.change_connection_id()
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(transfer(server, client), 1)
+            self.assertEqual(
+                generator.decode_server_id(client._peer_cid_available[-1].cid),
+                b"\x01\x02",
+            )
+
     def test_change_connection_id_retransmit_new_connection_id(self):
         with client_and_server() as (client, server):
             self.assertEqual(
@@ -1260,6 +1293,287 @@ class QuicConnectionTest(TestCase):
                 self.assertEqual(type(event), events.DatagramFrameReceived)
                 self.assertEqual(event.data, payload)
 
+    def test_datagram_frame_drop_newest(self):
+        with client_and_server(
+            client_options={
+                "datagram_drop_policy": "drop-newest",
+                "max_datagram_frame_size": 65536,
+                "max_datagrams_pending": 3,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # queue 5 datagrams, the last 2 are dropped
+            for i in range(5):
+                client.send_datagram_frame(b"hello %d" % i)
+            self.assertEqual(client.datagrams_dropped, 2)
+            self.assertEqual(
+                [client.next_event(), client.next_event()],
+                [
+                    events.DatagramFrameDropped(data=b"hello 3"),
+                    events.DatagramFrameDropped(data=b"hello 4"),
+                ],
+            )
+
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(
+                [server.next_event().data for i in range(3)],
+                [b"hello 0", b"hello 1", b"hello 2"],
+            )
+
+    def test_datagram_frame_drop_oldest(self):
+        with client_and_server(
+            client_options={
+                "max_datagram_frame_size": 65536,
+                "max_datagrams_pending": 3,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # queue 5 datagrams, the first 2 are dropped
+            for i in range(5):
+                client.send_datagram_frame(b"hello %d" % i)
+            self.assertEqual(client.datagrams_dropped, 2)
+            self.assertEqual(
+                [client.next_event(), client.next_event()],
+                [
+                    events.DatagramFrameDropped(data=b"hello 0"),
+                    events.DatagramFrameDropped(data=b"hello 1"),
+                ],
+            )
+
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(
+                [server.next_event().data for i in range(3)],
+                [b"hello 2", b"hello 3", b"hello 4"],
+            )
+
+    def test_datagram_frame_flows(self):
+        with client_and_server(
+            client_options={"datagram_quantum": 2, "max_datagram_frame_size": 65536},
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # flows are served in round-robin order
+            for i in range(4):
+                client.send_datagram_frame(b"a%d" % i, flow_id=1)
+            for i in range(2):
+                client.send_datagram_frame(b"b%d" % i, flow_id=2)
+            self.assertEqual(client.datagrams_pending, 6)
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(client.datagrams_pending, 0)
+            self.assertEqual(
+                [server.next_event().data for i in range(6)],
+                [b"a0", b"b0", b"a1", b"b1", b"a2", b"a3"],
+            )
+
+    def test_datagram_frame_flows_deficit(self):
+        with client_and_server(
+            client_options={
+                "datagram_quantum": 1000,
+                "max_datagram_frame_size": 65536,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # flows get the same number of bytes per round
+            for i in range(4):
+                client.send_datagram_frame(b"A" * 1000, flow_id=1)
+            for i in range(20):
+                client.send_datagram_frame(b"B" * 100, flow_id=2)
+            transfer(client, server)
+
+            received = []
+            event = server.next_event()
+            while event is not None:
+                received.append(len(event.data))
+                event = server.next_event()
+            # frames of the second flow also fill the space the first leaves
+            self.assertEqual(
+                received, [1000] + [100] * 12 + [1000] + [100] * 8 + [1000] * 2
+            )
+
+    def test_datagram_frame_flows_fill_packet(self):
+        with client_and_server(
+            client_options={
+                "datagram_quantum": 2000,
+                "max_datagram_frame_size": 65536,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # smaller frames of other flows fill the space left in a packet
+            for i in range(2):
+                client.send_datagram_frame(b"A" * 600, flow_id=1)
+            for i in range(3):
+                client.send_datagram_frame(b"B" * 100, flow_id=2)
+            self.assertEqual(transfer(client, server), 2)
+
+            received = []
+            event = server.next_event()
+            while event is not None:
+                received.append(len(event.data))
+                event = server.next_event()
+            self.assertEqual(received, [600, 100, 100, 100, 600])
+
+    def test_datagram_frame_interleaved_with_stream(self):
+        payload = b"Z" * 1170
+
+        with client_and_server(
+            client_options={"max_datagram_frame_size": 65536},
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # queue 20 datagrams and some stream data
+            for i in range(20):
+                client.send_datagram_frame(payload)
+            stream_id = client.get_next_available_stream_id()
+            client.send_stream_data(stream_id, b"hello", end_stream=True)
+
+            # stream data is not stuck behind the datagrams
+            transfer(client, server)
+            received = []
+            event = server.next_event()
+            while event is not None:
+                received.append(type(event))
+                event = server.next_event()
+            self.assertEqual(
+                received[:3],
+                [
+                    events.DatagramFrameReceived,
+                    events.StreamDataReceived,
+                    events.DatagramFrameReceived,
+                ],
+            )
+
+    def test_datagram_frame_max_bytes(self):
+        with client_and_server(
+            client_options={
+                "max_datagram_frame_size": 65536,
+                "max_datagrams_pending_bytes": 1000,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # oldest datagrams are dropped to make room
+            client.send_datagram_frame(b"A" * 400)
+            client.send_datagram_frame(b"B" * 400)
+            client.send_datagram_frame(b"C" * 400)
+            self.assertEqual(client.datagrams_dropped, 1)
+            self.assertEqual(client._datagrams_pending_bytes, 800)
+
+            # datagrams which can never fit are dropped
+            client.send_datagram_frame(b"D" * 1001)
+            self.assertEqual(client.datagrams_dropped, 4)
+            self.assertEqual(client._datagrams_pending_bytes, 0)
+
+    def test_datagram_frame_max_age(self):
+        payload = b"Z" * 1170
+
+        with client_and_server(
+            client_options={
+                "datagram_max_age": 0.1,
+                "max_datagram_frame_size": 65536,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # queue 20 datagrams, only 11 are sent due to congestion control
+            for i in range(20):
+                client.send_datagram_frame(payload)
+            self.assertEqual(transfer(client, server), 11)
+
+            # the remaining datagrams expire
+            client.datagrams_to_send(now=time.time() + 0.2)
+            self.assertEqual(client.datagrams_dropped, 9)
+            self.assertEqual(len(client._datagrams_pending), 0)
+            self.assertEqual(client._datagrams_pending_bytes, 0)
+
+    def test_datagram_frame_max_data_size(self):
+        with client_and_server(
+            client_options={"max_datagram_frame_size": 65536},
+            server_options={"max_datagram_frame_size": 1000},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # limited by the space in a packet
+            self.assertEqual(server.max_datagram_frame_data_size, 1170)
+
+            # limited by the peer's transport parameter
+            self.assertEqual(client.max_datagram_frame_data_size, 997)
+
+            # frames which can never be sent are dropped
+            client.send_datagram_frame(b"A" * 998)
+            self.assertEqual(
+                client.next_event(), events.DatagramFrameDropped(data=b"A" * 998)
+            )
+            client.send_datagram_frame(b"B" * 997)
+            self.assertEqual(client.datagrams_pending, 1)
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(server.next_event().data, b"B" * 997)
+
+            # frames queued before the limit was known are dropped when sending
+            remote_max_datagram_frame_size = client._remote_max_datagram_frame_size
+            client._remote_max_datagram_frame_size = None
+            client.send_datagram_frame(b"C" * 998, flow_id=1)
+            client.send_datagram_frame(b"D" * 10, flow_id=1)
+            client.send_datagram_frame(b"E" * 10, flow_id=2)
+            client._remote_max_datagram_frame_size = remote_max_datagram_frame_size
+            self.assertEqual(transfer(client, server), 1)
+            self.assertEqual(
+                client.next_event(),
+                events.DatagramFrameDropped(data=b"C" * 998, flow_id=1),
+            )
+            self.assertEqual(client.datagrams_pending, 0)
+            self.assertEqual(
+                [server.next_event().data for i in range(2)], [b"D" * 10, b"E" * 10]
+            )
+
+    def test_datagram_frame_prefix(self):
+        with client_and_server(
+            client_options={
+                "max_datagram_frame_size": 65536,
+                "max_datagrams_pending": 1,
+            },
+            server_options={"max_datagram_frame_size": 65536},
+        ) as (client, server):
+            # check handshake completed
+            self.check_handshake(client=client, server=server, alpn_protocol=None)
+
+            # the prefix counts towards the queued bytes
+            client.send_datagram_frame(b"hello 0", flow_id=1, prefix=b"\x01")
+            self.assertEqual(client._datagrams_pending_bytes, 8)
+
+            # dropped frames include their prefix
+            client.send_datagram_frame(b"hello 1", flow_id=1, prefix=b"\x01")
+            self.assertEqual(
+                client.next_event(),
+                events.DatagramFrameDropped(data=b"\x01hello 0", flow_id=1),
+            )
+
+            # the prefix is sent in front of the data
+            self.assertEqual(transfer(client, server), 1)
+            event = server.next_event()
+            self.assertEqual(type(event), events.DatagramFrameReceived)
+            self.assertEqual(event.data, b"\x01hello 1")
+
     def test_decryption_error(self):
         with client_and_server() as (client, server):
             # mess with encryption key
@@ -1421,6 +1735,59 @@ class QuicConnectionTest(TestCase):
         )
         self.assertEqual(drop(client), 0)
 
+    def test_receive_stateless_reset(self):
+        with client_and_server(
+            server_options={"stateless_reset_key": b"secret"}
+        ) as (client, server):
+            # the tokens are derived from the connection IDs
+            for connection_id in [client._peer_cid] + client._peer_cid_available:
+                self.assertEqual(
+                    connection_id.stateless_reset_token,
+                    derive_stateless_reset_token(b"secret", connection_id.cid),
+                )
+
+            # garbage is ignored
+            client.receive_datagram(bytes(40), SERVER_ADDR, now=time.time())
+            self.assertEqual(client._state, QuicConnectionState.CONNECTED)
+
+            # so are the tokens of connection IDs which were not used yet
+            client.receive_datagram(
+                encode_quic_stateless_reset(
+                    size=40,
+                    stateless_reset_token=client._peer_cid_available[
+                        0
+                    ].stateless_reset_token,
+                ),
+                SERVER_ADDR,
+                now=time.time(),
+            )
+            self.assertEqual(client._state, QuicConnectionState.CONNECTED)
+
+            # the server lost its state and resets the connection
+            client.receive_datagram(
+                encode_quic_stateless_reset(
+                    size=40,
+                    stateless_reset_token=derive_stateless_reset_token(
+                        b"secret", client._peer_cid.cid
+                    ),
+                ),
+                SERVER_ADDR,
+                now=time.time(),
+            )
+            self.assertEqual(client._state, QuicConnectionState.DRAINING)
+            self.assertEqual(client.datagrams_to_send(now=time.time()), [])
+
+            client.handle_timer(client.get_timer())
+            self.assertEqual(client._state, QuicConnectionState.TERMINATED)
+            self.assertEqual(
+                client._close_event,
+                events.ConnectionTerminated(
+                    error_code=QuicErrorCode.NO_ERROR,
+                    frame_type=None,
+                    reason_phrase="Stateless reset",
+                ),
+            )
+
     def test_handle_ack_frame_ecn(self):
         client = create_standalone_client(self)
 
@@ -1944,6 +2311,54 @@ class QuicConnectionTest(TestCase):
                 cm.exception.reason_phrase, "Clients must not send NEW_TOKEN frames"
             )
 
+    def test_send_new_token(self):
+        tokens = []
+
+        # the token is queued before the handshake and sent once it completes
+        with client_and_server(
+            client_kwargs={"token_handler": tokens.append},
+            server_patch=lambda server: server.send_new_token(b"token-1"),
+        ) as (client, server):
+            self.assertEqual(tokens, [b"token-1"])
+
+            # tokens can also be sent later on
+            server.send_new_token(b"token-2")
+            self.assertEqual(transfer(server, client), 1)
+            self.assertEqual(tokens, [b"token-1", b"token-2"])
+
+    def test_send_new_token_lost(self):
+        tokens = []
+
+        with client_and_server(client_kwargs={"token_handler": tokens.append}) as (
+            client,
+            server,
+        ):
+            server.send_new_token(b"token")
+
+            # the NEW_TOKEN frame is lost
+            server.datagrams_to_send(now=time.time())
+            self.assertEqual(server._new_tokens_pending, [])
+            server._on_new_token_delivery(QuicDeliveryState.LOST, b"token")
+            self.assertEqual(server._new_tokens_pending, [b"token"])
+
+            # it is sent again
+            self.assertEqual(transfer(server, client), 1)
+            self.assertEqual(tokens, [b"token"])
+
+    def test_server_address_validated(self):
+        for address_validated in (False, True):
+            with client_and_server(
+                handshake=False, server_kwargs={"address_validated": address_validated}
+            ) as (client, server):
+                client.connect(SERVER_ADDR, now=0.0)
+                for data, addr in client.datagrams_to_send(now=0.0):
+                    server.receive_datagram(data, CLIENT_ADDR, now=TICK)
+
+                # a validated address lifts the anti-amplification limit
+                self.assertEqual(
+                    server._network_paths[0].is_validated, address_validated
+                )
+
     def test_handle_path_challenge_frame(self):
         with client_and_server() as (client, server):
             # client changes address and sends some data
@@ -0,0 +1,112 @@
+from unittest import TestCase
+
+from aioquic.quic.connection_id import (
+    ConnectionIdGenerator,
+    QuicLbConnectionIdGenerator,
+    derive_stateless_reset_token,
+)
+
+KEY = bytes.fromhex("fdf726a9893ec05c0632d3956680baf0")
+
+
+class ConnectionIdGeneratorTest(TestCase):
+    def test_generate(self):
+        generator = ConnectionIdGenerator()
+        cid = generator.generate(8)
+        self.assertEqual(len(cid), 8)
+        self.assertNotEqual(generator.generate(8), cid)
+
+
+class DeriveStatelessResetTokenTest(TestCase):
+    def test_derive(self):
+        token = derive_stateless_reset_token(b"secret", b"\x01\x02\x03\x04")
+        self.assertEqual(len(token), 16)
+
+        # the token only depends on the key and the connection ID
+        self.assertEqual(
+            derive_stateless_reset_token(b"secret", b"\x01\x02\x03\x04"), token
+        )
+        self.assertNotEqual(
+            derive_stateless_reset_token(b"other", b"\x01\x02\x03\x04"), token
+        )
+        self.assertNotEqual(
+            derive_stateless_reset_token(b"secret", b"\x01\x02\x03\x05"), token
+        )
+
+
+class QuicLbConnectionIdGeneratorTest(TestCase):
+    def check_round_trip(self, server_id: bytes, nonce_length: int, key=KEY):
+        generator = QuicLbConnectionIdGenerator(
+            config_id=2, key=key, nonce_length=nonce_length, server_id=server_id
+        )
+        length = 1 + len(server_id) + nonce_length
+        cids = set()
+        for i in range(100):
+            cid = generator.generate(length)
+            self.assertEqual(len(cid), length)
+            self.assertEqual(cid[0], 0x40 | (length - 1))
+            self.assertEqual(generator.decode_server_id(cid), server_id)
+            cids.add(cid)
+        self.assertEqual(len(cids), 100)
+        return cid
+
+    def test_clear(self):
+        cid = self.check_round_trip(b"\x01\x02\x03", 4, key=None)
+        self.assertEqual(cid[1:4], b"\x01\x02\x03")
+
+    def test_single_pass(self):
+        cid = self.check_round_trip(b"\x01\x02\x03", 13)
+        self.assertNotEqual(cid[1:4], b"\x01\x02\x03")
+
+    def test_four_pass_even(self):
+        cid = self.check_round_trip(b"\x01\x02\x03", 5)
+        self.assertNotEqual(cid[1:4], b"\x01\x02\x03")
+
+    def test_four_pass_odd(self):
+        for nonce_length in range(4, 17, 2):
+            self.check_round_trip(b"\x01\x02\x03", nonce_length)
+        self.check_round_trip(b"\xff" * 15, 4)
+
+    def test_decode_other_configuration(self):
+        generator = QuicLbConnectionIdGenerator(
+            config_id=2, key=KEY, nonce_length=5, server_id=b"\x01\x02\x03"
+        )
+        other = QuicLbConnectionIdGenerator(
+            config_id=3, key=KEY, nonce_length=5, server_id=b"\x01\x02\x03"
+        )
+        cid = other.generate(9)
+        self.assertIsNone(generator.decode_server_id(cid))
+        self.assertIsNone(generator.decode_server_id(cid[:8]))
+
+        # a different key yields a different server ID
+        other = QuicLbConnectionIdGenerator(
+            config_id=2, key=b"\x00" * 16, nonce_length=5, server_id=b"\x01\x02\x03"
+        )
+        self.assertNotEqual(
+            generator.decode_server_id(other.generate(9)), b"\x01\x02\x03"
+        )
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError) as cm:
+            QuicLbConnectionIdGenerator(server_id=b"", nonce_length=4)
+        self.assertEqual(str(cm.exception), "Server ID must be between 1 and 15 bytes")
+
+        with self.assertRaises(ValueError) as cm:
+            QuicLbConnectionIdGenerator(server_id=b"\x01", nonce_length=3)
+        self.assertEqual(str(cm.exception), "Nonce must be between 4 and 18 bytes")
+
+        with self.assertRaises(ValueError) as cm:
+            QuicLbConnectionIdGenerator(server_id=b"\x01" * 15, nonce_length=5)
+        self.assertEqual(
+            str(cm.exception), "Server ID and nonce cannot exceed 19 bytes"
+        )
+
+        with self.assertRaises(ValueError) as cm:
+            QuicLbConnectionIdGenerator(server_id=b"\x01", nonce_length=4, config_id=7)
+        self.assertEqual(
+            str(cm.exception), "Configuration ID must be between 0 and 6"
+        )
+
+        with self.assertRaises(ValueError) as cm:
+            QuicLbConnectionIdGenerator(server_id=b"\x01", nonce_length=4, key=b"x")
+        self.assertEqual(str(cm.exception), "Key must be 16 bytes")
@@ -1,12 +1,31 @@
+import asyncio
+import contextlib
 from unittest import TestCase
-from unittest.mock import Mock
-from aioquic.masque.capsule import CapsuleBuffer, CapsuleType, DatagramCapsule
+from unittest.mock import Mock, patch
+from aioquic.masque.capsule import MAX_CAPSULE_SIZE, CapsuleBuffer, CapsuleType, DatagramCapsule
+from aioquic.masque.capsule import encode_datagram_capsules
+from aioquic.masque.capsule import AddressAssignCapsule, AssignedAddress, CloseWebTransportSessionCapsule
+from aioquic.masque.capsule import IpAddressRange, RouteAdvertisementCapsule
+from aioquic.masque.capsule import encode_address_assign_capsule, encode_close_webtransport_session_capsule
+from aioquic.masque.capsule import encode_address_request_capsule, encode_route_advertisement_capsule
 from aioquic.masque.capsule import _encode_capsule as encode_capsule
-from aioquic.masque.tunnel import UdpTunnel, ConnectState
+from aioquic.masque.context import DatagramContext, QuicShortHeaderContext
+from aioquic.masque.tunnel import IpTunnel, UdpTunnel, ConnectState
 from aioquic.masque.events import Connected, ConnectFailed, ProxiedDatagramReceived
+from aioquic.masque.events import AddressAssigned, AddressRequested, RoutesAdvertised
 from aioquic.masque.exceptions import MasqueError
-from aioquic.h3.events import DataReceived, DatagramReceived, HeadersReceived
+from aioquic.masque.pool import MasqueConnectionPool
+from aioquic.masque.proxy import MAX_EARLY_DATAGRAMS, MAX_EARLY_STREAMS, MasqueProxy
+from aioquic.masque.resolver import CachingResolver, StaticResolver
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+from aioquic.h3.events import DataReceived, DatagramDropped, DatagramReceived, HeadersReceived
 from aioquic.buffer import Buffer, UINT_VAR_MAX_SIZE, encode_uint_var
+import ipaddress
+import socket
+
+from .utils import asynctest
 
 
 
@@ -30,6 +49,25 @@ class CapsuleTest(TestCase):
         encoded_data = buf.pull_bytes(encoded_length)
         self.assertEqual(encoded_data, data)
 
+    def test_encode_datagram_capsules(self):
+        datagrams = [b'x' * 10, b'y' * 100, b'']
+        encoded = encode_datagram_capsules(datagrams)
+        self.assertEqual(encoded, b''.join(encode_capsule(CapsuleType.DATAGRAM, d) for d in datagrams))
+
+    def test_encode_datagram_capsules_from_received(self):
+        encoded = encode_datagram_capsules([b'x' * 10, b'y' * 100])
+        capsules = CapsuleBuffer().read_capsule_data(encoded)
+        self.assertIsInstance(capsules[0].data, memoryview) # type: ignore
+        self.assertEqual(encode_datagram_capsules(c.data for c in capsules), encoded) # type: ignore
+
+    def test_encode_datagram_capsules_with_context_id(self):
+        datagrams = [b'x' * 10, b'y' * 100]
+        encoded = encode_datagram_capsules(datagrams, context_id=0)
+        capsules = CapsuleBuffer().read_capsule_data(encoded)
+        self.assertEqual(len(capsules), 2)
+        self.assertEqual(capsules[0].data, b'\x00' + datagrams[0]) # type: ignore
+        self.assertEqual(capsules[1].data, b'\x00' + datagrams[1]) # type: ignore
+
     def test_empty(self):
         capsule_buffer = CapsuleBuffer()
         capsules = capsule_buffer.read_capsule_data(b'')
@@ -100,6 +138,133 @@ class CapsuleTest(TestCase):
         self.assertIsInstance(capsules[0], DatagramCapsule)
         self.assertEqual(capsules[0].data, second + third) # type: ignore
 
+    def test_split_every_byte(self):
+        capsule_buffer = CapsuleBuffer()
+        first = b'x' * 100
+        second = b'y' * 300
+        input = encode_capsule(CapsuleType.DATAGRAM, first) + encode_capsule(CapsuleType.DATAGRAM, second)
+
+        capsules = []
+        for i in range(len(input)):
+            capsules += capsule_buffer.read_capsule_data(input[i:i + 1])
+        self.assertEqual(len(capsules), 2)
+        self.assertEqual(capsules[0].data, first) # type: ignore
+        self.assertEqual(capsules[1].data, second) # type: ignore
+
+    def test_empty_capsule_split_header(self):
+        capsule_buffer = CapsuleBuffer()
+        self.assertEqual(capsule_buffer.read_capsule_data(b'\x00'), [])
+        capsules = capsule_buffer.read_capsule_data(b'\x00')
+        self.assertEqual(len(capsules), 1)
+        self.assertEqual(capsules[0].data, b'') # type: ignore
+
+        # the buffer is still usable
+        capsules = capsule_buffer.read_capsule_data(encode_capsule(CapsuleType.DATAGRAM, b'x'))
+        self.assertEqual(capsules[0].data, b'x') # type: ignore
+
+    def test_zero_copy(self):
+        capsule_buffer = CapsuleBuffer()
+        input = encode_capsule(CapsuleType.DATAGRAM, b'x' * 100)
+        capsules = capsule_buffer.read_capsule_data(input)
+        self.assertEqual(len(capsules), 1)
+        self.assertIsInstance(capsules[0].data, memoryview) # type: ignore
+        self.assertIs(capsules[0].data.obj, input) # type: ignore
+
+    def test_larger_than_default(self):
+        capsule_buffer = CapsuleBuffer(max_capsule_size=1 << 20)
+        data = b'x' * (MAX_CAPSULE_SIZE * 4)
+        input = encode_capsule(CapsuleType.DATAGRAM, data)
+        capsules = []
+        for i in range(0, len(input), 1000):
+            capsules += capsule_buffer.read_capsule_data(input[i:i + 1000])
+        self.assertEqual(len(capsules), 1)
+        self.assertEqual(capsules[0].data, data) # type: ignore
+
+    def test_too_large(self):
+        capsule_buffer = CapsuleBuffer()
+        input = encode_capsule(CapsuleType.DATAGRAM, b'x' * (MAX_CAPSULE_SIZE + 1))
+        with self.assertRaises(MasqueError):
+            capsule_buffer.read_capsule_data(input[:10])
+
+
+    def test_unknown_skipped(self):
+        capsule_buffer = CapsuleBuffer()
+        unknown = encode_capsule(0x1234, b'u' * 1000)
+        input = unknown + encode_capsule(CapsuleType.DATAGRAM, b'x' * 10) + unknown
+
+        capsules = capsule_buffer.read_capsule_data(input)
+        self.assertEqual(len(capsules), 1)
+        self.assertEqual(capsules[0].data, b'x' * 10) # type: ignore
+        self.assertEqual(capsule_buffer._size, 0)
+
+        # split unknown capsules are dropped as they arrive
+        capsules = []
+        for i in range(0, len(input), 7):
+            capsules += capsule_buffer.read_capsule_data(input[i:i + 7])
+            self.assertLess(capsule_buffer._size, 20)
+        self.assertEqual(len(capsules), 1)
+        self.assertEqual(capsules[0].data, b'x' * 10) # type: ignore
+
+    def test_unknown_too_large_skipped(self):
+        capsule_buffer = CapsuleBuffer()
+        unknown = encode_capsule(0x1234, b'u' * (MAX_CAPSULE_SIZE * 2))
+        input = unknown + encode_capsule(CapsuleType.DATAGRAM, b'x' * 10)
+        capsules = []
+        for i in range(0, len(input), 1000):
+            capsules += capsule_buffer.read_capsule_data(input[i:i + 1000])
+        self.assertEqual(len(capsules), 1)
+
+    def test_custom_decoders(self):
+        capsule_buffer = CapsuleBuffer(decoders={})
+        capsules = capsule_buffer.read_capsule_data(encode_capsule(CapsuleType.DATAGRAM, b'x'))
+        self.assertEqual(capsules, [])
+
+    def test_address_assign(self):
+        addresses = [
+            AssignedAddress(request_id=1, prefix=ipaddress.ip_network("192.0.2.0/24")),
+            AssignedAddress(request_id=0, prefix=ipaddress.ip_network("2001:db8::1/128")),
+        ]
+        capsules = CapsuleBuffer().read_capsule_data(encode_address_assign_capsule(addresses))
+        self.assertEqual(capsules, [AddressAssignCapsule(addresses=addresses)])
+
+    def test_route_advertisement(self):
+        ranges = [
+            IpAddressRange(
+                start=ipaddress.ip_address("192.0.2.0"),
+                end=ipaddress.ip_address("192.0.2.255"),
+                ip_protocol=17,
+            ),
+        ]
+        capsules = CapsuleBuffer().read_capsule_data(encode_route_advertisement_capsule(ranges))
+        self.assertEqual(capsules, [RouteAdvertisementCapsule(ranges=ranges)])
+
+    def test_close_webtransport_session(self):
+        capsules = CapsuleBuffer().read_capsule_data(
+            encode_close_webtransport_session_capsule(42, "bye"))
+        self.assertEqual(capsules, [CloseWebTransportSessionCapsule(error_code=42, reason="bye")])
+
+    def test_malformed(self):
+        input = encode_capsule(CapsuleType.ADDRESS_ASSIGN, b'\x01\x04\x01')
+        with self.assertRaises(MasqueError):
+            CapsuleBuffer().read_capsule_data(input)
+
+
+class ContextTest(TestCase):
+
+    def test_quic_short_header(self):
+        cid = bytes(range(8))
+        context = QuicShortHeaderContext(cid)
+        packet = b'\x41' + cid + b'payload'
+
+        compressed = context.compress(packet)
+        self.assertEqual(compressed, b'\x41payload')
+        self.assertEqual(context.decompress(compressed), packet)
+
+        # long header packets and other connection IDs are not compressed
+        self.assertIsNone(context.compress(b'\xc1' + cid + b'payload'))
+        self.assertIsNone(context.compress(b'\x41' + bytes(8) + b'payload'))
+        self.assertIsNone(context.decompress(b'\xc1payload'))
+
 
 class TunnelTest(TestCase):
     
@@ -118,6 +283,19 @@ class TunnelTest(TestCase):
     def test_connect_invalid_uri(self):
         with self.assertRaises(MasqueError):
             self.tunnel.connect("http://proxy.example.com/path")
+
+    def test_mark_connected(self):
+        self.assertFalse(self.tunnel.connected)
+        self.tunnel.mark_connected()
+        self.assertTrue(self.tunnel.connected)
+
+        # a tunnel cannot be marked connected twice, nor after a request
+        with self.assertRaises(MasqueError):
+            self.tunnel.mark_connected()
+        tunnel = UdpTunnel(self.http_mock, 8)
+        tunnel.connect("https://proxy.example.com/.well-known/masque/udp/target.com/443/")
+        with self.assertRaises(MasqueError):
+            tunnel.mark_connected()
     
     def test_handle_headers_success(self):
         self.tunnel._connect_state = ConnectState.CONNECT_SENT
@@ -147,6 +325,13 @@ class TunnelTest(TestCase):
         
         self.assertEqual(len(events), 1)
         self.assertIsInstance(events[0], ConnectFailed)
+        self.assertEqual(self.tunnel._connect_state, ConnectState.FAILED)
+
+        # the response body and late datagrams are ignored
+        self.assertEqual(self.tunnel.handle_http_event(
+            DataReceived(stream_id=self.stream_id, data=b'Not Found', stream_ended=True)), [])
+        self.assertEqual(self.tunnel.handle_http_event(
+            DatagramReceived(stream_id=self.stream_id, data=b'\x00payload')), [])
     
     def test_handle_headers_capsule_zero(self):
         self.tunnel._connect_state = ConnectState.CONNECT_SENT
@@ -189,6 +374,56 @@ class TunnelTest(TestCase):
         
         self.http_mock.send_datagram.assert_called_once()
     
+    def test_send_datagrams_via_stream(self):
+        self.tunnel.send_datagrams([b"one", b"two", b"three"], stream=True)
+
+        self.http_mock.send_data.assert_called_once()
+        stream_id, data = self.http_mock.send_data.call_args[0]
+        self.assertEqual(stream_id, self.stream_id)
+        capsules = CapsuleBuffer().read_capsule_data(data)
+        self.assertEqual([c.data for c in capsules], [b"\x00one", b"\x00two", b"\x00three"]) # type: ignore
+
+    def test_send_datagrams_via_datagram(self):
+        self.tunnel.send_datagrams([b"one", b"two"], stream=False)
+
+        self.assertEqual(self.http_mock.send_datagram.call_count, 2)
+
+    def test_max_datagram_payload_size(self):
+        self.http_mock.max_datagram_size.return_value = None
+        self.assertIsNone(self.tunnel.max_datagram_payload_size)
+
+        # the context ID takes one byte
+        self.http_mock.max_datagram_size.return_value = 1369
+        self.assertEqual(self.tunnel.max_datagram_payload_size, 1368)
+        self.http_mock.max_datagram_size.assert_called_with(self.stream_id)
+
+    def test_register_capsule_handler(self):
+        received = []
+        self.tunnel.register_capsule_handler(
+            CapsuleType.CLOSE_WEBTRANSPORT_SESSION, lambda capsule: received.append(capsule) or [])
+        self.tunnel._connect_state = ConnectState.CONNECTED
+
+        event = DataReceived(
+            stream_id=self.stream_id,
+            data=encode_close_webtransport_session_capsule(1, "x"),
+            stream_ended=False
+        )
+        self.assertEqual(self.tunnel.handle_http_event(event), [])
+        self.assertEqual(received, [CloseWebTransportSessionCapsule(error_code=1, reason="x")])
+
+    def test_register_capsule_handler_unknown(self):
+        with self.assertRaises(MasqueError):
+            self.tunnel.register_capsule_handler(0x1234, lambda capsule: [])
+
+    def test_handle_http_event_data_unhandled_capsule(self):
+        self.tunnel._connect_state = ConnectState.CONNECTED
+        event = DataReceived(
+            stream_id=self.stream_id,
+            data=encode_close_webtransport_session_capsule(1, "x"),
+            stream_ended=False
+        )
+        self.assertEqual(self.tunnel.handle_http_event(event), [])
+
     def test_receive_datagram_valid(self):
         payload = b"test data"
         context_id = encode_uint_var(0)
@@ -205,6 +440,66 @@ class TunnelTest(TestCase):
         result = self.tunnel._receive_datagram(datagram_data)
         self.assertEqual(result, b'')
     
+    def test_receive_datagram_two_byte_context(self):
+        self.tunnel.register_context(0x42, DatagramContext())
+        result = self.tunnel._receive_datagram(encode_uint_var(0x42) + b"test data")
+        self.assertEqual(result, b"test data")
+
+        # context ID 2 encoded on two bytes is not context ID 0x42
+        result = self.tunnel._receive_datagram(b"\x40\x02test data")
+        self.assertEqual(result, b'')
+
+    def test_statistics(self):
+        self.tunnel._connect_state = ConnectState.CONNECTED
+        self.tunnel.send_datagram(b'foo')
+        self.tunnel.send_datagrams([b'bar', b'bazz'], stream=True)
+        self.assertEqual(self.tunnel.datagrams_sent, 3)
+        self.assertEqual(self.tunnel.bytes_sent, 10)
+
+        self.tunnel.handle_http_event(DatagramReceived(stream_id=self.stream_id, data=b'\x00hello'))
+        self.tunnel.handle_http_event(DatagramReceived(stream_id=self.stream_id, data=b'\x07hello'))
+        self.assertEqual(self.tunnel.datagrams_received, 1)
+        self.assertEqual(self.tunnel.bytes_received, 5)
+
+        self.tunnel.handle_http_event(DatagramDropped(stream_id=self.stream_id, data=b'\x00foo'))
+        self.assertEqual(self.tunnel.datagrams_dropped, 1)
+
+    def test_allocate_context_id(self):
+        self.assertEqual(self.tunnel.allocate_context_id(), 2)
+        self.assertEqual(self.tunnel.allocate_context_id(), 4)
+
+    def test_register_context_twice(self):
+        context_id = self.tunnel.allocate_context_id()
+        self.tunnel.register_context(context_id, DatagramContext())
+        with self.assertRaises(MasqueError):
+            self.tunnel.register_context(context_id, DatagramContext())
+
+    def test_compression_context(self):
+        cid = bytes(range(8))
+        context_id = self.tunnel.allocate_context_id()
+        self.tunnel.register_context(context_id, QuicShortHeaderContext(cid))
+
+        # matching packets use the compression context
+        self.tunnel.send_datagram(b'\x41' + cid + b'payload')
+        self.http_mock.send_datagram.assert_called_with(self.stream_id, b'\x02\x41payload')
+        self.assertEqual(self.tunnel._receive_datagram(b'\x02\x41payload'), b'\x41' + cid + b'payload')
+
+        # other packets fall back to the uncompressed context
+        self.tunnel.send_datagram(b'\xc1' + cid + b'payload')
+        self.http_mock.send_datagram.assert_called_with(self.stream_id, b'\x00\xc1' + cid + b'payload')
+
+        # stream mode
+        self.tunnel.send_datagrams([b'\x41' + cid + b'a', b'other'], stream=True)
+        stream_id, data = self.http_mock.send_data.call_args[0]
+        capsules = CapsuleBuffer().read_capsule_data(data)
+        self.assertEqual([c.data for c in capsules], [b'\x02\x41a', b'\x00other']) # type: ignore
+
+        # once unregistered, the context is neither used nor accepted
+        self.tunnel.unregister_context(context_id)
+        self.tunnel.send_datagram(b'\x41' + cid + b'payload')
+        self.http_mock.send_datagram.assert_called_with(self.stream_id, b'\x41' + cid + b'payload', prefix=b'\x00')
+        self.assertEqual(self.tunnel._receive_datagram(b'\x02\x41payload'), b'')
+
     def test_handle_http_event_datagram(self):
         payload = b"test data"
         context_id = encode_uint_var(0)
@@ -235,4 +530,684 @@ class TunnelTest(TestCase):
         masque_events = self.tunnel.handle_http_event(event)
         self.assertEqual(len(masque_events), 1)
         self.assertIsInstance(masque_events[0], ProxiedDatagramReceived)
-        self.assertEqual(masque_events[0].datagram, payload)  # type: ignore
\ No newline at end of file
+        self.assertEqual(masque_events[0].datagram, payload)  # type: ignore
+
+
+class IpTunnelTest(TestCase):
+
+    def setUp(self):
+        self.http_mock = Mock()
+        self.stream_id = 4
+        self.tunnel = IpTunnel(self.http_mock, self.stream_id)
+
+    def receive_capsule(self, data):
+        self.tunnel._connect_state = ConnectState.CONNECTED
+        return self.tunnel.handle_http_event(
+            DataReceived(stream_id=self.stream_id, data=data, stream_ended=False))
+
+    def test_connect(self):
+        self.tunnel.connect("https://proxy.example.com/.well-known/masque/ip/*/*/")
+
+        self.assertEqual(self.tunnel._connect_state, ConnectState.CONNECT_SENT)
+        headers = self.http_mock.send_headers.call_args[1]["headers"]
+        self.assertIn((b':protocol', b'connect-ip'), headers)
+
+    def test_address_assign(self):
+        addresses = [AssignedAddress(request_id=0, prefix=ipaddress.ip_network("10.0.0.2/32"))]
+        events = self.receive_capsule(encode_address_assign_capsule(addresses))
+        self.assertEqual(events, [AddressAssigned(self.stream_id, addresses)])
+        self.assertEqual(self.tunnel.assigned_addresses, addresses)
+
+    def test_address_request(self):
+        addresses = [AssignedAddress(request_id=1, prefix=ipaddress.ip_network("0.0.0.0/32"))]
+        events = self.receive_capsule(encode_address_request_capsule(addresses))
+        self.assertEqual(events, [AddressRequested(self.stream_id, addresses)])
+
+    def test_route_advertisement(self):
+        ranges = [
+            IpAddressRange(
+                start=ipaddress.ip_address("10.0.0.0"),
+                end=ipaddress.ip_address("10.0.0.255"),
+            ),
+            IpAddressRange(
+                start=ipaddress.ip_address("10.1.0.0"),
+                end=ipaddress.ip_address("10.1.0.255"),
+            ),
+        ]
+        events = self.receive_capsule(encode_route_advertisement_capsule(ranges))
+        self.assertEqual(events, [RoutesAdvertised(self.stream_id, ranges)])
+        self.assertEqual(self.tunnel.routes, ranges)
+
+    def test_route_advertisement_unordered(self):
+        ranges = [
+            IpAddressRange(
+                start=ipaddress.ip_address("10.1.0.0"),
+                end=ipaddress.ip_address("10.1.0.255"),
+            ),
+            IpAddressRange(
+                start=ipaddress.ip_address("10.0.0.0"),
+                end=ipaddress.ip_address("10.0.0.255"),
+            ),
+        ]
+        with self.assertRaises(MasqueError):
+            self.receive_capsule(encode_route_advertisement_capsule(ranges))
+
+    def test_route_advertisement_reversed(self):
+        ranges = [
+            IpAddressRange(
+                start=ipaddress.ip_address("10.0.0.255"),
+                end=ipaddress.ip_address("10.0.0.0"),
+            ),
+        ]
+        with self.assertRaises(MasqueError):
+            self.receive_capsule(encode_route_advertisement_capsule(ranges))
+        self.assertEqual(self.tunnel.routes, [])
+
+    def test_request_address(self):
+        with self.assertRaises(MasqueError):
+            self.tunnel.request_address(ipaddress.ip_network("0.0.0.0/32"))
+
+        self.tunnel._connect_state = ConnectState.CONNECT_SENT
+        request_id = self.tunnel.request_address(ipaddress.ip_network("0.0.0.0/32"))
+        self.assertEqual(request_id, 1)
+        stream_id, data = self.http_mock.send_data.call_args[0]
+        self.assertEqual(
+            data,
+            encode_address_request_capsule(
+                [AssignedAddress(request_id=1, prefix=ipaddress.ip_network("0.0.0.0/32"))]))
+
+    def test_ip_packets(self):
+        packet = bytes.fromhex("4500001c000000004011000a0a0000020a000001")
+        self.tunnel._connect_state = ConnectState.CONNECTED
+        events = self.tunnel.handle_http_event(
+            DatagramReceived(stream_id=self.stream_id, data=b"\x00" + packet))
+        self.assertEqual(events, [ProxiedDatagramReceived(self.stream_id, packet)])
+
+        self.tunnel.send_datagram(packet)
+        self.http_mock.send_datagram.assert_called_once_with(self.stream_id, packet, prefix=b"\x00")
+
+
+class ProxyTest(TestCase):
+
+    def setUp(self):
+        self.http_mock = Mock()
+        self.http_mock.datagrams_pending = 0
+        self.transmit = Mock()
+
+    def connect_request(self, stream_id, path):
+        return HeadersReceived(
+            stream_id=stream_id,
+            headers=[
+                (b':method', b'CONNECT'),
+                (b':protocol', b'connect-udp'),
+                (b':scheme', b'https'),
+                (b':authority', b'proxy.example.com'),
+                (b':path', path.encode()),
+            ],
+            stream_ended=False,
+        )
+
+    async def open_tunnel(self, proxy, port):
+        path = "/.well-known/masque/udp/127.0.0.1/%d/" % port
+        self.assertTrue(proxy.handle_http_event(self.connect_request(0, path)))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if proxy.tunnels[0].transport is not None:
+                break
+        return proxy.tunnels[0]
+
+    @asynctest
+    async def test_not_connect_udp(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        event = HeadersReceived(
+            stream_id=0, headers=[(b':method', b'GET'), (b':path', b'/')], stream_ended=True)
+        self.assertFalse(proxy.handle_http_event(event))
+        self.assertFalse(proxy.handle_http_event(
+            DataReceived(stream_id=0, data=b'', stream_ended=True)))
+        proxy.close()
+
+    @asynctest
+    async def test_invalid_path(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        self.assertTrue(proxy.handle_http_event(self.connect_request(0, "/foo")))
+        self.assertEqual(proxy.tunnels, {})
+        self.assertEqual(
+            self.http_mock.send_headers.call_args[1]["headers"], [(b':status', b'400')])
+
+        await asyncio.sleep(0)
+        self.transmit.assert_called_once_with()
+        proxy.close()
+
+    @asynctest
+    async def test_forward(self):
+        await self.check_forward()
+
+    @asynctest
+    async def test_forward_without_add_reader(self):
+        loop = asyncio.get_running_loop()
+        with patch.object(loop, "add_reader", side_effect=NotImplementedError):
+            await self.check_forward()
+
+    async def check_forward(self):
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue()
+        target, _ = await loop.create_datagram_endpoint(
+            lambda: QueueProtocol(received), local_addr=("127.0.0.1", 0))
+        port = target.get_extra_info("sockname")[1]
+
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        tunnel = await self.open_tunnel(proxy, port)
+        self.assertTrue(tunnel.connected)
+        self.assertEqual(
+            self.http_mock.send_headers.call_args[1]["headers"],
+            [(b':status', b'200'), (b'capsule-protocol', b'?1')])
+
+        # client to target
+        proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00ping'))
+        data, addr = await asyncio.wait_for(received.get(), 1)
+        self.assertEqual(data, b'ping')
+
+        # target to client, several datagrams share a single transmit
+        self.transmit.reset_mock()
+        for i in range(3):
+            target.sendto(b'pong%d' % i, addr)
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            if self.http_mock.send_datagram.call_count == 3:
+                break
+        self.assertEqual(
+            [(c[0][0], c[1]["prefix"] + c[0][1]) for c in self.http_mock.send_datagram.call_args_list],
+            [(0, b'\x00pong0'), (0, b'\x00pong1'), (0, b'\x00pong2')])
+        self.assertLessEqual(self.transmit.call_count, 3)
+
+        # client closes the stream
+        proxy.handle_http_event(DataReceived(stream_id=0, data=b'', stream_ended=True))
+        self.assertEqual(proxy.tunnels, {})
+        self.http_mock.send_data.assert_called_once_with(0, b'', end_stream=True)
+
+        proxy.close()
+        target.close()
+
+    @asynctest
+    async def test_flush_delay(self):
+        # datagrams are transmitted once after the flush delay
+        proxy = MasqueProxy(self.http_mock, self.transmit, flush_delay=0.02)
+        tunnel = await self.open_tunnel(proxy, 9)
+        self.transmit.reset_mock()
+        for i in range(5):
+            proxy._target_datagrams_received(tunnel, [b'data'])
+        await asyncio.sleep(0)
+        self.transmit.assert_not_called()
+        await asyncio.sleep(0.05)
+        self.transmit.assert_called_once_with()
+        proxy.close()
+
+        # or immediately if there is no flush delay
+        proxy = MasqueProxy(self.http_mock, self.transmit, flush_delay=None)
+        tunnel = await self.open_tunnel(proxy, 9)
+        self.transmit.reset_mock()
+        for i in range(5):
+            proxy._target_datagrams_received(tunnel, [b'data'])
+        self.assertEqual(self.transmit.call_count, 5)
+        proxy.close()
+
+    @asynctest
+    async def test_unknown_host(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit, resolver=StaticResolver({}))
+        proxy.handle_http_event(
+            self.connect_request(0, "/.well-known/masque/udp/unknown.invalid/443/"))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not proxy.tunnels:
+                break
+        self.assertEqual(proxy.tunnels, {})
+        self.assertEqual(
+            self.http_mock.send_headers.call_args[1]["headers"], [(b':status', b'404')])
+        proxy.close()
+
+    @asynctest
+    async def test_resolver_error(self):
+        class FailingResolver(StaticResolver):
+            async def resolve(self, host, port):
+                raise OSError("resolver unavailable")
+
+        proxy = MasqueProxy(self.http_mock, self.transmit, resolver=FailingResolver({}))
+        proxy.handle_http_event(
+            self.connect_request(0, "/.well-known/masque/udp/target.example.com/443/"))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not proxy.tunnels:
+                break
+        self.assertEqual(proxy.tunnels, {})
+        self.assertEqual(
+            self.http_mock.send_headers.call_args[1]["headers"], [(b':status', b'502')])
+        proxy.close()
+
+    @asynctest
+    async def test_idle_timeout(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit, idle_timeout=0.05)
+        await self.open_tunnel(proxy, 9)
+        self.assertEqual(len(proxy.tunnels), 1)
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(proxy.tunnels, {})
+        self.http_mock.send_data.assert_called_once_with(0, b'', end_stream=True)
+        proxy.close()
+
+    @asynctest
+    async def test_compressed_context_dropped(self):
+        # the proxy does not register contexts, only context ID 0 is forwarded
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        tunnel = await self.open_tunnel(proxy, 9)
+        tunnel.transport = Mock()
+        proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x02\x40payload'))
+        tunnel.transport.sendto.assert_not_called()
+        proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00payload'))
+        tunnel.transport.sendto.assert_called_once_with(b'payload')
+        proxy.close()
+
+    @asynctest
+    async def test_backpressure(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit, max_pending_datagrams=4)
+        tunnel = await self.open_tunnel(proxy, 9)
+        tunnel.transport = Mock()
+
+        self.http_mock.datagrams_pending = 3
+        proxy._target_datagrams_received(tunnel, [b'data'])
+        tunnel.transport.pause_reading.assert_not_called()
+        self.http_mock.datagrams_pending = 4
+        proxy._target_datagrams_received(tunnel, [b'data'])
+        tunnel.transport.pause_reading.assert_called_once_with()
+
+        # reading resumes once the queue drains below half the limit
+        await asyncio.sleep(0)
+        tunnel.transport.resume_reading.assert_not_called()
+        self.http_mock.datagrams_pending = 0
+        await asyncio.sleep(0.05)
+        tunnel.transport.resume_reading.assert_called_once_with()
+
+        # datagrams are dropped while the target socket is not writable
+        tunnel.writing_paused = True
+        proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00ping'))
+        tunnel.transport.sendto.assert_not_called()
+        self.assertEqual(tunnel.datagrams_dropped, 1)
+        proxy.close()
+
+
+    @asynctest
+    async def test_early_datagrams(self):
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue()
+        target, _ = await loop.create_datagram_endpoint(
+            lambda: QueueProtocol(received), local_addr=("127.0.0.1", 0))
+        port = target.get_extra_info("sockname")[1]
+        path = "/.well-known/masque/udp/127.0.0.1/%d/" % port
+
+        # a datagram arrives before its request
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        self.assertTrue(proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00ping0')))
+        self.assertEqual(proxy.tunnels, {})
+
+        # another arrives while the target socket is being opened
+        self.assertTrue(proxy.handle_http_event(self.connect_request(0, path)))
+        self.assertTrue(proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00ping1')))
+        self.assertEqual(proxy.tunnels[0].pending_datagrams, [b'ping0', b'ping1'])
+
+        # both are forwarded once the target socket is ready
+        for i in range(2):
+            data, addr = await asyncio.wait_for(received.get(), 1)
+            self.assertEqual(data, b'ping%d' % i)
+        self.assertEqual(proxy.tunnels[0].pending_datagrams, [])
+
+        proxy.close()
+        target.close()
+
+    @asynctest
+    async def test_early_capsules(self):
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue()
+        target, _ = await loop.create_datagram_endpoint(
+            lambda: QueueProtocol(received), local_addr=("127.0.0.1", 0))
+        port = target.get_extra_info("sockname")[1]
+        path = "/.well-known/masque/udp/127.0.0.1/%d/" % port
+
+        resolver = CountingResolver({})
+        resolver.released.clear()
+        proxy = MasqueProxy(self.http_mock, self.transmit, resolver=resolver)
+
+        # a DATAGRAM capsule arrives while the target is being resolved
+        self.assertTrue(proxy.handle_http_event(self.connect_request(0, path)))
+        self.assertTrue(proxy.handle_http_event(DataReceived(
+            stream_id=0, data=encode_capsule(CapsuleType.DATAGRAM, b'\x00ping'), stream_ended=False)))
+        self.assertEqual(proxy.tunnels[0].pending_datagrams, [b'ping'])
+
+        # the client gives up on another tunnel before the response
+        self.assertTrue(proxy.handle_http_event(self.connect_request(4, path)))
+        self.assertTrue(proxy.handle_http_event(DataReceived(stream_id=4, data=b'', stream_ended=True)))
+        self.assertNotIn(4, proxy.tunnels)
+        self.http_mock.send_headers.assert_called_once_with(
+            stream_id=4, headers=[(b':status', b'400')], end_stream=True)
+
+        # the capsule is forwarded once the target socket is ready
+        resolver.released.set()
+        data, addr = await asyncio.wait_for(received.get(), 1)
+        self.assertEqual(data, b'ping')
+        self.assertEqual(
+            self.http_mock.send_headers.call_args[1]["headers"],
+            [(b':status', b'200'), (b'capsule-protocol', b'?1')])
+        self.assertEqual(len(self.http_mock.send_headers.call_args_list), 2)
+
+        proxy.close()
+        target.close()
+
+    @asynctest
+    async def test_early_datagrams_limits(self):
+        proxy = MasqueProxy(self.http_mock, self.transmit)
+        for stream_id in range(0, 4 * MAX_EARLY_STREAMS, 4):
+            for _ in range(MAX_EARLY_DATAGRAMS + 1):
+                self.assertTrue(proxy.handle_http_event(
+                    DatagramReceived(stream_id=stream_id, data=b'\x00ping')))
+        self.assertEqual(len(proxy._early_datagrams[0]), MAX_EARLY_DATAGRAMS)
+
+        # datagrams for further streams are not handled
+        self.assertFalse(proxy.handle_http_event(
+            DatagramReceived(stream_id=4 * MAX_EARLY_STREAMS, data=b'\x00ping')))
+
+        # buffered datagrams are discarded if the request is not for a tunnel
+        proxy.handle_http_event(HeadersReceived(
+            stream_id=0, headers=[(b':method', b'GET'), (b':path', b'/')], stream_ended=True))
+        self.assertNotIn(0, proxy._early_datagrams)
+
+        # later datagrams for that stream are left to the caller
+        self.assertFalse(proxy.handle_http_event(
+            DatagramReceived(stream_id=0, data=b'\x00ping')))
+        proxy.close()
+        self.assertEqual(proxy._early_datagrams, {})
+
+
+    @asynctest
+    async def test_resolver(self):
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue()
+        target, _ = await loop.create_datagram_endpoint(
+            lambda: QueueProtocol(received), local_addr=("127.0.0.1", 0))
+        port = target.get_extra_info("sockname")[1]
+
+        proxy = MasqueProxy(
+            self.http_mock, self.transmit, resolver=StaticResolver({"target.example.com": ["127.0.0.1"]}))
+        proxy.handle_http_event(
+            self.connect_request(0, "/.well-known/masque/udp/target.example.com/%d/" % port))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if proxy.tunnels[0].transport is not None:
+                break
+        proxy.handle_http_event(DatagramReceived(stream_id=0, data=b'\x00ping'))
+        data, addr = await asyncio.wait_for(received.get(), 1)
+        self.assertEqual(data, b'ping')
+
+        proxy.close()
+        target.close()
+
+
+class CountingResolver(StaticResolver):
+    def __init__(self, hosts):
+        super().__init__(hosts)
+        self.calls = 0
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def resolve(self, host, port):
+        self.calls += 1
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            await self.released.wait()
+            return await super().resolve(host, port)
+        finally:
+            self.concurrent -= 1
+
+
+class ResolverTest(TestCase):
+
+    @asynctest
+    async def test_static(self):
+        resolver = StaticResolver({"example.com": ["192.0.2.1", "2001:db8::1"]})
+        self.assertEqual(await resolver.resolve("example.com", 443), [
+            (socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP, "", ("192.0.2.1", 443)),
+            (socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP, "", ("2001:db8::1", 443, 0, 0)),
+        ])
+        self.assertEqual(await resolver.resolve("192.0.2.2", 53), [
+            (socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP, "", ("192.0.2.2", 53)),
+        ])
+        with self.assertRaises(socket.gaierror):
+            await resolver.resolve("unknown.invalid", 443)
+
+    @asynctest
+    async def test_cache(self):
+        static = CountingResolver({"example.com": ["192.0.2.1"]})
+        resolver = CachingResolver(static, ttl=0.05)
+
+        # the cache is shared between ports
+        infos = await resolver.resolve("example.com", 443)
+        self.assertEqual(infos[0][4], ("192.0.2.1", 443))
+        infos = await resolver.resolve("example.com", 4433)
+        self.assertEqual(infos[0][4], ("192.0.2.1", 4433))
+        self.assertEqual(static.calls, 1)
+        self.assertEqual((resolver.cache_hits, resolver.cache_misses), (1, 1))
+
+        # entries expire
+        await asyncio.sleep(0.1)
+        await resolver.resolve("example.com", 443)
+        self.assertEqual(static.calls, 2)
+
+        # or are cleared
+        resolver.clear()
+        await resolver.resolve("example.com", 443)
+        self.assertEqual(static.calls, 3)
+
+    @asynctest
+    async def test_negative_cache(self):
+        static = CountingResolver({})
+        resolver = CachingResolver(static, negative_ttl=0.05)
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                await resolver.resolve("unknown.invalid", 443)
+        self.assertEqual(static.calls, 1)
+
+        await asyncio.sleep(0.1)
+        static.hosts["unknown.invalid"] = ["192.0.2.1"]
+        infos = await resolver.resolve("unknown.invalid", 443)
+        self.assertEqual(infos[0][4], ("192.0.2.1", 443))
+        self.assertEqual(static.calls, 2)
+
+    @asynctest
+    async def test_coalescing_and_concurrency(self):
+        static = CountingResolver({"a.example.com": ["192.0.2.1"], "b.example.com": ["192.0.2.2"]})
+        static.released.clear()
+        resolver = CachingResolver(static, max_concurrency=1)
+        lookups = [
+            asyncio.ensure_future(resolver.resolve(host, 443))
+            for host in ["a.example.com", "a.example.com", "b.example.com"]
+        ]
+        await asyncio.sleep(0.01)
+        self.assertEqual(static.calls, 1)
+        self.assertEqual(resolver.lookups_coalesced, 1)
+
+        static.released.set()
+        results = await asyncio.gather(*lookups)
+        self.assertEqual([r[0][4][0] for r in results], ["192.0.2.1", "192.0.2.1", "192.0.2.2"])
+        self.assertEqual(static.calls, 2)
+        self.assertEqual(static.max_concurrent, 1)
+
+    @asynctest
+    async def test_max_entries(self):
+        static = CountingResolver({"a.example.com": ["192.0.2.1"], "b.example.com": ["192.0.2.2"]})
+        resolver = CachingResolver(static, max_entries=1)
+        await resolver.resolve("a.example.com", 443)
+        await resolver.resolve("b.example.com", 443)
+        await resolver.resolve("a.example.com", 443)
+        self.assertEqual(static.calls, 3)
+
+
+class QueueProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((data, addr))
+
+
+class FakeMasqueClient(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed_tunnels = []
+        self.connect_count = 0
+
+    async def connect_udp(self, uri, addr, **kwargs):
+        self.connect_count += 1
+        await asyncio.sleep(0)
+        if addr == "unreachable:443":
+            return None
+        return QuicConnectionProtocol(
+            QuicConnection(configuration=QuicConfiguration(is_client=True)))
+
+    def close_udp(self, protocol):
+        self.closed_tunnels.append(protocol)
+
+
+class PoolTest(TestCase):
+
+    def create_pool(self, **kwargs):
+        self.clients = []
+
+        @contextlib.asynccontextmanager
+        async def connect(host, port, *, configuration, create_protocol):
+            client = create_protocol(QuicConnection(configuration=configuration))
+            self.clients.append(client)
+            yield client
+
+        return MasqueConnectionPool(
+            configuration=QuicConfiguration(is_client=True),
+            create_protocol=FakeMasqueClient,
+            connect=connect,
+            **kwargs)
+
+    async def connect_udp(self, pool, addr):
+        return await pool.connect_udp("proxy.example.com", 443, "https://proxy.example.com/", addr)
+
+    @asynctest
+    async def test_reuse(self):
+        pool = self.create_pool()
+        first = await self.connect_udp(pool, "a.example.com:443")
+        second = await self.connect_udp(pool, "a.example.com:443")
+        other = await self.connect_udp(pool, "b.example.com:443")
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(pool.tunnels_opened, 2)
+        self.assertEqual(pool.tunnels_reused, 1)
+
+        # a single connection to the proxy is used
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.clients[0].connect_count, 2)
+
+        # a closed tunnel is replaced
+        first._closed.set()
+        third = await self.connect_udp(pool, "a.example.com:443")
+        self.assertIsNot(third, first)
+        self.assertEqual(self.clients[0].closed_tunnels, [first])
+
+        await pool.close()
+        self.assertEqual(self.clients[0].closed_tunnels, [first, other, third])
+
+    @asynctest
+    async def test_concurrent_requests(self):
+        pool = self.create_pool()
+        first, second = await asyncio.gather(
+            self.connect_udp(pool, "a.example.com:443"),
+            self.connect_udp(pool, "a.example.com:443"))
+        self.assertIs(first, second)
+        self.assertEqual(self.clients[0].connect_count, 1)
+        await pool.close()
+
+    @asynctest
+    async def test_connect_failed(self):
+        pool = self.create_pool()
+        self.assertIsNone(await self.connect_udp(pool, "unreachable:443"))
+        self.assertIsNone(await self.connect_udp(pool, "unreachable:443"))
+        self.assertEqual(self.clients[0].connect_count, 2)
+        self.assertEqual(pool.tunnels_opened, 0)
+        await pool.close()
+
+    @asynctest
+    async def test_load_balancing(self):
+        pool = self.create_pool(connections_per_proxy=2)
+        await pool.warm_up("proxy.example.com", 443)
+        self.assertEqual(len(self.clients), 2)
+
+        # the connection with the larger window gets the tunnel
+        self.clients[1]._quic._loss._cc.congestion_window *= 2
+        await self.connect_udp(pool, "a.example.com:443")
+        self.assertEqual([c.connect_count for c in self.clients], [0, 1])
+
+        # the connection with the shorter RTT gets the tunnel
+        self.assertEqual(self.clients[0].smoothed_rtt, self.clients[1].smoothed_rtt)
+        for client, rtt in zip(self.clients, [0.01, 0.1]):
+            client._quic._loss._rtt_initialized = True
+            client._quic._loss._rtt_smoothed = rtt
+        self.assertEqual([c.smoothed_rtt for c in self.clients], [0.01, 0.1])
+        await self.connect_udp(pool, "b.example.com:443")
+        self.assertEqual([c.connect_count for c in self.clients], [1, 1])
+
+        # closed connections are replaced
+        self.clients[0]._closed.set()
+        await self.connect_udp(pool, "c.example.com:443")
+        self.assertEqual(len(self.clients), 3)
+        self.assertEqual(self.clients[2].connect_count, 1)
+        await pool.close()
+
+    @asynctest
+    async def test_locks_released(self):
+        pool = self.create_pool()
+        await self.connect_udp(pool, "a.example.com:443")
+
+        # the lock is kept while a connection to the proxy is pooled
+        self.assertEqual(list(pool._locks), [("proxy.example.com", 443)])
+        await pool.close()
+        self.assertEqual(pool._locks, {})
+
+        # and forgotten if the connection could not be opened
+        @contextlib.asynccontextmanager
+        async def connect(host, port, *, configuration, create_protocol):
+            raise ConnectionError
+            yield
+
+        pool = MasqueConnectionPool(
+            configuration=QuicConfiguration(is_client=True),
+            create_protocol=FakeMasqueClient,
+            connect=connect)
+        for _ in range(2):
+            results = await asyncio.gather(
+                self.connect_udp(pool, "a.example.com:443"),
+                pool.warm_up("proxy.example.com", 443),
+                return_exceptions=True)
+            self.assertEqual([type(r) for r in results], [ConnectionError] * 2)
+        self.assertEqual(pool._locks, {})
+        self.assertEqual(pool._connections, {})
+        await pool.close()
+
+    @asynctest
+    async def test_idle_timeout(self):
+        pool = self.create_pool(idle_timeout=0.02)
+        busy = await self.connect_udp(pool, "a.example.com:443")
+        idle = await self.connect_udp(pool, "b.example.com:443")
+        pool.release(idle)
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.clients[0].closed_tunnels, [idle])
+        self.assertEqual(pool.tunnels_evicted, 1)
+
+        # tunnels in use are kept
+        self.assertIs(await self.connect_udp(pool, "a.example.com:443"), busy)
+        await pool.close()
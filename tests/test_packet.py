@@ -11,6 +11,7 @@ from aioquic.quic.packet import (
     QuicVersionInformation,
     decode_packet_number,
     encode_quic_retry,
+    encode_quic_stateless_reset,
     encode_quic_version_negotiation,
     get_retry_integrity_tag,
     pull_quic_header,
@@ -269,6 +270,17 @@ class PacketTest(TestCase):
             pull_quic_header(buf, host_cid_length=8)
         self.assertEqual(str(cm.exception), "Packet fixed bit is zero")
 
+    def test_stateless_reset(self):
+        token = bytes(range(16))
+        for i in range(16):
+            data = encode_quic_stateless_reset(size=21, stateless_reset_token=token)
+            self.assertEqual(len(data), 21)
+            self.assertEqual(data[-16:], token)
+
+            # it looks like a short header packet
+            header = pull_quic_header(Buffer(data=data), host_cid_length=4)
+            self.assertEqual(header.packet_type, QuicPacketType.ONE_RTT)
+
 
 class ParamsTest(TestCase):
     maxDiff = None
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from aioquic.quic.retry import QuicRetryTokenHandler
+from aioquic.quic.retry import QuicRetryTokenHandler, is_new_token
 
 
 class QuicRetryTokenHandlerTest(TestCase):
@@ -16,7 +16,7 @@ class QuicRetryTokenHandlerTest(TestCase):
             addr, original_destination_connection_id, retry_source_connection_id
         )
         self.assertIsNotNone(token)
-        self.assertEqual(len(token), 256)
+        self.assertEqual(len(token), 63)
 
         # validate token - ok
         self.assertEqual(
@@ -27,11 +27,140 @@ class QuicRetryTokenHandlerTest(TestCase):
         # validate token - empty
         with self.assertRaises(ValueError) as cm:
             handler.validate_token(addr, b"")
-        self.assertEqual(
-            str(cm.exception), "Ciphertext length must be equal to key size."
-        )
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+
+        # validate token - tampered
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_token(addr, token[:-1] + bytes([token[-1] ^ 1]))
+        self.assertEqual(str(cm.exception), "Token is invalid.")
 
         # validate token - wrong address
         with self.assertRaises(ValueError) as cm:
             handler.validate_token(("1.2.3.4", 12345), token)
         self.assertEqual(str(cm.exception), "Remote address does not match.")
+
+    def test_new_token(self):
+        handler = QuicRetryTokenHandler(new_token_lifetime=3600.0)
+        token = handler.create_new_token(("1.2.3.4", 1234), now=100.0)
+        self.assertEqual(len(token), 43)
+
+        # validate token - ok, even from another port
+        handler.validate_new_token(("1.2.3.4", 5678), token, now=3700.0)
+
+        # validate token - expired
+        token = handler.create_new_token(("1.2.3.4", 1234), now=100.0)
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_new_token(("1.2.3.4", 1234), token, now=3700.1)
+        self.assertEqual(str(cm.exception), "Token has expired.")
+
+        # validate token - wrong address
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_new_token(("1.2.3.5", 1234), token, now=100.0)
+        self.assertEqual(str(cm.exception), "Remote address does not match.")
+
+    def test_new_token_reused(self):
+        addr = ("1.2.3.4", 1234)
+        handler = QuicRetryTokenHandler()
+        token = handler.create_new_token(addr)
+        handler.validate_new_token(addr, token)
+
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_new_token(addr, token)
+        self.assertEqual(str(cm.exception), "Token has already been used.")
+
+    def test_new_token_reused_after_eviction(self):
+        addr = ("1.2.3.4", 1234)
+        handler = QuicRetryTokenHandler(max_used_new_tokens=2)
+        tokens = [handler.create_new_token(addr, now=100.0 + i) for i in range(4)]
+        handler.validate_new_token(addr, tokens[0], now=200.0)
+        handler.validate_new_token(addr, tokens[1], now=200.0)
+        handler.validate_new_token(addr, tokens[3], now=200.0)
+
+        # the first token was forgotten but is still rejected, as are the
+        # tokens remembered
+        for token in tokens[:2] + tokens[3:]:
+            with self.assertRaises(ValueError) as cm:
+                handler.validate_new_token(addr, token, now=200.0)
+            self.assertEqual(str(cm.exception), "Token has already been used.")
+
+        # an unused token issued later is accepted
+        handler.validate_new_token(addr, tokens[2], now=200.0)
+
+        # expired tokens are forgotten first
+        token = handler.create_new_token(addr, now=100000.0)
+        handler.validate_new_token(addr, token, now=100000.0)
+        self.assertEqual(len(handler._used_new_tokens), 1)
+
+    def test_new_token_and_retry_token_are_distinct(self):
+        addr = ("1.2.3.4", 1234)
+        handler = QuicRetryTokenHandler()
+        new_token = handler.create_new_token(addr)
+        retry_token = handler.create_token(addr, b"original", b"retry")
+        self.assertTrue(is_new_token(new_token))
+        self.assertFalse(is_new_token(retry_token))
+
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_token(addr, new_token)
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_new_token(addr, retry_token)
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+
+        # the token type is authenticated
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_token(addr, b"\x00" + new_token[1:])
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+
+    def test_retry_token_expired(self):
+        addr = ("127.0.0.1", 1234)
+        handler = QuicRetryTokenHandler(lifetime=5.0)
+        token = handler.create_token(addr, b"original", b"retry", now=100.0)
+
+        self.assertEqual(
+            handler.validate_token(addr, token, now=105.0), (b"original", b"retry")
+        )
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_token(addr, token, now=105.1)
+        self.assertEqual(str(cm.exception), "Token has expired.")
+
+    def test_retry_token_key_rotation(self):
+        addr = ("127.0.0.1", 1234)
+        handler = QuicRetryTokenHandler()
+        token_1 = handler.create_token(addr, b"original", b"retry")
+
+        # tokens issued with the previous key remain valid
+        handler.rotate_key()
+        token_2 = handler.create_token(addr, b"original", b"retry")
+        self.assertEqual(handler.validate_token(addr, token_1), (b"original", b"retry"))
+        self.assertEqual(handler.validate_token(addr, token_2), (b"original", b"retry"))
+
+        # older keys are forgotten
+        handler.rotate_key()
+        with self.assertRaises(ValueError) as cm:
+            handler.validate_token(addr, token_1)
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+        self.assertEqual(handler.validate_token(addr, token_2), (b"original", b"retry"))
+
+    def test_retry_token_shared_key(self):
+        addr = ("::1", 1234, 0, 0)
+        key = bytes(range(32))
+        token = QuicRetryTokenHandler(key=key).create_token(
+            addr, b"original", b"retry"
+        )
+
+        # another server sharing the key validates the token
+        self.assertEqual(
+            QuicRetryTokenHandler(key=key).validate_token(addr, token),
+            (b"original", b"retry"),
+        )
+
+        # a server with another key does not
+        with self.assertRaises(ValueError) as cm:
+            QuicRetryTokenHandler().validate_token(addr, token)
+        self.assertEqual(str(cm.exception), "Token is invalid.")
+
+    def test_retry_token_bad_key(self):
+        with self.assertRaises(ValueError) as cm:
+            QuicRetryTokenHandler(key=b"short")
+        self.assertEqual(str(cm.exception), "Retry token key must be 32 bytes")
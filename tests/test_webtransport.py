@@ -2,13 +2,14 @@ from unittest import TestCase
 
 from aioquic.h3.connection import H3_ALPN, ErrorCode, H3Connection
 from aioquic.h3.events import (
+    DatagramDropped,
     DatagramReceived,
     HeadersReceived,
     WebTransportStreamDataReceived,
 )
 from aioquic.h3.exceptions import InvalidStreamTypeError
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import DatagramFrameReceived
+from aioquic.quic.events import DatagramFrameDropped, DatagramFrameReceived
 
 from .test_h3 import (
     FakeQuicConnection,
@@ -286,8 +287,15 @@ class WebTransportTest(TestCase):
             with self.assertRaises(InvalidStreamTypeError):
                 h3_client.send_datagram(data=b"foo", stream_id=1)
 
+            # the quarter stream ID takes one byte
+            self.assertEqual(
+                h3_client.max_datagram_size(session_id),
+                quic_client.max_datagram_frame_data_size - 1,
+            )
+
             # send datagram
             h3_client.send_datagram(data=b"foo", stream_id=session_id)
+            self.assertEqual(h3_client.datagrams_pending, 1)
 
             # receive datagram
             events = h3_transfer(quic_client, h3_server)
@@ -296,6 +304,33 @@ class WebTransportTest(TestCase):
                 [DatagramReceived(data=b"foo", stream_id=session_id)],
             )
 
+            # send datagram with a prefix
+            h3_client.send_datagram(data=b"foo", stream_id=session_id, prefix=b"\x00")
+            events = h3_transfer(quic_client, h3_server)
+            self.assertEqual(
+                events,
+                [DatagramReceived(data=b"\x00foo", stream_id=session_id)],
+            )
+
+    def test_handle_datagram_dropped(self):
+        quic_server = FakeQuicConnection(
+            configuration=QuicConfiguration(is_client=False)
+        )
+        h3_server = H3Connection(quic_server)
+
+        # a datagram for a stream is dropped
+        self.assertEqual(
+            h3_server.handle_event(
+                DatagramFrameDropped(data=b"\x41\x00foo", flow_id=256)
+            ),
+            [DatagramDropped(data=b"foo", stream_id=1024)],
+        )
+
+        # a datagram which is not associated to a stream is dropped
+        self.assertEqual(
+            h3_server.handle_event(DatagramFrameDropped(data=b"quack")), []
+        )
+
     def test_handle_datagram_truncated(self):
         quic_server = FakeQuicConnection(
             configuration=QuicConfiguration(is_client=False)